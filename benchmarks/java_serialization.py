@@ -0,0 +1,49 @@
+#! /usr/bin/env python
+####################################################################################################
+# benchmarks/java_serialization.py
+# A micro-benchmark of neuropythy.java.serialize_numpy, which encodes the numpy arrays that are sent
+# to the JVM, on fsaverage-sized coordinate and face matrices. The JVM is not required.
+# Usage: python benchmarks/java_serialization.py [repeats]
+
+import sys, time
+from array import array
+import numpy as np
+
+from neuropythy.java import serialize_numpy
+
+def legacy_serialize_numpy(m, t):
+    # the implementation of serialize_numpy prior to writing directly into a preallocated buffer
+    header = array('i', [len(m.shape)] + list(m.shape))
+    body = array(t, m.flatten().tolist())
+    if sys.byteorder != 'big':
+        header.byteswap()
+        body.byteswap()
+    return bytearray(header.tostring() + body.tostring())
+
+def benchmark(fn, m, t, repeats):
+    # yields (best time in seconds, MB/s) over the given number of repeats
+    best = None
+    for _ in range(repeats):
+        t0 = time.time()
+        res = fn(m, t)
+        dt = time.time() - t0
+        best = dt if best is None or dt < best else best
+    return (best, len(res) / 1024.0**2 / max(best, 1e-9))
+
+def main(args):
+    repeats = int(args[0]) if len(args) > 0 else 5
+    # fsaverage has 163842 vertices and 327680 faces per hemisphere
+    rng = np.random.RandomState(0)
+    cases = [('coordinates (3 x 163842) doubles', 100 * rng.randn(3, 163842), 'd'),
+             ('faces (3 x 327680) ints', rng.randint(0, 163842, size=(3, 327680)), 'i')]
+    for (name, m, t) in cases:
+        if serialize_numpy(m, t) != legacy_serialize_numpy(m, t):
+            raise RuntimeError('serialize_numpy and legacy output differ for %s' % name)
+        print name
+        for (fname, fn) in [('legacy', legacy_serialize_numpy), ('current', serialize_numpy)]:
+            (dt, rate) = benchmark(fn, m, t, repeats)
+            print '   %-8s %8.2f ms %10.1f MB/s' % (fname, dt * 1000, rate)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
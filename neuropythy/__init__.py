@@ -27,6 +27,7 @@ def reload_neuropythy():
             'neuropythy.util',
             'neuropythy.java',
             'neuropythy.geometry.util',
+            'neuropythy.geometry.locator',
             'neuropythy.geometry.mesh',
             'neuropythy.geometry',
             'neuropythy.topology',
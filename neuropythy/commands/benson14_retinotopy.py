@@ -18,6 +18,7 @@ from neuropythy.freesurfer import (freesurfer_subject, add_subject_path,
                                    Hemisphere)
 from neuropythy.util import CommandLineParser
 from neuropythy.vision import (predict_retinotopy)
+from neuropythy.topology import set_interpolation_cache_path
 
 benson14_retinotopy_help = \
    '''
@@ -65,6 +66,12 @@ benson14_retinotopy_help = \
       directories, which are given here in descending search priority) when looking
       for subjects by name. This option cannot be specified multiple times, but it
       may contain : characters to separate directories, as in PATH.
+    * --interpolation-cache=|-I
+      Specifies the directory in which the interpolation operators between the
+      subject's registrations and the template are cached. Once an operator has been
+      cached, later runs for the same subject load rather than recalculate it. By
+      default this is the NEUROPYTHY_INTERPOLATION_CACHE environment variable; if
+      neither is given, or the value is 'none', operators are not cached on disk.
     * --no-overwrite|-n
       This flag indicates that, when writing output files, no file should ever be
       replaced, should it already exist.
@@ -88,7 +95,8 @@ _benson14_parser_instructions = [
     ('a', 'angle-tag',              'angle_tag',         'benson14_angle'),
     ('l', 'label-tag',              'label_tag',         'benson14_varea'),
     ('d', 'subjects-dir',           'subjects_dir',      None),
-    ('t', 'template',               'template',          'benson17')
+    ('t', 'template',               'template',          'benson17'),
+    ('I', 'interpolation-cache',    'interpolation_cache', None)
     ]
 _benson14_parser = CommandLineParser(_benson14_parser_instructions)
 def benson14_retinotopy_command(*args):
@@ -110,6 +118,10 @@ def benson14_retinotopy_command(*args):
     # Add the subjects directory, if there is one
     if 'subjects_dir' in opts and opts['subjects_dir'] is not None:
         add_subject_path(opts['subjects_dir'])
+    # Setup the interpolation cache, if requested
+    if opts['interpolation_cache'] is not None:
+        ic = opts['interpolation_cache']
+        set_interpolation_cache_path(None if ic.lower() == 'none' else ic)
     ow = not opts['no_overwrite']
     nse = opts['no_surf_export']
     nve = opts['no_vol_export']
@@ -18,6 +18,8 @@ from neuropythy.freesurfer import (freesurfer_subject, add_subject_path,
                                    Hemisphere)
 from neuropythy.util import CommandLineParser
 from neuropythy.vision import (register_retinotopy, retinotopy_model)
+from neuropythy.topology import set_interpolation_cache_path
+from neuropythy.java import java_prewarm
 
 
 register_retinotopy_help = \
@@ -132,6 +134,24 @@ register_retinotopy_help = \
       directories, which are given here in descending search priority) when looking
       for subjects by name. This option cannot be specified multiple times, but it
       may contain : characters to separate directories, as in PATH.
+    * --interpolation-cache=|-I
+      Specifies the directory in which the interpolation operators between the
+      subject's registrations and the template are cached. Once an operator has been
+      cached, later runs for the same subject load rather than recalculate it. By
+      default this is the NEUROPYTHY_INTERPOLATION_CACHE environment variable; if
+      neither is given, or the value is 'none', operators are not cached on disk.
+    * --java-heap=|-J
+      Specifies the maximum heap size of the JVM used for the registration (e.g., 4g).
+      By default this is the NEUROPYTHY_JAVA_HEAP environment variable or 2g. The JVM
+      is started in the background while the subjects are loaded.
+    * --warm-start|-i
+      This flag indicates that the registration of each hemisphere should be started
+      from the registration written by a previous run of this command (i.e., the file
+      surf/lh.<string>.sphere.reg or xhemi/surf/lh.<string>.sphere.reg, where <string>
+      is the registration name; see --registration-name) rather than from the prior.
+      When the data have changed only slightly since that run, the registration
+      converges in a fraction of the steps. If the file does not exist, the
+      registration starts from the prior as usual.
     * --no-overwrite|-n
       This flag indicates that, when writing output files, no file should ever be
       replaced, should it already exist.
@@ -151,6 +171,7 @@ _retinotopy_parser_instructions = [
     ('X', 'no-registration-export', 'no_reg_export',     False),
     ('n', 'no-overwrite',           'no_overwrite',      False),
     ('N', 'no-partial-correction',  'part_vol_correct',  True),
+    ('i', 'warm-start',             'warm_start',        False),
     # Options                       
     ['e', 'eccen-lh',               'eccen_lh_file',     None],
     ['a', 'angle-lh',               'angle_lh_file',     None],
@@ -170,7 +191,9 @@ _retinotopy_parser_instructions = [
     ['l', 'label-tag',              'label_tag',         'v123roi_predict'],
     ['u', 'registration-name',      'registration_name', 'retinotopy_sym'],
     ['M', 'max-output-eccen',       'max_out_eccen',     '90'],
-    ['d', 'subjects-dir',           'subjects_dir',      None]]
+    ['d', 'subjects-dir',           'subjects_dir',      None],
+    ['I', 'interpolation-cache',    'interpolation_cache', None],
+    ['J', 'java-heap',              'java_heap',         None]]
 _retinotopy_parser = CommandLineParser(_retinotopy_parser_instructions)
 def _guess_surf_file(fl):
     if len(fl) > 4 and (fl[-4:] == '.mgz' or fl[-4:] == '.mgh'):
@@ -198,6 +221,12 @@ def register_retinotopy_command(args):
     # Add the subjects directory, if there is one
     if 'subjects_dir' in opts and opts['subjects_dir'] is not None:
         add_subject_path(opts['subjects_dir'])
+    # Setup the interpolation cache, if requested
+    if opts['interpolation_cache'] is not None:
+        ic = opts['interpolation_cache']
+        set_interpolation_cache_path(None if ic.lower() == 'none' else ic)
+    # Start the JVM now so that it is ready by the time the subjects have been loaded
+    java_prewarm(heap=opts['java_heap'])
     # Parse the simple numbers
     for o in ['weight_cutoff', 'edge_strength', 'angle_strength', 'func_strength',
               'max_step_size', 'max_out_eccen']:
@@ -224,6 +253,17 @@ def register_retinotopy_command(args):
             if opts['angle'  + suffix] is not None: ang = _guess_surf_file(opts['angle'  + suffix])
             if opts['eccen'  + suffix] is not None: ecc = _guess_surf_file(opts['eccen'  + suffix])
             if opts['weight' + suffix] is not None: wgt = _guess_surf_file(opts['weight' + suffix])
+            # The registration file, which we may start from and which we export below
+            regnm = '.'.join([h.lower(), opts['registration_name'], 'sphere', 'reg'])
+            regfl = (os.path.join(sub.directory, 'surf', regnm) if h == 'LH' else
+                     os.path.join(sub.directory, 'xhemi', 'surf', regnm))
+            warm = None
+            if opts['warm_start']:
+                if os.path.isfile(regfl):
+                    note('    - Warm-starting from registration file: %s' % regfl)
+                    warm = regfl
+                else:
+                    note('    - No registration file to warm-start from: %s' % regfl)
             # Do the registration
             note('    - Running Registration...')
             res[h] = register_retinotopy(hemi, retinotopy_model(),
@@ -236,12 +276,11 @@ def register_retinotopy_command(args):
                                          prior=opts['prior'],
                                          max_predicted_eccen=opts['max_out_eccen'],
                                          max_steps=opts['max_steps'],
-                                         max_step_size=opts['max_step_size'])
+                                         max_step_size=opts['max_step_size'],
+                                         initial_registration=warm)
             # Perform the hemi-specific outputs now:
             if not opts['no_reg_export']:
-                regnm = '.'.join([h.lower(), opts['registration_name'], 'sphere', 'reg'])
-                flnm = (os.path.join(sub.directory, 'surf', regnm) if h == 'LH' else
-                        os.path.join(sub.directory, 'xhemi', 'surf', regnm))
+                flnm = regfl
                 if ow or not os.path.exist(flnm):
                     note('    - Exporting registration file: %s' % flnm)
                     fsio.write_geometry(flnm, res[h].coordinates.T, res[h].faces.T,
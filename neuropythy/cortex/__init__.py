@@ -9,6 +9,7 @@ import scipy.spatial          as space
 import scipy.optimize         as spopt
 import nibabel.freesurfer.io  as fsio
 import neuropythy.geometry    as geo
+from neuropythy.geometry.mesh import (_address_data, _unaddress_data)
 from neuropythy.immutable import Immutable
 from scipy.sparse         import (lil_matrix, csr_matrix)
 from numpy.linalg         import lstsq, norm
@@ -663,9 +664,10 @@ class CorticalMesh(Immutable):
     def unaddress(self, data):
         '''mesh.unaddress(addr) yields a coordinate matrix of points on the given mesh that are
            located at the mesh addresses given in addr. The addr matrix should be generated from
-           a mesh.address(points) method call; the two meshes must be topologically equivalent
-           or an error may be raised. The resulting matrix will always be sized 2 or 3 by n unless
-           the address is of a single point, in which case that point is returned.'''
+           a mesh.address(points) method call (or may be a compact address array); the two meshes
+           must be topologically equivalent or an error may be raised. The resulting matrix will
+           always be sized 2 or 3 by n unless the address is of a single point, in which case that
+           point is returned.'''
         # addresses are dictionaries that contain two fields: 'face_id' and 'coordinates'
         # these may be numbers or a list and a matrix whose second dimension is the same lenght
         if self.coordinates.shape[0] == 2:
@@ -673,39 +675,29 @@ class CorticalMesh(Immutable):
             smesh = self.meta('source_mesh')
             if smesh is None: raise ValueError('2D mesh has no source mesh!')
             return self.reproject(smesh.unaddress(data))
-        if not isinstance(data, dict):
-            raise ValueError('address data must be a dictionary')
-        if 'face_id' not in data: raise ValueError('address must contain face_id key')
-        if 'coordinates' not in data: raise ValueError('address must contain coordinates key')
-        face_id = data['face_id']
-        coordinates = np.asarray(data['coordinates'])
-        if hasattr(face_id, '__iter__'):
-            if len(coordinates.shape) != 2:
-                raise ValueError('if face_id is a list, then coordinates must be a matrix')
-            if coordinates.shape[1] != len(face_id):
-                coordinates = coordinates.T
-            tx = np.asarray(self.coordinates[:, f] for f in self.faces[face_id])
-            return geo.barycentric_to_cartesian(tx, coordinates)
-        else:
+        (face_id, coordinates) = _address_data(data)
+        if len(face_id.shape) == 0:
             return geo.barycentric_to_cartesian(self.face_coordinates[:, :, face_id],
                                                 coordinates)
-    def address(self, data):
+        return _unaddress_data(self.coordinates.T, self.faces.T, face_id, coordinates).T
+    def address(self, data, compact=False):
         '''
         mesh.address(X) yields a dictionary containing the address or addresses of the point or
         points given in the vector or coordinate matrix X. Addresses specify a single unique 
         topological location on the mesh such that deformations of the mesh will address the same
         points differently. To convert a point from one mesh to another isomorphic mesh, you can
         address the point in the first mesh then unaddress it in the second mesh. Note that an
-        address may only be obtained from a spherical or 2D mesh.
+        address may only be obtained from a spherical or 2D mesh. If compact is True, a compact
+        address array is yielded instead; see neuropythy.geometry.compact_address.
         '''
         if self.coordinates.shape[0] == 2:
             smesh = self.meta('source_mesh')
             if smesh is None: raise ValueError('2D mesh has no source mesh!')
-            return smesh.address(self.unproject(data))
+            return smesh.address(self.unproject(data), compact=compact)
         else:
             reg = self.meta('registration')
             if reg is None: raise ValueError('mesh has no registration!')
-            return reg.address(data)
+            return reg.address(data, compact=compact)
 
     def option(self, opt):
         '''mesh.option(x) yields the value of the option f in the given mesh. If x is not an option
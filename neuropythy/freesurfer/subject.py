@@ -414,37 +414,42 @@ class Hemisphere(Immutable):
         else:
             self.add_property(name, arg)
 
-    def address(self, coords, registration=None, nearest=True):
+    def address(self, coords, registration=None, nearest=True, compact=False):
         '''
         hemi.address(coords) yields the address dictionary of the given coords to their closest
         points in the 3D sphere registration of the given hemi. The optional argument registration
         may be specified to indicate that a different registration should be used; the default
         (None) indicates that the subject's native registration should be used. The optional
         argument nearest (default True) may also be set to False to indicate that the nearest point
-        in the mesh should not be looked up
+        in the mesh should not be looked up. If the optional argument compact is True, then a
+        compact address array is yielded instead of a dictionary; such arrays may be saved with
+        np.save and reused; see neuropythy.geometry.compact_address.
         '''
         coords = np.asarray(coords)
         if len(coords.shape) == 1:
             if coords.shape[0] == 0: return []
-            else: return self.address([coords], registration=registration)[:,0]
-        transposed = True if coords.shape[0] != 3 else False
-        coords = coords.T if transposed else coords
+            addr = self.address([coords], registration=registration, nearest=nearest,
+                                compact=compact)
+            if compact: return addr[0]
+            return {'face_id': addr['face_id'][0], 'coordinates': addr['coordinates'][:,0]}
+        coords = coords if coords.shape[1] == 3 else coords.T
         reg = self.topology.registrations[self.subject.id if registration is None else registration]
         if nearest: coords = reg.nearest(coords)
-        return reg.address(coords)
+        return reg.address(coords, compact=compact)
 
     def unaddress(self, addrs, registration=None):
         '''
-        hemi.unaddress(addrs) yields the coordinates of the given address dictionary addrs, looked
-        up in the native registration of the given hemisphere hemi. The optional argument
-        registration can be provided to indicate that a registration other than the subject's native
-        registration should be used; the default (None) uses the native.
+        hemi.unaddress(addrs) yields the coordinates of the given address dictionary (or compact
+        address array) addrs, looked up in the native registration of the given hemisphere hemi.
+        The optional argument registration can be provided to indicate that a registration other
+        than the subject's native registration should be used; the default (None) uses the native.
         '''
         reg = self.topology.registrations[self.subject.id if registration is None else registration]
         return reg.unaddress(addrs).T
             
     def interpolate(self, from_hemi, property_name, 
-                    apply=True, method='automatic', mask=None, null=None, n_jobs=1):
+                    apply=True, method='automatic', mask=None, null=None, n_jobs=None,
+                    registration=None, chunk_size=None):
         '''
         hemi.interpolate(from_hemi, prop) yields a list of property values that have been resampled
         onto the given hemisphere hemi from the property with the given name prop of the given 
@@ -454,11 +459,17 @@ class Hemisphere(Immutable):
         this case, the apply option must be a new property name string, otherwise it is treated as
         False. Note that in order to work, the hemi and from_hemi objects must share a registration
         such as fsaverage or fsaverage_sym.
+        If prop is a list of property names or a dictionary whose keys are names and whose values
+        are property names or arrays of values, then a dictionary of the interpolated properties is
+        returned. In this case, the method option may also be a dictionary of methods whose keys
+        are the same names, and all of the properties that share a method are interpolated
+        together, as one matrix, using a single point-location pass over the mesh.
 
         Options:
           * mask (default: None) indicates that the given True/False or 0/1 valued list/array should
-            be used; any point whose nearest neighbor (see below) is in the given mask will, instead
-            of an interpolated value, be set to the null value (see null option).
+            be used; any source vertex that is not in the mask is dropped from the interpolation,
+            and the weights of the remaining vertices are renormalized; destination vertices that
+            are left with no vertices to interpolate from are set to the null value.
           * null (default: None) indicates the value that should be placed in the returned result if
             either a vertex does not lie in any triangle or a vertex is masked out via the mask
             option.
@@ -467,20 +478,32 @@ class Hemisphere(Immutable):
             while 2 represents a slightly smoother version of this. Note that this is not an order
             of interpolation option.
           * method (default: 'automatic') specifies what method to use for interpolation. The only
-            currently supported methods are 'automatic' or 'nearest'. The 'nearest' method does not
-            actually perform a nearest-neighbor interpolation but rather assigns to a destination
-            vertex the value of the source vertex whose veronoi-like polygon contains the
-            destination vertex; note that the term 'veronoi-like' is used here because it uses the
-            Voronoi diagram that corresponds to the triangle mesh and not the true delaunay
-            triangulation. The 'automatic' checks every destination vertex and assigns it the
-            'nearest' value if that value would not be a number, otherwise it interpolates linearly
-            within the vertex's source triangle.
-          * n_jobs (default: 1) is passed along to the cKDTree.query method, so may be set to an
-            integer to specify how many processors to use, or may be -1 to specify all processors.
+            currently supported methods are 'automatic' (or 'linear') or 'nearest'. The 'nearest'
+            method assigns to each destination vertex the value of the nearest vertex of the source
+            triangle that contains it (or of the nearest source vertex, if no triangle contains
+            it). The 'automatic' method interpolates linearly within the vertex's source triangle.
+          * n_jobs (default: None) is passed along to the cKDTree.query method, so may be set to an
+            integer to specify how many processors to use, or may be -1 to specify all processors;
+            None uses the library-wide default (see neuropythy.geometry.set_kdtree_workers).
+          * registration (default: None) specifies the name or list of names of the shared
+            registrations that may be used, in order of preference; by default, fsaverage is
+            preferred over fsaverage_sym (see Topology.registration_order).
+          * chunk_size (default: None) may specify that the interpolation be performed at most
+            chunk_size vertices at a time in order to bound the memory it uses; see
+            Topology.interpolate_from.
         '''
         if from_hemi.chirality != self.chirality:
             raise ValueError('hemispheres have opposite chiralities')
-        if isinstance(property_name, basestring):
+        if isinstance(property_name, dict) or (
+                hasattr(property_name, '__iter__') and
+                not isinstance(property_name, np.ndarray) and
+                len(property_name) > 0 and
+                all(isinstance(s, basestring) for s in property_name)):
+            return self._interpolate_properties(from_hemi, property_name,
+                                                apply=apply, method=method, mask=mask,
+                                                null=null, n_jobs=n_jobs,
+                                                registration=registration, chunk_size=chunk_size)
+        elif isinstance(property_name, basestring):
             if not from_hemi.has_property(property_name):
                 raise ValueError('given property ' + property_name + ' is not in from_hemi!')
             data = from_hemi.prop(property_name)
@@ -488,20 +511,15 @@ class Hemisphere(Immutable):
             data = property_name
             property_name = apply if isinstance(apply, basestring) else None
         elif hasattr(property_name, '__iter__'):
-            if all(isinstance(s, basestring) for s in property_name):
-                return {p: self.interpolate(from_hemi, p, 
-                                            method=method, mask=mask,
-                                            null=null, n_jobs=n_jobs)
-                        for p in property_name}
-            else:
-                data = np.asarray(property_name)
-                property_name = apply if isinstance(apply, basestring) else None
+            data = np.asarray(property_name)
+            property_name = apply if isinstance(apply, basestring) else None
         else:
             raise ValueError('property_name is not a string or valid list')
         # pass data along to the topology object...
         result = self.topology.interpolate_from(from_hemi.topology, data,
                                                 method=method, mask=mask,
-                                                null=null, n_jobs=n_jobs)
+                                                null=null, n_jobs=n_jobs,
+                                                registration=registration, chunk_size=chunk_size)
         if result is not None:
             if apply is True and property_name is not None:
                 self.prop(property_name, result)
@@ -509,7 +527,48 @@ class Hemisphere(Immutable):
                 self.prop(apply, result)
         return result
 
-    def partial_volume_factor(self, distance_cutoff=None, angle_cutoff=2.7):
+    def _interpolate_properties(self, from_hemi, props, apply=True, method='automatic',
+                                mask=None, null=None, n_jobs=None, registration=None,
+                                chunk_size=None):
+        # interpolates many properties at once; see hemi.interpolate
+        if not isinstance(props, dict): props = {p:p for p in props}
+        methods = method if isinstance(method, dict) else {k:method for k in props.iterkeys()}
+        data = {}
+        for (k,v) in props.iteritems():
+            if isinstance(v, basestring):
+                if not from_hemi.has_property(v):
+                    raise ValueError('given property ' + v + ' is not in from_hemi!')
+                v = from_hemi.prop(v)
+            data[k] = np.asarray(v)
+        # stack the properties that share a method and a type into one matrix each
+        groups = {}
+        for (k,v) in data.iteritems():
+            mtd = methods.get(k, 'automatic')
+            mtd = 'automatic' if mtd == 'linear' else mtd
+            gk = (mtd, v.dtype) if len(v.shape) == 1 else (mtd, k)
+            if gk not in groups: groups[gk] = []
+            groups[gk].append(k)
+        res = {}
+        for ((mtd, _), ks) in groups.iteritems():
+            stack = data[ks[0]] if len(ks) == 1 else np.transpose([data[k] for k in ks])
+            interp = self.topology.interpolate_from(from_hemi.topology, stack,
+                                                    method=mtd, mask=mask,
+                                                    null=null, n_jobs=n_jobs,
+                                                    registration=registration,
+                                                    chunk_size=chunk_size)
+            if len(ks) == 1:
+                res[ks[0]] = interp
+            else:
+                interp = np.asarray(interp)
+                for (i,k) in enumerate(ks):
+                    res[k] = interp[:,i]
+        if apply is True:
+            for (k,v) in res.iteritems():
+                self.prop(k, v)
+        return res
+
+    def partial_volume_factor(self, distance_cutoff=None, angle_cutoff=2.7, n_jobs=None,
+                              chunk_size=65536):
         '''
         mesh.partial_volume_factor() yields an array of partial voluming risk metric values, one per
         vertex. Each value is a number between 0 and 1 such that a 1 indicates a very high risk for
@@ -521,16 +580,28 @@ class Hemisphere(Immutable):
         The partial volume factor for u, f(u) = length({v in V | (N(v) . N(u)) < k}) / length(V); the
         function N(u) indicates the vector normal to the cortical surface at vertex u and k is the
         cosine of the angle_cutoff option, which, by default, is 2.7 rad, or approximately 155 deg.
+        The neighborhoods are found chunk_size vertices at a time using n_jobs workers (None uses
+        the library-wide default; see neuropythy.geometry.set_kdtree_workers).
         '''
         pial = self.pial_surface
         normals = pial.vertex_normals.T
+        X = pial.coordinates.T
         d = np.mean(pial.edge_lengths) if distance_cutoff is None else distance_cutoff
         k = np.cos(angle_cutoff)
-        # get the neighbors
-        neis = pial.vertex_spatial_hash.query_ball_point(pial.coordinates.T, r=d)
-        # calculate the fraction with large angles:
-        return [float(len([1 for v in V if np.dot(u,normals[v]) < k])) / float(len(V))
-                for (u,V) in zip(normals, neis)]
+        res = np.empty(X.shape[0])
+        for start in range(0, X.shape[0], chunk_size):
+            end = min(start + chunk_size, X.shape[0])
+            # get the neighbors
+            neis = geo.kdtree_query_ball_point(pial.vertex_spatial_hash, X[start:end], d,
+                                               n_jobs=n_jobs)
+            lens = np.asarray([len(V) for V in neis], dtype=np.int64)
+            us = np.repeat(np.arange(start, end), lens)
+            vs = np.fromiter(itertools.chain.from_iterable(neis), dtype=np.int64, count=len(us))
+            # calculate the fraction with large angles:
+            large = np.sum(normals[us] * normals[vs], axis=1) < k
+            nlarge = np.bincount(us[large] - start, minlength=(end - start))
+            res[start:end] = nlarge / lens.astype(np.float64)
+        return res.tolist()
         
     
     # This [private] function and this variable set up automatic properties from the FS directory
@@ -1086,7 +1157,7 @@ class Subject(Immutable):
 ####################################################################################################
 # Some FreeSurfer specific functions
 
-def cortex_to_ribbon_map_smooth(sub, hemi=None, k=12, distance=4, sigma=0.35355):
+def cortex_to_ribbon_map_smooth(sub, hemi=None, k=12, distance=4, sigma=0.35355, n_jobs=None):
     '''cortex_to_ribbon_map_smooth(sub) yields a dictionary whose keys are the indices of the ribbon
          voxels for the given FreeSurfer subject sub and whose values are a tuple of both (0) a list
          of vertex labels associated with the given voxel and (1) a list of the weights associated
@@ -1102,12 +1173,16 @@ def cortex_to_ribbon_map_smooth(sub, hemi=None, k=12, distance=4, sigma=0.35355)
          * hemi (default: None) specifies which hemisphere to operate over; this may be 'lh', 'rh',
            or None (to do both)
          * sigma (default: 1 / (2 sqrt(2))) specifies the standard deviation of the Gaussian used
-           to weight the vertices contributing to a voxel'''
+           to weight the vertices contributing to a voxel
+         * n_jobs (default: None) specifies the number of workers used in the KD-tree queries; None
+           uses the library-wide default (see neuropythy.geometry.set_kdtree_workers)'''
     
     # we can speed things up slightly by doing left and right hemispheres separately
     if hemi is None:
-        return (cortex_to_ribbon_map(sub, k=k, distance=distance, sigma=sigma, hemi='lh'),
-                cortex_to_ribbon_map(sub, k=k, distance=distance, sigma=sigma, hemi='rh'))
+        return (cortex_to_ribbon_map_smooth(sub, k=k, distance=distance, sigma=sigma, hemi='lh',
+                                            n_jobs=n_jobs),
+                cortex_to_ribbon_map_smooth(sub, k=k, distance=distance, sigma=sigma, hemi='rh',
+                                            n_jobs=n_jobs))
     if not isinstance(hemi, basestring):
         raise ValueError('hemi must be a string \'lh\', \'rh\', or None')
     if hemi.lower() == 'lh' or hemi.lower() == 'left':
@@ -1125,10 +1200,11 @@ def cortex_to_ribbon_map_smooth(sub, hemi=None, k=12, distance=4, sigma=0.35355)
     # now we want to make an octree from the midgray voxels
     txcoord = lambda mtx: np.dot(tmtx[0:3], np.vstack((mtx, np.ones(mtx.shape[1]))))
     midgray = txcoord(hemi.midgray_surface.coordinates)
-    near = space.KDTree(midgray.T)
+    near = space.cKDTree(midgray.T)
     
     # then we find the k nearest vertices for each voxel with a distance cutoff
-    (d, nei) = near.query(idcs, k=k, distance_upper_bound=distance, p=2)
+    (d, nei) = geo.kdtree_query(near, idcs, k=k, n_jobs=n_jobs,
+                                distance_upper_bound=distance, p=2)
     ## we want the i'th row of d and nei to be a list of the i'th-nearests to each voxel center
     d = d.T
     nei = nei.T
@@ -1186,7 +1262,7 @@ def cortex_to_ribbon_map_smooth(sub, hemi=None, k=12, distance=4, sigma=0.35355)
     ### we have to check if any of these values are 0 and give them a nearest-vertex assignment
     zero_idcs = np.where(wtot < 1e-9)
     if len(zero_idcs) > 0:
-        (d0s, nei0s) = near.query(idcs.T[zero_idcs], k=1, p=2)
+        (d0s, nei0s) = geo.kdtree_query(near, idcs.T[zero_idcs], k=1, n_jobs=n_jobs, p=2)
         nei[0, zero_idcs] = nei0s
         d[0, zero_idcs] = 1.0
         d[1:, zero_idcs] = 0.0
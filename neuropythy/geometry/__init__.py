@@ -23,6 +23,12 @@ from .util import (
     barycentric_to_cartesian,
     triangle_address,
     triangle_unaddress,
-    point_in_triangle)
-from .mesh import Mesh
+    point_in_triangle,
+    kdtree_workers,
+    set_kdtree_workers,
+    kdtree_query,
+    kdtree_query_ball_point)
+from .locator import (SphericalTriangleIndex, PlanarTriangleIndex)
+from .mesh import (Mesh, apply_interpolation_matrix, interpolate_in_chunks, address_dtype,
+                   compact_address, expand_address)
 
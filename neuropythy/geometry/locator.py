@@ -0,0 +1,305 @@
+####################################################################################################
+# neuropythy/geometry/locator.py
+# Spatial indices that find the triangles of a mesh containing a set of points.
+# By Noah C. Benson
+
+import numpy as np
+
+def _cell_ranges_to_bins(owner, cell0, cell1, row0, row1, row_stride, offset, ncells):
+    '''
+    _cell_ranges_to_bins(owner, i0, i1, j0, j1, stride, offset, ncells) yields a tuple (indptr,
+    indices) of the compressed bins (in the style of scipy.sparse.csr_matrix) that results from
+    inserting each owner[k] into every cell (i, j) with i0[k] <= i <= i1[k] and j0[k] <= j <= j1[k];
+    the id of cell (i, j) is offset[k] + i*stride + j.
+    '''
+    ni = cell1 - cell0 + 1
+    nj = row1 - row0 + 1
+    counts = ni * nj
+    tot = np.sum(counts)
+    # for each inserted (owner, cell) pair, find its position within the owner's block of cells
+    starts = np.cumsum(counts) - counts
+    k = np.repeat(np.arange(len(owner)), counts)
+    q = np.arange(tot) - starts[k]
+    ii = cell0[k] + q // nj[k]
+    jj = row0[k] + q % nj[k]
+    cells = offset[k] + ii*row_stride + jj
+    order = np.argsort(cells, kind='mergesort')
+    indices = owner[k[order]]
+    indptr = np.zeros(ncells + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(cells, minlength=ncells))
+    return (indptr, indices)
+
+def _bin_candidates(indptr, indices, cells):
+    '''
+    _bin_candidates(indptr, indices, cells) yields a tuple (point_ids, triangle_ids) of all the
+    candidate (point, triangle) pairs found by looking up each point k's cell, cells[k], in the
+    given compressed bins.
+    '''
+    counts = indptr[cells + 1] - indptr[cells]
+    tot = np.sum(counts)
+    pt_ids = np.repeat(np.arange(len(cells)), counts)
+    starts = np.cumsum(counts) - counts
+    idx = indptr[cells][pt_ids] + (np.arange(tot) - starts[pt_ids])
+    return (pt_ids, indices[idx])
+
+def _best_candidates(npts, pt_ids, tri_ids, bc, hit):
+    '''
+    _best_candidates(n, pt_ids, tri_ids, bc, hit) yields the tuple (ids, bc) in which ids is the
+    triangle id chosen for each of the n points (or -1) and bc is an n x 3 matrix of the barycentric
+    coordinates of each point in its triangle. Among the hits for a point, the triangle in which
+    the point lies most deeply is chosen.
+    '''
+    ids = np.full(npts, -1, dtype=np.int64)
+    res = np.zeros((npts, 3))
+    if not np.any(hit): return (ids, res)
+    (pt_ids, tri_ids, bc) = (pt_ids[hit], tri_ids[hit], bc[hit])
+    score = np.min(bc, axis=1)
+    order = np.lexsort((-score, pt_ids))
+    pt_ids = pt_ids[order]
+    first = np.ones(len(pt_ids), dtype=bool)
+    first[1:] = pt_ids[1:] != pt_ids[:-1]
+    order = order[first]
+    pt_ids = pt_ids[first]
+    ids[pt_ids] = tri_ids[order]
+    res[pt_ids] = bc[order]
+    return (ids, res)
+
+def _ray_barycentric(origin, D, tx):
+    '''
+    _ray_barycentric(origin, D, tx) yields a tuple (bc, s, ok) for the rays starting at the given
+    origin and pointing in the directions given by the rows of the (n x 3) matrix D and the n
+    triangles in the (n x 3 x 3) array tx (triangle, vertex, coordinate): bc is the (n x 3) matrix
+    of barycentric coordinates of the intersection of each ray with the plane of its triangle, s is
+    the distance along the ray (in units of D) of the intersection, and ok is False for rays that
+    are parallel to their triangle's plane. The Moller-Trumbore algorithm is used.
+    '''
+    e1 = tx[:,1] - tx[:,0]
+    e2 = tx[:,2] - tx[:,0]
+    p = np.cross(D, e2)
+    det = np.sum(e1 * p, axis=1)
+    ok = np.abs(det) > 0
+    det[~ok] = 1
+    t = origin - tx[:,0]
+    u = np.sum(t * p, axis=1) / det
+    q = np.cross(t, e1)
+    v = np.sum(D * q, axis=1) / det
+    s = np.sum(e2 * q, axis=1) / det
+    return (np.transpose([1.0 - u - v, u, v]), s, ok)
+
+class _TriangleIndex(object):
+    '''
+    _TriangleIndex is the base class of the triangle indices; subclasses must provide the members
+    dims, chunk_size, and _locate_chunk(points, tolerance).
+    '''
+    def locate(self, points, tolerance=1e-9):
+        '''
+        index.locate(X) yields a tuple (ids, bc) in which ids is a vector of the ids of the
+        triangles that contain the points in the (n x d) matrix X and bc is an (n x 3) matrix of
+        the barycentric coordinates of each point in its triangle. Points that are not contained by
+        any triangle are given an id of -1 and barycentric coordinates of 0.
+        '''
+        P = np.asarray(points, dtype=np.float64)
+        if len(P.shape) == 1:
+            (ids, bc) = self.locate([P], tolerance=tolerance)
+            return (ids[0], bc[0])
+        if P.shape[1] != self.dims: P = P.T
+        n = P.shape[0]
+        if n <= self.chunk_size: return self._locate_chunk(P, tolerance)
+        ids = np.empty(n, dtype=np.int64)
+        bc = np.empty((n, 3))
+        for k in range(0, n, self.chunk_size):
+            (ids[k:k+self.chunk_size], bc[k:k+self.chunk_size]) = self._locate_chunk(
+                P[k:k+self.chunk_size], tolerance)
+        return (ids, bc)
+
+class SphericalTriangleIndex(_TriangleIndex):
+    '''
+    SphericalTriangleIndex(triangles, coordinates) yields an index over the triangles of the
+    spherical mesh given by the (n x 3) triangle matrix and the (m x 3) coordinate matrix. The
+    index bins the triangles by their direction from the center of the sphere into the cells of a
+    cube-map (each face of a cube surrounding the sphere is divided into an N x N grid, and each
+    direction is assigned to the cell its ray passes through). Points are located by intersecting
+    the ray from the sphere's center through each point with the candidate triangles of its cell.
+
+    The following options are accepted:
+      * center (default: None) specifies the center of the sphere; if None, then the mean of the
+        coordinates is used.
+      * resolution (default: None) specifies the number N of cells along each edge of each cube
+        face; if None, a value is chosen such that there are about 2 triangles per cell.
+      * chunk_size (default: 65536) specifies the maximum number of points that are tested at once
+        when locating points; this bounds the memory used by the vectorized tests.
+    '''
+
+    # The (axis, sign) pairs of the 6 cube faces and the two in-plane axes of each
+    _faces = ((0, 1.0, 1, 2), (0, -1.0, 1, 2),
+              (1, 1.0, 2, 0), (1, -1.0, 2, 0),
+              (2, 1.0, 0, 1), (2, -1.0, 0, 1))
+
+    @staticmethod
+    def is_spherical(coordinates, tolerance=0.01):
+        '''
+        SphericalTriangleIndex.is_spherical(X) yields True if the points in the (n x 3) coordinate
+        matrix X all lie close to a sphere centered at their mean; the relative standard deviation
+        of their radii must be smaller than the given tolerance (default: 0.01).
+        '''
+        X = np.asarray(coordinates)
+        if len(X.shape) != 2 or X.shape[1] != 3 or X.shape[0] < 4: return False
+        r = np.sqrt(np.sum((X - np.mean(X, axis=0))**2, axis=1))
+        mu = np.mean(r)
+        return bool(mu > 0 and np.std(r) < tolerance * mu)
+
+    def __init__(self, triangles, coordinates, center=None, resolution=None, chunk_size=65536):
+        X = np.asarray(coordinates, dtype=np.float64)
+        T = np.asarray(triangles, dtype=np.int64)
+        if X.shape[1] != 3: X = X.T
+        if T.shape[1] != 3: T = T.T
+        self.center = np.mean(X, axis=0) if center is None else np.asarray(center, dtype=np.float64)
+        self.coordinates = X
+        self.triangles = T
+        self.dims = 3
+        self.chunk_size = int(chunk_size)
+        if resolution is None:
+            resolution = max(1, int(np.ceil(np.sqrt(T.shape[0] / 12.0))))
+        self.resolution = int(resolution)
+        N = self.resolution
+        # the directions of each vertex from the center
+        U = X - self.center
+        # for each face of the cube, insert the triangles that can reach it
+        (owners, i0s, i1s, j0s, j1s, offs) = ([], [], [], [], [], [])
+        for (f, (ax, sgn, bx, cx)) in enumerate(SphericalTriangleIndex._faces):
+            h = sgn * U[:, ax]
+            ht = h[T]
+            allpos = np.all(ht > 0, axis=1)
+            # triangles with all vertices in front of the face are projected gnomonically; the
+            # projection of a triangle's cone is exactly the projected triangle
+            tids = np.where(allpos)[0]
+            if len(tids) > 0:
+                a = (U[:, bx] / np.where(h > 0, h, 1))[T[tids]]
+                b = (U[:, cx] / np.where(h > 0, h, 1))[T[tids]]
+                i0s.append(self._cell_of(np.min(a, axis=1)))
+                i1s.append(self._cell_of(np.max(a, axis=1)))
+                j0s.append(self._cell_of(np.min(b, axis=1)))
+                j1s.append(self._cell_of(np.max(b, axis=1)))
+                owners.append(tids)
+                offs.append(np.full(len(tids), f*N*N, dtype=np.int64))
+            # any other triangle with a vertex inside this face's region is large relative to the
+            # cube-map, so we conservatively place it in every cell of the face
+            inface = (h > 0) & (h >= np.abs(U[:, bx])) & (h >= np.abs(U[:, cx]))
+            tids = np.where(~allpos & np.any(inface[T], axis=1))[0]
+            if len(tids) > 0:
+                z = np.zeros(len(tids), dtype=np.int64)
+                i0s.append(z)
+                i1s.append(z + N - 1)
+                j0s.append(z)
+                j1s.append(z + N - 1)
+                owners.append(tids)
+                offs.append(np.full(len(tids), f*N*N, dtype=np.int64))
+        (self.indptr, self.indices) = _cell_ranges_to_bins(
+            np.concatenate(owners), np.concatenate(i0s), np.concatenate(i1s),
+            np.concatenate(j0s), np.concatenate(j1s), N, np.concatenate(offs), 6*N*N)
+
+    def _cell_of(self, u):
+        N = self.resolution
+        u = np.clip(u, -1.0, 1.0)
+        return np.clip(np.floor((u + 1.0) * 0.5 * N).astype(np.int64), 0, N - 1)
+
+    def _cells(self, D):
+        # find the cube face and the cell of each direction in the (n x 3) matrix D
+        N = self.resolution
+        A = np.abs(D)
+        ax = np.argmax(A, axis=1)
+        idx = np.arange(D.shape[0])
+        h = D[idx, ax]
+        f = 2*ax + (h < 0)
+        bx = (ax + 1) % 3
+        cx = (ax + 2) % 3
+        h = np.abs(h)
+        h[h == 0] = 1
+        i = self._cell_of(D[idx, bx] / h)
+        j = self._cell_of(D[idx, cx] / h)
+        return f*N*N + i*N + j
+
+    def _locate_chunk(self, P, tolerance):
+        D = P - self.center
+        ok = np.any(D != 0, axis=1)
+        (pt_ids, tri_ids) = _bin_candidates(self.indptr, self.indices, self._cells(D))
+        keep = ok[pt_ids]
+        (pt_ids, tri_ids) = (pt_ids[keep], tri_ids[keep])
+        # intersect the ray from the center toward each point with its candidates
+        tx = self.coordinates[self.triangles[tri_ids]]
+        (bc, s, good) = _ray_barycentric(self.center, D[pt_ids], tx)
+        hit = good & (s > 0) & np.all(bc >= -tolerance, axis=1)
+        return _best_candidates(P.shape[0], pt_ids, tri_ids, bc, hit)
+
+class PlanarTriangleIndex(_TriangleIndex):
+    '''
+    PlanarTriangleIndex(triangles, coordinates) yields an index over the triangles of the 2D mesh
+    given by the (n x 3) triangle matrix and the (m x 2) coordinate matrix. The index divides the
+    bounding box of the triangles into a uniform grid and lists, for each grid cell, the triangles
+    whose bounding boxes overlap it. Points are located by looking up their cell and testing the
+    barycentric coordinates of each of the cell's candidate triangles.
+
+    The following options are accepted:
+      * resolution (default: None) specifies the (rows, columns) of the grid, or a single number
+        for both; if None, a grid with about 1 cell per 2 triangles is chosen that matches the
+        aspect ratio of the bounding box.
+      * chunk_size (default: 65536) specifies the maximum number of points that are tested at once
+        when locating points; this bounds the memory used by the vectorized tests.
+    '''
+
+    def __init__(self, triangles, coordinates, resolution=None, chunk_size=65536):
+        X = np.asarray(coordinates, dtype=np.float64)
+        T = np.asarray(triangles, dtype=np.int64)
+        if X.shape[1] != 2: X = X.T
+        if T.shape[1] != 3: T = T.T
+        self.coordinates = X
+        self.triangles = T
+        self.dims = 2
+        self.chunk_size = int(chunk_size)
+        # the grid only needs to cover the vertices actually used by triangles
+        used = X[np.unique(T)] if T.shape[0] > 0 else np.zeros((1,2))
+        self.lower = np.min(used, axis=0)
+        self.upper = np.max(used, axis=0)
+        ext = self.upper - self.lower
+        ext[ext <= 0] = 1
+        if resolution is None:
+            ncells = max(1.0, T.shape[0] / 2.0)
+            nx = max(1, int(np.ceil(np.sqrt(ncells * ext[0] / ext[1]))))
+            ny = max(1, int(np.ceil(ncells / nx)))
+            resolution = (nx, ny)
+        elif not hasattr(resolution, '__iter__'):
+            resolution = (resolution, resolution)
+        self.resolution = tuple(int(r) for r in resolution)
+        self.cell_size = ext / self.resolution
+        (nx, ny) = self.resolution
+        tx = X[T]
+        (i0, j0) = self._cells_of(np.min(tx, axis=1))
+        (i1, j1) = self._cells_of(np.max(tx, axis=1))
+        (self.indptr, self.indices) = _cell_ranges_to_bins(
+            np.arange(T.shape[0]), i0, i1, j0, j1, ny, np.zeros(T.shape[0], dtype=np.int64),
+            nx*ny)
+
+    def _cells_of(self, P):
+        ij = np.floor((P - self.lower) / self.cell_size)
+        ij = np.clip(ij, -1, np.asarray(self.resolution)).astype(np.int64)
+        return (np.clip(ij[:,0], 0, self.resolution[0] - 1),
+                np.clip(ij[:,1], 0, self.resolution[1] - 1))
+
+    def _locate_chunk(self, P, tolerance):
+        ok = np.all((P >= self.lower) & (P <= self.upper), axis=1)
+        (i, j) = self._cells_of(P)
+        (pt_ids, tri_ids) = _bin_candidates(self.indptr, self.indices, i*self.resolution[1] + j)
+        keep = ok[pt_ids]
+        (pt_ids, tri_ids) = (pt_ids[keep], tri_ids[keep])
+        tx = self.coordinates[self.triangles[tri_ids]]
+        e1 = tx[:,1] - tx[:,0]
+        e2 = tx[:,2] - tx[:,0]
+        d = P[pt_ids] - tx[:,0]
+        det = e1[:,0]*e2[:,1] - e1[:,1]*e2[:,0]
+        good = det != 0
+        det[~good] = 1
+        u = (d[:,0]*e2[:,1] - d[:,1]*e2[:,0]) / det
+        v = (e1[:,0]*d[:,1] - e1[:,1]*d[:,0]) / det
+        bc = np.transpose([1.0 - u - v, u, v])
+        hit = good & np.all(bc >= -tolerance, axis=1)
+        return _best_candidates(P.shape[0], pt_ids, tri_ids, bc, hit)
@@ -6,6 +6,7 @@
 import numpy as np
 import scipy as sp
 import scipy.spatial as space
+import scipy.sparse as sps
 import os, math
 from pysistence import make_dict
 from numpy.linalg import norm
@@ -13,7 +14,149 @@ from numpy.linalg import norm
 from neuropythy.immutable import Immutable
 from .util import (triangle_area, triangle_address, alignment_matrix_3D,
                    cartesian_to_barycentric_3D, cartesian_to_barycentric_2D,
-                   barycentric_to_cartesian, point_in_triangle)
+                   barycentric_to_cartesian, point_in_triangle, kdtree_query)
+from .locator import (SphericalTriangleIndex, PlanarTriangleIndex, _ray_barycentric)
+
+def apply_interpolation_matrix(M, data, mask=None, null=None):
+    '''
+    apply_interpolation_matrix(M, data) yields the result of interpolating the given data using the
+    (n x m) interpolation matrix M, as yielded by mesh.point_interpolation_matrix(x). The data may
+    be a vector of m values or an (m x k) or (k x m) matrix of k properties, in which case the
+    result is an (n x k) or (k x n) matrix. The options mask and null are handled as in
+    mesh.interpolate: the columns of M that are not in the mask are cleared and the rows are
+    renormalized; rows with no remaining weight yield the null value. If every row of M contains a
+    single weight of 1 (as for nearest-neighbor interpolation), the values are copied rather than
+    multiplied, so the data needn't be numerical.
+    '''
+    data = np.asarray(data)
+    (n, m) = M.shape
+    data_t = (data.shape[0] != m)
+    if data_t: data = data.T
+    if data.shape[0] != m:
+        raise ValueError('data does not match the number of vertices in the interpolation matrix')
+    M = sps.csr_matrix(M)
+    if mask is not None:
+        mask = np.asarray(mask)
+        keep = (mask == 1) if mask.dtype != np.bool_ else mask
+        M = M.dot(sps.diags(keep.astype(np.float64)))
+        M.eliminate_zeros()
+        tot = np.asarray(M.sum(axis=1)).flatten()
+        tot[tot == 0] = 1
+        M = sps.diags(1.0 / tot).dot(M).tocsr()
+    counts = np.diff(M.indptr)
+    empty = (counts == 0)
+    if np.all(counts <= 1) and np.all(M.data == 1):
+        # a simple lookup; this preserves the type of the data
+        cols = np.zeros(n, dtype=np.int64)
+        cols[~empty] = M.indices[M.indptr[:-1][~empty]]
+        res = data[cols]
+    else:
+        res = np.asarray(M.dot(data))
+    if np.any(empty):
+        if null is None or (not isinstance(null, (int, long, float, complex)) and
+                            res.dtype != np.object_):
+            res = res.astype(np.object_)
+        elif isinstance(null, float) and not np.issubdtype(res.dtype, np.inexact):
+            res = res.astype(np.float64)
+        res[empty] = null
+    return res.T if data_t else res
+
+def interpolate_in_chunks(n, chunk_size, transposed, fn):
+    '''
+    interpolate_in_chunks(n, chunk_size, transposed, fn) yields the result of interpolating data
+    onto n points chunk_size points at a time: fn(s) must yield the result of the interpolation for
+    the points in the slice s, and these results are written into a preallocated output array.
+    If transposed is True, the points are the columns (rather than the rows) of the results.
+    '''
+    chunk_size = int(chunk_size)
+    if chunk_size < 1: raise ValueError('chunk_size must be positive')
+    axis = 1 if transposed else 0
+    res = None
+    for start in range(0, max(n, 1), chunk_size):
+        ii = slice(start, min(start + chunk_size, n))
+        r = np.asarray(fn(ii))
+        if res is None:
+            shape = list(r.shape)
+            shape[axis] = n
+            res = np.empty(shape, dtype=r.dtype)
+        elif r.dtype != res.dtype:
+            # e.g., a later chunk contains null values that require an object array
+            res = res.astype(np.result_type(res.dtype, r.dtype))
+        if transposed: res[:, ii] = r
+        else:          res[ii] = r
+    return res
+
+# The dtype of compact address arrays: the id of the containing face and the first two barycentric
+# coordinates of the point in that face
+address_dtype = np.dtype([('face_id', np.int32), ('coordinates', np.float32, (2,))])
+
+def compact_address(addr):
+    '''
+    compact_address(addr) yields a numpy structured array (whose dtype is geometry.address_dtype)
+    that is equivalent to the given address dictionary addr, as yielded by mesh.address(X). Each
+    element of the array contains an int32 field face_id and a float32 field coordinates of the
+    first two barycentric coordinates. Compact addresses can be saved and reloaded with np.save and
+    np.load and may be passed directly to mesh.unaddress. See also expand_address.
+    '''
+    if isinstance(addr, np.ndarray) and addr.dtype.names is not None: return addr
+    (face_id, coords) = _address_data(addr)
+    if len(face_id.shape) == 0:
+        res = np.zeros((), dtype=address_dtype)
+        res['face_id'] = face_id
+        res['coordinates'] = coords
+        return res
+    res = np.empty(len(face_id), dtype=address_dtype)
+    res['face_id'] = face_id
+    res['coordinates'] = coords.T
+    return res
+
+def expand_address(addr):
+    '''
+    expand_address(addr) yields the address dictionary equivalent to the given compact address
+    array addr; this is the inverse of compact_address.
+    '''
+    if isinstance(addr, dict): return addr
+    addr = np.asarray(addr)
+    if addr.dtype.names is None or 'face_id' not in addr.dtype.names:
+        raise ValueError('compact address must be a structured array with a face_id field')
+    if len(addr.shape) == 0:
+        return {'face_id': int(addr['face_id']),
+                'coordinates': np.asarray(addr['coordinates'], dtype=np.float64)}
+    return {'face_id': np.asarray(addr['face_id'], dtype=np.int64),
+            'coordinates': np.asarray(addr['coordinates'], dtype=np.float64).T}
+
+def _address_data(addr):
+    # yields (face_id, coordinates) for an address dictionary or compact address array; for many
+    # points, face_id is an integer vector and coordinates is a (2 x n) matrix
+    if isinstance(addr, np.ndarray) and addr.dtype.names is not None:
+        addr = expand_address(addr)
+    if not isinstance(addr, dict):
+        raise ValueError('address data must be a dictionary')
+    if 'face_id' not in addr: raise ValueError('address must contain face_id')
+    if 'coordinates' not in addr: raise ValueError('address must contain coordinates')
+    face_id = addr['face_id']
+    face_id = np.asarray([-1 if f is None else f for f in face_id] if isinstance(face_id, list)
+                         else face_id)
+    coords = np.asarray(addr['coordinates'], dtype=np.float64)
+    if len(face_id.shape) == 0: return (face_id.astype(np.int64), coords)
+    face_id = face_id.astype(np.int64)
+    if len(coords.shape) != 2:
+        raise ValueError('if face_id is a list, then coordinates must be a matrix')
+    if coords.shape[0] != 2: coords = coords.T
+    if coords.shape[1] != len(face_id):
+        raise ValueError('address face_id and coordinates are not the same length')
+    return (face_id, coords)
+
+def _unaddress_data(X, T, face_id, coords):
+    # yields the (n x dims) points at the given faces (-1 for none) and (2 x n) barycentric
+    # coordinates in the mesh with the (m x dims) coordinates X and the (k x 3) triangles T
+    found = (face_id >= 0)
+    res = np.full((len(face_id), X.shape[1]), np.nan)
+    tx = X[T[face_id[found]]]
+    (l1, l2) = coords[:, found]
+    res[found] = (tx[:,0] * l1[:,None] + tx[:,1] * l2[:,None] +
+                  tx[:,2] * (1.0 - l1 - l2)[:,None])
+    return res
 
 class Mesh(Immutable):
     '''
@@ -30,19 +173,29 @@ class Mesh(Immutable):
 
     @staticmethod
     def __calculate_triangle_normals(triangles, coords):
-        coords = np.asarray(coords)
-        coords = coords if coords.shape[0] < coords.shape[1] else coords.T
-        triangles = np.asarray(triangles)
-        triangles = triangles if triangles.shape[0] < triangles.shape[1] else triangles.T
+        # these are always given as (n x dims) and (n x 3) by the lazy member triangle_normals
+        coords = np.asarray(coords).T
+        triangles = np.asarray(triangles).T
+        # 2D meshes lie in the z=0 plane
+        if coords.shape[0] == 2: coords = np.vstack((coords, np.zeros(coords.shape[1])))
         tmp = coords[:, triangles[0]]
         u01 = coords[:, triangles[1]] - tmp
         u02 = coords[:, triangles[2]] - tmp
         xp = np.cross(u01, u02, axisa=0, axisb=0)
         xpnorms = np.sqrt(np.sum(xp**2, axis=1))
         zero = np.isclose(xpnorms, 0)
-        zero_idcs = np.where(zero)
-        xp[zeros_idcs,:] = 0
-        return xp / (xpnorms + zero)
+        xp[zero,:] = 0
+        return xp / (xpnorms + zero)[:,None]
+
+    @staticmethod
+    def __calculate_point_index(triangles, coords):
+        # 2D meshes get a uniform-grid index and spherical meshes (e.g., registrations) get a
+        # direction-binned index; others use the cKDTree search over triangle centers
+        if coords.shape[1] == 2:
+            return PlanarTriangleIndex(triangles, coords)
+        elif coords.shape[1] == 3 and SphericalTriangleIndex.is_spherical(coords):
+            return SphericalTriangleIndex(triangles, coords)
+        return None
         
     
     def __init__(self, triangles, coordinates):
@@ -54,9 +207,11 @@ class Mesh(Immutable):
             {'coordinates': coordinates.T, 'triangles': triangles.T},
             {'triangle_centers': (('triangles','coordinates'),
                                   lambda t,x: Mesh.__calculate_triangle_centers(t, x)),
-             'triangle_normals': (('triangle','coordinates'),
+             'triangle_normals': (('triangles','coordinates'),
                                   lambda t,x: Mesh.__calculate_triangle_normals(t, x)),
              'triangle_hash':    (('triangle_centers',), lambda x: space.cKDTree(x)),
+             'point_index':      (('triangles','coordinates'),
+                                  lambda t,x: Mesh.__calculate_point_index(t, x)),
              'vertex_hash':      (('coordinates',), lambda x: space.cKDTree(x))})
     def __repr__(self):
         return 'Mesh(<%d triangles>, <%d vertices>)' % (self.triangles.shape[0],
@@ -73,81 +228,120 @@ class Mesh(Immutable):
         # gradually increase until we find the container triangle; if k passes the max, then
         # we give up and assume no triangle is the container
         if k >= 288: return None
-        (d,near) = self.triangle_hash.query(x, k=k)
+        (d,near) = kdtree_query(self.triangle_hash, x, k=k)
         near = [n for n in near if n not in searched]
         searched = searched.union(near)
         tri_no = next((kk for kk in near if self._point_in_triangle(kk, x)), None)
         return (tri_no if tri_no is not None
                 else self._find_triangle_search(x, k=(2*k), searched=searched))
     
-    def nearest_vertex(self, pt):
+    def nearest_vertex(self, pt, n_jobs=None):
         '''
         mesh.nearest_vertex(pt) yields the id number of the nearest vertex in the given
         mesh to the given point pt. If pt is an (n x dims) matrix of points, an id is given
         for each column of pt.
         '''
-        (d,near) = self.vertex_hash.query(pt, k=1)
+        (d,near) = kdtree_query(self.vertex_hash, pt, k=1, n_jobs=n_jobs)
         return near
 
     def point_in_plane(self, tri_no, pt):
         '''
         r.point_in_plane(id, pt) yields the distance from the plane of the id'th triangle in the
-        registration r to the given pt and the point in that plane as a tuple (d, x).
+        registration r to the given pt and the point in that plane as a tuple (d, x). If id is a
+        vector of n triangle ids and pt is an (n x 3) matrix of points, then d is a vector and x is
+        an (n x 3) matrix of the projections of each point onto the plane of its triangle.
         '''
-        tx = self.coordinates[self.triangles[tri_no]]
-        n = np.cross(tx[1] - tx[0], tx[2] - tx[0])
-        n /= norm(n)
-        d = np.dot(n, pt - tx[0])
-        return (abs(d), pt - n*d)
+        tri_no = np.asarray(tri_no)
+        pt = np.asarray(pt, dtype=np.float64)
+        n = self.triangle_normals[tri_no]
+        d = np.sum(n * (pt - self.coordinates[self.triangles[tri_no, 0]]), axis=-1)
+        return (np.abs(d), pt - n * d[...,None])
     
-    def nearest_data(self, pt, k=2, n_jobs=1):
+    def nearest_data(self, pt, k=2, n_jobs=None):
         '''
         mesh.nearest_data(pt) yields a tuple (k, d, x) of the matrix x containing the point(s)
         nearest the given point(s) pt that is/are in the mesh; a vector d if the distances between
         the point(s) pt and x; and k, the face index/indices of the triangles containing the 
-        point(s) in x.
+        point(s) in x. Points that are not contained by any triangle are given a face index of -1
+        and a distance and nearest point of nan.
         Note that this function and those of this class are made for spherical meshes and are not
         intended to work with other kinds of complex topologies; though they might work 
         heuristically.
         '''
-        pt = np.asarray(pt, dtype=np.float32)
+        pt = np.asarray(pt, dtype=np.float64)
         if len(pt.shape) == 1:
-            r = self.nearest_data([pt], k=k, n_jobs=n_jobs)[0];
+            r = self.nearest_data([pt], k=k, n_jobs=n_jobs)
             return (r[0][0], r[1][0], r[2][0])
-        pt = pt if pt.shape[1] == 3 else pt.T
-        (d, near) = self.triangle_hash.query(pt, k=k)
-        ids = [tri_no if tri_no is not None else self._find_triangle_search(x, 2*k, set(near_i))
-               for (x, near_i) in zip(pt, near)
-               for tri_no in [next((k for k in near_i if self._point_in_triangle(k, x)), None)]]
-        pips = [self.point_in_plane(i, p) if i is not None else (0, None)
-                for (i,p) in zip(ids, pt)]
-        return (np.asarray(ids),
-                np.asarray([d[0] for d in pips]),
-                np.asarray([d[1] for d in pips]))
+        dims = self.coordinates.shape[1]
+        pt = pt if pt.shape[1] == dims else pt.T
+        ids = self._container_ids(pt, k=k, n_jobs=n_jobs)
+        found = (ids >= 0)
+        d = np.full(pt.shape[0], np.nan)
+        x = np.full(pt.shape, np.nan)
+        if dims == 2:
+            # points in a 2D mesh are in the plane of their triangles
+            d[found] = 0
+            x[found] = pt[found]
+        else:
+            (d[found], x[found]) = self.point_in_plane(ids[found], pt[found])
+        return (ids, d, x)
 
-    def nearest(self, pt, k=2, n_jobs=1):
+    def nearest(self, pt, k=2, n_jobs=None):
         '''
         mesh.nearest(pt) yields the point in the given mesh nearest the given array of points pts.
         '''
-        dat = self.nearest_data(pt)
+        dat = self.nearest_data(pt, k=k, n_jobs=n_jobs)
         return dat[2]
 
-    def distance(self, pt, k=2, n_jobs=1):
+    def distance(self, pt, k=2, n_jobs=None):
         '''
         mesh.distance(pt) yields the distance to the nearest point in the given mesh from the points
         in the given matrix pt.
         '''
-        dat = self.nearest_data(pt)
+        dat = self.nearest_data(pt, k=k, n_jobs=n_jobs)
         return dat[1]
 
-    def container(self, pt, k=2, n_jobs=1):
+    def container(self, pt, k=2, n_jobs=None):
         '''
         mesh.container(pt) yields the id number of the nearest triangle in the given
         mesh to the given point pt. If pt is an (n x dims) matrix of points, an id is given
         for each column of pt.
         '''
+        ids = self._container_ids(pt, k=k, n_jobs=n_jobs)
+        if len(ids.shape) == 0:
+            return None if ids < 0 else int(ids)
+        else:
+            return [None if i < 0 else i for i in ids.tolist()]
+
+    def _container_ids(self, pt, k=2, n_jobs=None):
+        '''
+        mesh._container_ids(pt) is identical to mesh.container(pt) except that it always yields a
+        numpy array (or a single integer if pt is a vector) in which the value -1 indicates that no
+        containing triangle was found.
+        '''
+        pt = np.asarray(pt)
+        if self.point_index is None:
+            res = self._container_search(pt, k=k, n_jobs=n_jobs)
+            return (np.asarray(-1 if res is None else res) if len(pt.shape) == 1 else
+                    np.asarray([-1 if r is None else r for r in res], dtype=np.int64))
+        ids = np.array(self.point_index.locate(pt)[0])
+        # the 2D grid is exhaustive, but on a sphere anything the index missed gets the search
+        if self.coordinates.shape[1] == 2:
+            return ids
+        elif len(ids.shape) == 0:
+            if ids < 0: ids = self._container_ids(pt[None,:], k=k, n_jobs=n_jobs)[0]
+            return ids
+        miss = np.where(ids < 0)[0]
+        if len(miss) > 0:
+            pts = pt if pt.shape[1] == 3 else pt.T
+            res = self._container_search(pts[miss], k=k, n_jobs=n_jobs)
+            ids[miss] = [-1 if r is None else r for r in res]
+        return ids
+
+    def _container_search(self, pt, k=2, n_jobs=None):
+        # the generic container search using the nearest k triangle centers
         pt = np.asarray(pt, dtype=np.float32)
-        (d, near) = self.triangle_hash.query(pt, k=k) #n_jobs fails?
+        (d, near) = kdtree_query(self.triangle_hash, pt, k=k, n_jobs=n_jobs)
         if len(pt.shape) == 1:
             tri_no = next((kk for kk in near if self._point_in_triangle(kk, pt)), None)
             return (tri_no if tri_no is not None
@@ -160,8 +354,8 @@ class Mesh(Immutable):
                                         None)]]
 
     def interpolate(self, x, data, 
-                    smoothing=1, mask=None, null=None, method='automatic', n_jobs=1,
-                    container_ids=None):
+                    smoothing=1, mask=None, null=None, method='automatic', n_jobs=None,
+                    container_ids=None, chunk_size=None):
         '''
         mesh.interpolate(x, data) yields a numpy array of the data interpolated from the given
         array, data, which must contain the same number of elements as there are points in the Mesh
@@ -170,8 +364,9 @@ class Mesh(Immutable):
         
         The following options are accepted:
           * mask (default: None) indicates that the given True/False or 0/1 valued list/array should
-            be used; any point whose nearest neighbor (see below) is in the given mask will, instead
-            of an interpolated value, be set to the null value (see null option).
+            be used; any vertex of the mesh that is not in the mask is dropped from the
+            interpolation, and the weights of the remaining vertices are renormalized; points that
+            are left with no vertices to interpolate from are set to the null value.
           * null (default: None) indicates the value that should be placed in the returned result if
             either a vertex does not lie in any triangle or a vertex is masked out via the mask
             option.
@@ -180,127 +375,158 @@ class Mesh(Immutable):
             while 2 represents a slightly smoother version of this. Note that this is not an order
             of interpolation option.
           * method (default: 'automatic') specifies what method to use for interpolation. The only
-            currently supported methods are 'automatic' or 'nearest'. The 'nearest' method does not
-            actually perform a nearest-neighbor interpolation but rather assigns to a destination
-            vertex the value of the source vertex whose veronoi-like polygon contains the
-            destination vertex; note that the term 'veronoi-like' is used here because it uses the
-            Voronoi diagram that corresponds to the triangle mesh and not the true delaunay
-            triangulation. The 'automatic' checks every destination vertex and assigns it the
-            'nearest' value if that value would not be a number, otherwise it interpolates linearly
-            within the vertex's source triangle.
-          * n_jobs (default: 1) is passed along to the cKDTree.query method, so may be set to an
-            integer to specify how many processors to use, or may be -1 to specify all processors.
+            currently supported methods are 'automatic' (or 'linear') or 'nearest'. The 'nearest'
+            method assigns to each destination point the value of the nearest vertex of the
+            triangle that contains it (or of the nearest vertex in the mesh, if no triangle
+            contains it). The 'automatic' method interpolates linearly within the point's source
+            triangle.
+          * n_jobs (default: None) is passed along to the cKDTree.query method, so may be set to an
+            integer to specify how many processors to use, or may be -1 to specify all processors;
+            None uses the library-wide default (see neuropythy.geometry.set_kdtree_workers).
+          * chunk_size (default: None) may specify that the points x be located and interpolated
+            at most chunk_size points at a time; the results are written into a preallocated
+            output array, so the memory used beyond the result itself does not depend on the
+            number of points in x.
         '''
         x = np.asarray(x)
         if len(x.shape) == 2:
             x = x if x.shape[1] == 2 or x.shape[1] == 3 else x.T
-            sz = 2
             dims = x.shape[1]
         elif len(x.shape) == 1:
-            sz = 1
             dims = x.shape[0]
             x = np.asarray([x])
         else:
             raise ValueError('interpolation points must be a matrix or vector')
         if dims != self.coordinates.shape[1]:
             raise ValueError('interpolation points have wrong dimensionality for mesh')
+        if chunk_size is None:
+            M = self.point_interpolation_matrix(x, method=method, smoothing=smoothing,
+                                                n_jobs=n_jobs)
+            return apply_interpolation_matrix(M, data, mask=mask, null=null)
         data = np.asarray(data)
-        data_t = (data.shape[0] != self.coordinates.shape[0])
-        if data_t: data = data.T
-        # Okay, switch on method:
+        return interpolate_in_chunks(
+            x.shape[0], chunk_size, data.shape[0] != self.coordinates.shape[0],
+            lambda ii: apply_interpolation_matrix(
+                self.point_interpolation_matrix(x[ii], method=method, smoothing=smoothing,
+                                                n_jobs=n_jobs),
+                data, mask=mask, null=null))
+
+    def point_interpolation_matrix(self, x, method='automatic', smoothing=1, n_jobs=None,
+                                   location=None):
+        '''
+        mesh.point_interpolation_matrix(x) yields a scipy.sparse.csr_matrix M of size (n x m) where
+        n is the number of points in the (n x dims) matrix x and m is the number of vertices in mesh
+        such that M.dot(data) interpolates the vertex data onto the points x. Rows of M that
+        correspond to points that are not in the mesh are empty. See mesh.interpolate for a
+        description of the method and smoothing options; see also apply_interpolation_matrix.
+        The option location may give the result of mesh.point_location(x), in which case the points
+        are not located again; this allows several matrices to share one point-location pass.
+        '''
+        x = np.asarray(x)
+        x = x if x.shape[1] == self.coordinates.shape[1] else x.T
+        n = x.shape[0]
+        m = self.coordinates.shape[0]
+        if method != 'automatic' and method != 'linear' and method != 'nearest':
+            raise ValueError('unrecognized interpolation method: %s' % method)
+        (ids, bc) = self.point_location(x, n_jobs=n_jobs) if location is None else location
         if method == 'nearest':
-            data = self._interpolate_nearest(x, data, mask, null, n_jobs)
-        elif method == 'automatic':
-            data = self._interpolate_linear(x, data, mask, null, smoothing, 12, n_jobs)
-        data = np.asarray(data)
-        return data.T if data_t else data
+            # the nearest vertex of the containing triangle, or of the mesh for points outside it
+            nei = np.empty(n, dtype=np.int64)
+            found = (ids >= 0)
+            if np.any(found):
+                tris = self.triangles[ids[found]]
+                d2 = np.sum((self.coordinates[tris] - x[found][:,None,:])**2, axis=2)
+                nei[found] = tris[np.arange(tris.shape[0]), np.argmin(d2, axis=1)]
+            if not np.all(found):
+                nei[~found] = kdtree_query(self.vertex_hash, x[~found], k=1, n_jobs=n_jobs)[1]
+            return sps.csr_matrix((np.ones(n), (np.arange(n), nei)), shape=(n, m))
+        # the weights are the areas of the sub-triangles opposite each vertex, raised to the power
+        # of the smoothing parameter; these areas are proportional to the barycentric coordinates
+        wgt = np.clip(bc, 0, None) ** smoothing
+        tot = np.sum(wgt, axis=1)
+        ok = (ids >= 0) & ~np.isclose(tot, 0)
+        rows = np.where(ok)[0]
+        wgt = wgt[rows] / tot[rows, None]
+        cols = self.triangles[ids[rows]].flatten()
+        M = sps.csr_matrix((wgt.flatten(), (np.repeat(rows, 3), cols)), shape=(n, m))
+        M.eliminate_zeros()
+        return M
 
-    # perform nearest-neighbor interpolation
-    def _interpolate_nearest(self, x, data, mask, null, n_jobs):
-        # lookup the neighbors...
-        (d, nei) = self.vertex_hash.query(x, k=1) #n_jobs fails? version problem?
-        if mask is None:
-            return [data[i] for i in nei]
-        else:
-            return [data[i] if mask[i] == 1 else null for i in nei]
-    # perform linear interpolation
-    def _interpolate_linear(self, coords, data, mask, null, smoothing, check_no, n_jobs):
-        # first, find the triangle containing each point...
-        tris = self.triangles
-        ## we only query the nearest check_no triangles; otherwise we don't fine the container
-        containers = self.container(coords, k=check_no, n_jobs=n_jobs)
-        # Okay, now we interpolate for each triangle
-        nulls = [null for _ in range(data.shape[1])] if len(data.shape) > 1 else null
-        if mask is None:
-            return [(nulls if tri_no is None
-                     else self._interpolate_triangle(x, data, tris[tri_no], smoothing, nulls))
-                    for (x, tri_no) in zip(coords, containers)]
-        else:
-            return [(nulls if tri_no is None or any(mask[u] == 0 for u in tris[tri_no])
-                     else self._interpolate_triangle(x, data, tris[tri_no], smoothing, nulls))
-                    for (x, tri_no) in zip(coords, containers)]
-    def _interpolate_triangle(self, x, data, tri_vertices, smoothing, nulls):
-        # we'll want to project things down to 2 dimensions:
-        if len(x) == 3:
-            mtx = alignment_matrix_3D(x, [0,0,1])[0:2].T
-            # Project out what we don't want
-            corners = np.dot(self.coordinates[tri_vertices], mtx)
-            x = np.asarray([0,0])
-        else:
-            corners = self.coordinates[tri_vertices]
-        # get the mini-triangles' areas
-        a_area = triangle_area(x, corners[1], corners[2]) ** smoothing
-        b_area = triangle_area(x, corners[2], corners[0]) ** smoothing
-        c_area = triangle_area(x, corners[0], corners[1]) ** smoothing
-        tot = a_area + b_area + c_area
-        # and do the interpolation:
-        if np.isclose(tot, 0):
-            return nulls
+    def point_location(self, x, n_jobs=None):
+        '''
+        mesh.point_location(x) yields a tuple (ids, bc) in which ids is a vector of the ids of the
+        triangles that contain the points in the (n x dims) matrix x (or -1 for points not in the
+        mesh) and bc is the (n x 3) matrix of the barycentric coordinates of each point in its
+        triangle. In 3D, the barycentric coordinates are those of the intersection of the triangle
+        with the ray from the origin (or the sphere's center) through the point.
+        '''
+        x = np.asarray(x)
+        x = x if x.shape[1] == self.coordinates.shape[1] else x.T
+        if self.point_index is not None:
+            (ids, bc) = self.point_index.locate(x)
+            if self.coordinates.shape[1] == 2: return (ids, bc)
+            miss = np.where(ids < 0)[0]
         else:
-            if len(data.shape) == 1:
-                return np.dot([a_area, b_area, c_area], data[tri_vertices]) / tot
-            else:
-                return np.dot([[a_area, b_area, c_area]], data[tri_vertices])[0] / tot
+            ids = np.full(x.shape[0], -1, dtype=np.int64)
+            bc = np.zeros((x.shape[0], 3))
+            miss = np.arange(x.shape[0])
+        if len(miss) > 0:
+            # points not found by an index are located by search; in 3D, the barycentric
+            # coordinates are those of the intersection of the ray from the origin to the point
+            ids[miss] = self._container_ids(x[miss], k=12, n_jobs=n_jobs)
+            miss = miss[ids[miss] >= 0]
+            if len(miss) > 0:
+                tx = self.coordinates[self.triangles[ids[miss]]]
+                if self.coordinates.shape[1] == 3:
+                    bc[miss] = _ray_barycentric(np.zeros(3), x[miss], tx)[0]
+                else:
+                    bc[miss,0:2] = cartesian_to_barycentric_2D(tx, x[miss]).T
+                    bc[miss,2] = 1.0 - bc[miss,0] - bc[miss,1]
+        return (ids, bc)
 
-    def address(self, data):
+    def address(self, data, compact=False):
         '''
         mesh.address(X) yields a dictionary containing the address or addresses of the point or
         points given in the vector or coordinate matrix X. Addresses specify a single unique 
         topological location on the mesh such that deformations of the mesh will address the same
         points differently. To convert a point from one mesh to another isomorphic mesh, you can
         address the point in the first mesh then unaddress it in the second mesh.
+        The address of a matrix of n points has a face_id vector, in which points that are not in
+        the mesh have the id -1, and a (2 x n) matrix of the first two barycentric coordinates, in
+        which such points have nan values. If the optional argument compact is True, the addresses
+        are instead yielded as a compact structured array; see compact_address.
         '''
-        # we have to have a topology and registration for this to work...
-        data = np.asarray(data)
+        data = np.asarray(data, dtype=np.float64)
+        dims = self.coordinates.shape[1]
         if len(data.shape) == 1:
-            face_id = self.container(data)
-            if face_id is None: return None
+            face_id = int(self._container_ids(data))
+            if face_id < 0: return None
             tx = self.coordinates[self.triangles[face_id]]
-        else:
-            data = data if data.shape[1] == 3 or data.shape[1] == 2 else data.T
-            face_id = self.container(data)
-            faces = self.triangles[face_id]
-            tx = np.transpose(np.asarray([self.coordinates[f] for f in faces]), (0,1,2))
-        bc = cartesian_to_barycentric_3D(tx, data) if self.coordinates.shape[1] == 3 else \
-             cartesian_to_barycentric_2D(tx, data)
-        return {'face_id': face_id, 'coordinates': bc}
+            bc = cartesian_to_barycentric_3D(tx, data) if dims == 3 else \
+                 cartesian_to_barycentric_2D(tx, data)
+            addr = {'face_id': face_id, 'coordinates': bc}
+            return compact_address(addr) if compact else addr
+        data = data if data.shape[1] == dims else data.T
+        face_id = self._container_ids(data)
+        found = (face_id >= 0)
+        bc = np.full((2, data.shape[0]), np.nan)
+        # the triangle corners are gathered as a (3 x dims x n) array
+        tx = np.transpose(self.coordinates[self.triangles[face_id[found]]], (1,2,0))
+        bc[:, found] = cartesian_to_barycentric_3D(tx, data[found].T) if dims == 3 else \
+                       cartesian_to_barycentric_2D(tx, data[found].T)
+        addr = {'face_id': face_id, 'coordinates': bc}
+        return compact_address(addr) if compact else addr
 
     def unaddress(self, data):
         '''
         mesh.unaddress(A) yields a coordinate matrix that is the result of unaddressing the given
-        address dictionary A in the given mesh. See also mesh.address.
+        address dictionary (or compact address array) A in the given mesh. See also mesh.address.
+        Addresses whose face_id is -1 yield nan coordinates.
         '''
-        if not isinstance(data, dict):
-            raise ValueError('address data must be a dictionary')
-        if 'face_id' not in data: raise ValueError('address must contain face_id')
-        if 'coordinates' not in data: raise ValueError('address must contain coordinates')
-        face_id = data['face_id']
-        coords = data['coordinates']
-        if all(hasattr(x, '__iter__') for x in (face_id, coords)):
-            faces = self.triangles[face_id].T
-            tx = np.transpose(np.asarray([self.coordinates[f] for f in faces]), (0,2,1))
-        else:
+        (face_id, coords) = _address_data(data)
+        if len(face_id.shape) == 0:
             tx = np.asarray(self.coordinates[self.triangles[face_id]])
-        return barycentric_to_cartesian(tx, coords)
+            return barycentric_to_cartesian(tx, coords)
+        return _unaddress_data(self.coordinates, self.triangles, face_id, coords).T
 
 
@@ -5,7 +5,7 @@
 # By Noah C. Benson
 
 import numpy as np
-import math
+import scipy, math, re
 
 def normalize(u):
     '''
@@ -212,7 +212,7 @@ def cartesian_to_barycentric_3D(tri, xy):
     xy = np.asarray(xy)
     tri = np.asarray(tri)
     if len(xy.shape) == 1:
-        return cartesian_to_barycentric_2D(np.transpose(np.asarray([tri]), (1,2,0)),
+        return cartesian_to_barycentric_3D(np.transpose(np.asarray([tri]), (1,2,0)),
                                            np.asarray([xy]).T)[:,0]
     xy = xy if xy.shape[0] == 3 else xy.T
     if tri.shape[0] == 3:
@@ -390,3 +390,95 @@ def point_in_triangle(tri, pt):
                 np.dot(pt - tri[1], np.cross(tri[1], tri[2] - tri[1])) >= 0 and
                 np.dot(pt - tri[2], np.cross(tri[2], tri[0] - tri[2])) >= 0)
     
+
+# KD-tree queries ##################################################################################
+# The library-wide default number of workers used in KD-tree queries and the number of points that
+# are queried at once; see set_kdtree_workers and kdtree_query.
+_kdtree_workers = 1
+_kdtree_chunk_size = 65536
+# The keyword that each cKDTree method uses for parallelism, by SciPy version: SciPy 1.6 renamed
+# n_jobs to workers, and query_ball_point gained n_jobs later than query did (we rely on it from
+# SciPy 1.2, the oldest release in which we have confirmed it); older versions accept neither
+_kdtree_workers_keywords = {'query':            ((1,6), 'workers', (0,16), 'n_jobs'),
+                            'query_ball_point': ((1,6), 'workers', (1,2),  'n_jobs')}
+_scipy_version = tuple(int(v) for v in re.findall(r'\d+', scipy.__version__)[:2])
+
+def kdtree_workers():
+    '''
+    kdtree_workers() yields the library-wide default number of workers used by the KD-tree queries
+    in neuropythy (e.g., in mesh.container and mesh.interpolate) when their n_jobs option is None.
+    A value of -1 indicates that all processors should be used. See also set_kdtree_workers.
+    '''
+    return _kdtree_workers
+
+def set_kdtree_workers(n, chunk_size=None):
+    '''
+    set_kdtree_workers(n) sets the library-wide default number of workers used by KD-tree queries
+    in neuropythy to n; -1 indicates that all processors should be used. If the optional argument
+    chunk_size is given, it sets the maximum number of points queried at once, which bounds the
+    size of the intermediate (n x k) result arrays. See also kdtree_query.
+    '''
+    global _kdtree_workers, _kdtree_chunk_size
+    n = int(n)
+    if n == 0 or n < -1: raise ValueError('number of workers must be positive or -1')
+    _kdtree_workers = n
+    if chunk_size is not None:
+        chunk_size = int(chunk_size)
+        if chunk_size < 1: raise ValueError('chunk_size must be positive')
+        _kdtree_chunk_size = chunk_size
+    return n
+
+def _kdtree_workers_keyword(name):
+    # yields the parallelism keyword of the cKDTree method with the given name in this SciPy, or
+    # None if the method does not accept one
+    (new_version, new_kw, old_version, old_kw) = _kdtree_workers_keywords[name]
+    return (new_kw if _scipy_version >= new_version else
+            old_kw if _scipy_version >= old_version else
+            None)
+
+def _kdtree_call(tree, name, x, n_jobs, args, kwargs):
+    # calls the named cKDTree method of tree with the parallelism keyword this SciPy understands
+    n = _kdtree_workers if n_jobs is None else n_jobs
+    kw = _kdtree_workers_keyword(name)
+    if kw is None or n == 1: return getattr(tree, name)(x, *args, **kwargs)
+    return getattr(tree, name)(x, *args, **dict(kwargs, **{kw:n}))
+
+def kdtree_query(tree, x, k=1, n_jobs=None, chunk_size=None, **kwargs):
+    '''
+    kdtree_query(tree, x) yields the result of tree.query(x) for the scipy.spatial.cKDTree object
+    tree and the (n x dims) matrix of points x, but passes the given number of workers n_jobs along
+    to SciPy (as workers or n_jobs, according to the installed version) and queries very large
+    matrices of points in chunks, filling preallocated result arrays, so that the memory required
+    by SciPy's intermediate arrays stays bounded.
+
+    The following options are accepted:
+      * k (default: 1) is the number of neighbors to find.
+      * n_jobs (default: None) is the number of workers; None uses the library-wide default (see
+        set_kdtree_workers), and -1 uses all processors.
+      * chunk_size (default: None) is the maximum number of points queried at once; None uses the
+        library-wide default of 65536.
+    All other options are passed along to tree.query.
+    '''
+    x = np.asarray(x)
+    chunk_size = _kdtree_chunk_size if chunk_size is None else chunk_size
+    if len(x.shape) == 1 or x.shape[0] <= chunk_size:
+        return _kdtree_call(tree, 'query', x, n_jobs, (k,), kwargs)
+    n = x.shape[0]
+    (d0, i0) = _kdtree_call(tree, 'query', x[:chunk_size], n_jobs, (k,), kwargs)
+    d = np.empty((n,) + d0.shape[1:], dtype=d0.dtype)
+    i = np.empty((n,) + i0.shape[1:], dtype=i0.dtype)
+    d[:chunk_size] = d0
+    i[:chunk_size] = i0
+    for start in range(chunk_size, n, chunk_size):
+        end = min(start + chunk_size, n)
+        (d[start:end], i[start:end]) = _kdtree_call(tree, 'query', x[start:end], n_jobs, (k,),
+                                                    kwargs)
+    return (d, i)
+
+def kdtree_query_ball_point(tree, x, r, n_jobs=None, **kwargs):
+    '''
+    kdtree_query_ball_point(tree, x, r) yields the result of tree.query_ball_point(x, r) for the
+    scipy.spatial.cKDTree object tree, passing the given number of workers n_jobs along to SciPy as
+    in kdtree_query. All other options are passed along to tree.query_ball_point.
+    '''
+    return _kdtree_call(tree, 'query_ball_point', x, n_jobs, (r,), kwargs)
@@ -6,30 +6,233 @@
 import numpy   as np
 import scipy   as sp
 import numbers as num
-import os, sys, gzip
+import os, sys, gzip, hashlib, threading, collections, contextlib
 
 from array import array
 
 # Java start:
 _java_port = None
 _java = None
+_java_lock = threading.RLock()
 
-def _init_registration():
+# The options with which the JVM is launched; these may be set via the environment variables
+# NEUROPYTHY_JAVA_HEAP (e.g., 4g), NEUROPYTHY_JAVA_GC (e.g., G1 or parallel), and
+# NEUROPYTHY_JAVA_OPTS (additional JVM flags, separated by whitespace) or via set_java_options.
+_java_gc_flags = {'g1':       '-XX:+UseG1GC',
+                  'parallel': '-XX:+UseParallelGC',
+                  'serial':   '-XX:+UseSerialGC'}
+_java_options = {'heap':    os.environ.get('NEUROPYTHY_JAVA_HEAP') or '2g',
+                 'gc':      os.environ.get('NEUROPYTHY_JAVA_GC') or None,
+                 'options': tuple(os.environ.get('NEUROPYTHY_JAVA_OPTS', '').split())}
+
+def java_options():
+    '''
+    java_options() yields a dictionary of the options with which neuropythy launches the JVM: heap
+    (the maximum heap size, as given to -Xmx), gc (the garbage collector, None for the JVM's
+    default), and options (a tuple of additional JVM flags).
+    '''
+    return dict(_java_options)
+
+def set_java_options(heap=None, gc=None, options=None):
+    '''
+    set_java_options(heap, gc, options) sets the options with which neuropythy launches the JVM; any
+    argument that is None is left unchanged. The heap option is the maximum heap size (e.g., '4g');
+    the gc option may be 'G1', 'parallel', 'serial', or a JVM flag such as '-XX:+UseZGC'; and the
+    options argument is a list of additional JVM flags. The defaults are taken from the environment
+    variables NEUROPYTHY_JAVA_HEAP, NEUROPYTHY_JAVA_GC, and NEUROPYTHY_JAVA_OPTS. A RuntimeError is
+    raised if the JVM has already been started.
+    '''
+    with _java_lock:
+        if _java is not None:
+            raise RuntimeError('JVM options cannot be changed once the JVM has been started')
+        if heap    is not None: _java_options['heap']    = str(heap)
+        if gc      is not None: _java_options['gc']      = gc
+        if options is not None:
+            _java_options['options'] = tuple([options] if isinstance(options, basestring) else
+                                             options)
+    return java_options()
+
+def _java_launch_options(heap=None, gc=None, options=None):
+    # yields the list of JVM flags for the given options, falling back on _java_options
+    heap = _java_options['heap']    if heap    is None else str(heap)
+    gc   = _java_options['gc']      if gc      is None else gc
+    opts = _java_options['options'] if options is None else options
+    if isinstance(opts, basestring): opts = opts.split()
+    flags = ['-Xmx' + heap] if heap else []
+    if gc:
+        if gc.startswith('-'):                 flags.append(gc)
+        elif gc.lower() in _java_gc_flags:     flags.append(_java_gc_flags[gc.lower()])
+        else: raise ValueError('Unrecognized garbage collector: %s' % gc)
+    return flags + list(opts)
+
+def _launch_java_gateway(heap=None, gc=None, options=None):
+    # launches a new JVM and yields (port, gateway) for it
     from py4j.java_gateway import (launch_gateway, JavaGateway, GatewayParameters)
-    global _java, _java_port
-    if _java is not None: return
-    _java_port = launch_gateway(
+    port = launch_gateway(
         classpath=os.path.join(
             os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
             'lib', 'nben', 'target', 'nben-standalone.jar'),
-        javaopts=['-Xmx2g'],
+        javaopts=_java_launch_options(heap=heap, gc=gc, options=options),
         die_on_exit=True)
-    _java = JavaGateway(gateway_parameters=GatewayParameters(port=_java_port))
+    return (port, JavaGateway(gateway_parameters=GatewayParameters(port=port)))
+
+def _init_registration(heap=None, gc=None, options=None):
+    global _java, _java_port
+    with _java_lock:
+        if _java is not None: return
+        (_java_port, _java) = _launch_java_gateway(heap=heap, gc=gc, options=options)
+        _java_pool.append([_java, 0])
+
+# The pool of gateways ##############################################################################
+# The first gateway in the pool is always _java; additional gateways (each with its own JVM) are
+# launched on demand by java_gateway() when all existing gateways are in use and the pool is not yet
+# full. Each thread may be bound to one gateway, which java_link() then yields.
+_java_pool = []
+_java_pool_size = int(os.environ.get('NEUROPYTHY_JAVA_POOL_SIZE') or 1)
+_java_thread = threading.local()
+
+def java_pool_size():
+    '''
+    java_pool_size() yields the maximum number of JVM gateways that neuropythy will launch for
+    concurrent use via java_gateway(); see set_java_pool_size.
+    '''
+    return _java_pool_size
+
+def set_java_pool_size(n):
+    '''
+    set_java_pool_size(n) sets the maximum number of JVM gateways (each with its own JVM, launched
+    with the options given by java_options()) that neuropythy will use for concurrent calls to
+    mesh_register and similar functions; see java_gateway. Gateways beyond the first n that are not
+    in use are shut down. The default is the environment variable NEUROPYTHY_JAVA_POOL_SIZE or 1.
+    '''
+    global _java_pool_size
+    n = int(n)
+    if n < 1: raise ValueError('JVM pool size must be at least 1')
+    with _java_lock:
+        _java_pool_size = n
+        idle = [ent for ent in _java_pool[n:] if ent[1] == 0]
+        for ent in idle: _java_pool.remove(ent)
+    for (gw, _) in idle:
+        _evict_java_arrays(0, gw, detach=True)
+        try:
+            gw.shutdown()
+        except Exception:
+            pass
+    return n
+
+def _acquire_java_gateway():
+    # yields the least-used gateway in the pool, launching a new one if the pool has room; the new
+    # gateway's slot is reserved (with a gateway of None) while its JVM is launched outside the lock
+    with _java_lock:
+        if _java is None: _init_registration()
+        ent = min([e for e in _java_pool if e[0] is not None], key=lambda e: e[1])
+        if ent[1] == 0 or len(_java_pool) >= _java_pool_size:
+            ent[1] += 1
+            return ent[0]
+        ent = [None, 1]
+        _java_pool.append(ent)
+    try:
+        gw = _launch_java_gateway()[1]
+    except Exception:
+        with _java_lock:
+            _java_pool[:] = [e for e in _java_pool if e is not ent]
+        raise
+    with _java_lock:
+        ent[0] = gw
+    return gw
+
+def _release_java_gateway(gw):
+    with _java_lock:
+        for ent in _java_pool:
+            if ent[0] is gw:
+                ent[1] -= 1
+                break
+
+@contextlib.contextmanager
+def java_gateway(gateway=None):
+    '''
+    java_gateway() is a context manager that binds a JVM gateway from the neuropythy gateway pool to
+    the current thread, so that java_link() yields that gateway within the context; the gateway is
+    yielded by the context manager. The gateway that is currently used by the fewest threads is
+    chosen, and a new JVM is launched if all gateways are in use and the pool has fewer than
+    java_pool_size() gateways. If the current thread is already bound to a gateway, that gateway is
+    used. This allows, for example, registrations run in a ThreadPoolExecutor to run in separate
+    JVMs:
+      set_java_pool_size(2)
+      with ThreadPoolExecutor(2) as ex:
+          regs = list(ex.map(register_retinotopy, [sub.LH, sub.RH]))
+
+    If a gateway is given (e.g., the gateway of a Java object, see java_object_gateway), then that
+    gateway is bound within the context instead.
+    '''
+    prev = getattr(_java_thread, 'gateway', None)
+    if gateway is None and prev is not None:
+        yield prev
+        return
+    gw = _acquire_java_gateway() if gateway is None else gateway
+    _java_thread.gateway = gw
+    try:
+        yield gw
+    finally:
+        _java_thread.gateway = prev
+        if gateway is None: _release_java_gateway(gw)
+
+def java_object_gateway(jobj):
+    '''
+    java_object_gateway(jobj) yields the gateway from the neuropythy gateway pool to which the given
+    Java object belongs, or java_link() if the object's gateway cannot be found.
+    '''
+    client = getattr(jobj, '_gateway_client', None)
+    with _java_lock:
+        for (gw, _) in _java_pool:
+            if gw is not None and gw._gateway_client is client: return gw
+    return java_link()
 
 def java_link():
+    '''
+    java_link() yields the py4j gateway that is bound to the current thread (see java_gateway) or,
+    if there is none, the default gateway, which is started if necessary.
+    '''
+    gw = getattr(_java_thread, 'gateway', None)
+    if gw is not None: return gw
     if _java is None: _init_registration()
     return _java
 
+# The classes loaded by java_prewarm when load_classes is True
+_java_prewarm_classes = ('nben.util.Numpy',
+                         'nben.mesh.registration.Minimizer',
+                         'nben.mesh.registration.Fields',
+                         'nben.neuroscience.SchiraModel')
+
+def java_prewarm(load_classes=True, heap=None, gc=None, options=None):
+    '''
+    java_prewarm() starts the JVM used by neuropythy in a background thread and yields that thread;
+    this allows the startup of the JVM to overlap with other work such as loading a subject. Any
+    later call that requires the JVM waits for the background startup to finish. If the JVM has
+    already been started, the returned thread does nothing.
+
+    The following options may be given:
+      * load_classes (default: True) specifies whether the nben classes used for registration and
+        retinotopic models should be loaded once the JVM has started.
+      * heap, gc, and options are used in place of the values given by java_options(); see
+        set_java_options.
+    '''
+    # check the options here so that errors are raised in the calling thread
+    _java_launch_options(heap=heap, gc=gc, options=options)
+    def _prewarm():
+        try:
+            _init_registration(heap=heap, gc=gc, options=options)
+            if load_classes:
+                for cls in _java_prewarm_classes:
+                    _java.jvm.java.lang.Class.forName(cls)
+        except Exception:
+            # any error will be raised again by the first call that needs the JVM
+            pass
+    th = threading.Thread(target=_prewarm, name='neuropythy-java-prewarm')
+    th.daemon = True
+    th.start()
+    return th
+
 def serialize_numpy(m, t):
     '''
     serialize_numpy(m, type) converts the numpy array m into a byte stream that can be read by the
@@ -39,51 +242,286 @@ def serialize_numpy(m, t):
     array, flattened.
     The argument type gives the type of the array to be transferred and must be 'i' for integer or
     'd' for double (or any other string accepted by array.array()).
+    The array is written directly into a single preallocated buffer using an explicit big-endian
+    dtype, so no intermediate Python lists or copies are made.
     '''
+    m = np.asarray(m)
+    dtype = np.dtype(t).newbyteorder('>')
     # Start with the header: <number of dimensions> <dim1-size> <dim2-size> ...
-    header = array('i', [len(m.shape)] + list(m.shape))
+    header = np.asarray([len(m.shape)] + list(m.shape), dtype='>i4')
+    buf = bytearray(header.nbytes + m.size * dtype.itemsize)
+    np.frombuffer(buf, dtype='>i4', count=len(header))[:] = header
     # Now, we can do the array itself, just flattened
-    body = array(t, m.flatten().tolist())
-    # Wrap bytes if necessary...
-    if sys.byteorder != 'big':
-        header.byteswap()
-        body.byteswap()
-    # And return the result:
-    return bytearray(header.tostring() + body.tostring())
+    if m.size > 0:
+        body = np.frombuffer(buf, dtype=dtype, count=m.size, offset=header.nbytes)
+        body.reshape(m.shape)[...] = m
+    return buf
+
+# The cache of Java arrays #########################################################################
+# Java arrays that are converted with cache=True are kept alive on the gateway, keyed by the gateway
+# and by the type, shape, and content hash of the numpy array, so that sending the same mesh to the
+# JVM again (e.g., for each potential term or each registration in a sweep) skips serialization.
+# When an array is evicted, the cache only drops its reference: py4j releases the Java array once no
+# Python object refers to it, so a handle that another thread has just been given stays valid. The
+# arrays are detached explicitly only by clear_java_array_cache and when a gateway is shut down.
+_java_array_cache = collections.OrderedDict()
+_java_array_cache_size = 64
+_java_array_cache_lock = threading.Lock()
 
-def to_java_doubles(m):
+def java_array_cache_size():
     '''
-    to_java_doubles(m) yields a java array object for the vector or matrix m.
+    java_array_cache_size() yields the maximum number of Java arrays kept in the neuropythy Java
+    array cache; see set_java_array_cache_size.
     '''
-    global _java
-    if _java is None: _init_registration()
+    return _java_array_cache_size
+
+def set_java_array_cache_size(n):
+    '''
+    set_java_array_cache_size(n) sets the maximum number of Java arrays kept alive by the Java
+    array cache (used by to_java_doubles(m, cache=True) and similar) to n; the least recently used
+    arrays are evicted, and the JVM may collect them once they are no longer in use. A value of 0
+    disables the cache.
+    '''
+    global _java_array_cache_size
+    n = int(n)
+    if n < 0: raise ValueError('cache size must be non-negative')
+    _java_array_cache_size = n
+    _evict_java_arrays(n)
+    return n
+
+def clear_java_array_cache():
+    '''
+    clear_java_array_cache() releases all of the Java arrays kept by the Java array cache; the
+    arrays are detached from their gateways, so this must not be called while a registration that
+    uses the cache is running.
+    '''
+    _evict_java_arrays(0, detach=True)
+
+def _evict_java_arrays(n, gateway=None, detach=False):
+    # evicts the least recently used arrays until at most n remain (of those on the given gateway);
+    # unless detach is True, the arrays are only dropped from the cache (see above)
+    with _java_array_cache_lock:
+        keys = [k for (k,(gw,_)) in _java_array_cache.iteritems()
+                if gateway is None or gw is gateway]
+        evicted = [_java_array_cache.pop(k) for k in keys[:max(len(keys) - n, 0)]]
+    if not detach: return
+    for (gw, jarr) in evicted:
+        try:
+            gw.detach(jarr)
+        except Exception:
+            pass
+
+def _to_java(m, t, cache):
+    # converts m to a Java array of type t ('i' or 'd'), optionally via the cache
     m = np.asarray(m)
     dims = len(m.shape)
     if dims > 2: raise ValueError('1D and 2D arrays supported only')
-    bindat = serialize_numpy(m, 'd')
-    return (_java.jvm.nben.util.Numpy.double2FromBytes(bindat) if dims == 2
-            else _java.jvm.nben.util.Numpy.double1FromBytes(bindat))
+    gw = java_link()
+    nums = gw.jvm.nben.util.Numpy
+    if not cache or _java_array_cache_size == 0:
+        bindat = serialize_numpy(m, t)
+        if t == 'i': return nums.int2FromBytes(bindat) if dims == 2 else nums.int1FromBytes(bindat)
+        else: return nums.double2FromBytes(bindat) if dims == 2 else nums.double1FromBytes(bindat)
+    dt = np.dtype(t)
+    key = (id(gw), t, m.shape,
+           hashlib.sha1(np.ascontiguousarray(m, dtype=dt).view(np.uint8)).hexdigest())
+    with _java_array_cache_lock:
+        if key in _java_array_cache:
+            jarr = _java_array_cache.pop(key)
+            _java_array_cache[key] = jarr
+            return jarr[1]
+    jarr = _to_java(m, t, False)
+    with _java_array_cache_lock:
+        _java_array_cache[key] = (gw, jarr)
+    _evict_java_arrays(_java_array_cache_size)
+    return jarr
+
+def to_java_doubles(m, cache=False):
+    '''
+    to_java_doubles(m) yields a java array object for the vector or matrix m.
+    If the optional argument cache is True, then the Java array may be shared with other calls to
+    to_java_doubles that are given an array with identical contents, so it must not be modified;
+    see set_java_array_cache_size.
+    '''
+    return _to_java(m, 'd', cache)
 
-def to_java_ints(m):
+def to_java_ints(m, cache=False):
     '''
     to_java_ints(m) yields a java array object for the vector or matrix m.
+    If the optional argument cache is True, then the Java array may be shared with other calls to
+    to_java_ints that are given an array with identical contents, so it must not be modified; see
+    set_java_array_cache_size.
     '''
-    global _java
-    if _java is None: _init_registration()
-    m = np.asarray(m)
-    dims = len(m.shape)
-    if dims > 2: raise ValueError('1D and 2D arrays supported only')
-    bindat = serialize_numpy(m, 'i')
-    return (_java.jvm.nben.util.Numpy.int2FromBytes(bindat) if dims == 2
-            else _java.jvm.nben.util.Numpy.int1FromBytes(bindat))
+    return _to_java(m, 'i', cache)
 
-def to_java_array(m):
+def to_java_array(m, cache=False):
     '''
     to_java_array(m) yields to_java_ints(m) if m is an array of integers and to_java_doubles(m) if
     m is anything else. The numpy array m is tested via numpy.issubdtype(m.dtype, numpy.int64).
+    The optional argument cache is passed along to to_java_ints or to_java_doubles.
     '''
     m = np.asarray(m)
     if np.issubdtype(m.dtype, np.int) or all(isinstance(x, num.Integral) for x in m):
-        return to_java_ints(m)
+        return to_java_ints(m, cache=cache)
     else:
-        return to_java_doubles(m)
+        return to_java_doubles(m, cache=cache)
+
+# Java -> Python ###################################################################################
+# Java arrays are copied back to Python in one call by serializing them with a Java
+# ObjectOutputStream and decoding the resulting byte array here; see the Java Object Serialization
+# Stream Protocol for the format. Only (possibly nested) arrays of primitives are supported.
+_java_primitive_dtypes = {'D': np.dtype('>f8'), 'F': np.dtype('>f4'), 'J': np.dtype('>i8'),
+                          'I': np.dtype('>i4'), 'S': np.dtype('>i2'), 'B': np.dtype('i1'),
+                          'C': np.dtype('>u2'), 'Z': np.dtype('?')}
+_java_stream_base_handle = 0x7E0000
+
+class _JavaArrayStream(object):
+    # a decoder for a serialized (possibly nested) Java array of primitives
+    def __init__(self, buf):
+        self.buf = buf
+        self.pos = 0
+        self.handles = {}
+        self.nhandles = 0
+    def read(self, dtype, count=1):
+        dtype = np.dtype(dtype)
+        if self.pos + dtype.itemsize * count > len(self.buf):
+            raise ValueError('unexpected end of Java stream')
+        res = np.frombuffer(self.buf, dtype=dtype, count=count, offset=self.pos)
+        self.pos += dtype.itemsize * count
+        return res
+    def read1(self, dtype):
+        return self.read(dtype)[0]
+    def new_handle(self, obj):
+        h = self.nhandles
+        self.nhandles += 1
+        self.handles[h] = obj
+        return h
+    def reference(self):
+        h = int(self.read1('>i4')) - _java_stream_base_handle
+        if h not in self.handles: raise ValueError('unsupported reference in Java stream')
+        return self.handles[h]
+    def class_desc(self):
+        tc = self.read1('u1')
+        if tc == 0x70: return None
+        elif tc == 0x71: return self.reference()
+        elif tc != 0x72: raise ValueError('unsupported class descriptor in Java stream')
+        name = self.read(np.uint8, int(self.read1('>u2'))).tostring()
+        self.read('u1', 8) # serialVersionUID
+        h = self.new_handle(None)
+        self.handles[h] = (name, h)
+        self.read1('u1') # flags
+        if self.read1('>i2') != 0: raise ValueError('only Java arrays are supported')
+        if self.read1('u1') != 0x78: raise ValueError('unsupported class annotation in Java stream')
+        self.class_desc() # the superclass
+        return (name, h)
+    def array(self):
+        # yields (value, template) where template describes how the array is laid out in the stream
+        # when its class descriptors are references; this lets us read uniform rows in one pass
+        tc = self.read1('u1')
+        if tc == 0x70: return (None, None)
+        elif tc != 0x75: raise ValueError('only Java arrays are supported')
+        (name, dh) = self.class_desc()
+        if not name.startswith('['): raise ValueError('only Java arrays are supported')
+        h = self.new_handle(None)
+        n = int(self.read1('>i4'))
+        head = [('tc', 'u1'), ('ref', 'u1'), ('desc', '>i4'), ('n', '>i4')]
+        if name[1] in _java_primitive_dtypes:
+            dt = _java_primitive_dtypes[name[1]]
+            res = self.read(dt, n)
+            tmpl = (dh, n, None, np.dtype(head + [('data', dt, (n,))])) if n > 0 else None
+        elif name[1] == '[':
+            (rows, tmpl) = ([], None)
+            if n > 0:
+                (r0, t) = self.array()
+                rest = None if t is None or n == 1 else self.uniform_rows(t, n - 1)
+                if t is not None and (n == 1 or rest is not None):
+                    res = r0[None] if rest is None else np.concatenate((r0[None], rest))
+                    tmpl = (dh, n, t, np.dtype(head + [('data', t[3], (n,))]))
+                    self.handles[h] = res
+                    return (res, tmpl)
+                rows = [r0] + [self.array()[0] for _ in range(n - 1)]
+            if n > 0 and all(isinstance(r, np.ndarray) and r.dtype != np.object_ for r in rows) \
+               and len(set(r.shape for r in rows)) == 1:
+                res = np.asarray(rows)
+            else:
+                res = np.empty(n, dtype=np.object_)
+                for (i,r) in enumerate(rows): res[i] = r
+        else:
+            raise ValueError('only arrays of primitives are supported')
+        self.handles[h] = res
+        return (res, tmpl)
+    def uniform_rows(self, tmpl, count):
+        # attempts to read count rows with the same layout as the template; yields None on failure
+        dt = tmpl[3]
+        if self.pos + dt.itemsize * count > len(self.buf): return None
+        recs = np.frombuffer(self.buf, dtype=dt, count=count, offset=self.pos)
+        (t, r) = (tmpl, recs)
+        while True:
+            if not (np.all(r['tc'] == 0x75) and np.all(r['ref'] == 0x71) and
+                    np.all(r['desc'] == t[0] + _java_stream_base_handle) and
+                    np.all(r['n'] == t[1])):
+                return None
+            if t[2] is None: break
+            (t, r) = (t[2], r['data'])
+        # the rows are uniform; skip past them (they cannot be referenced later)
+        self.pos += dt.itemsize * count
+        nested = recs['data']
+        t = tmpl
+        while t[2] is not None:
+            nested = nested['data']
+            t = t[2]
+        # each row and sub-row is an array with its own handle
+        (t, k) = (tmpl, count)
+        while t is not None:
+            self.nhandles += k
+            k *= t[1] if t[2] is not None else 0
+            t = t[2]
+        return nested
+
+def _decode_java_array(buf):
+    s = _JavaArrayStream(buf)
+    if s.read1('>u2') != 0xACED or s.read1('>u2') != 5:
+        raise ValueError('byte array is not a Java serialization stream')
+    res = s.array()[0]
+    if isinstance(res, np.ndarray) and res.dtype != np.object_:
+        res = res.astype(res.dtype.newbyteorder('='))
+    return res
+
+def _from_java_array_elementwise(jarr):
+    # the slow path: each element is copied via a separate py4j call
+    if not hasattr(jarr, '__iter__'): return jarr
+    return np.asarray([_from_java_array_elementwise(x) for x in jarr])
+
+def from_java_array(jarr):
+    '''
+    from_java_array(jarr) yields a numpy array equivalent to the given Java array of primitives
+    (e.g., a double[][] or an int[]), which may be nested to any depth. The array is transferred in
+    a single call to the JVM by serializing it into a byte array, which is then decoded with
+    np.frombuffer; this is much faster than iterating over the array via py4j, which requires a
+    call per element. If jarr is None, None is yielded.
+    '''
+    if jarr is None: return None
+    if not hasattr(jarr, '_target_id'): return np.asarray(jarr)
+    jvm = java_object_gateway(jarr).jvm
+    try:
+        bos = jvm.java.io.ByteArrayOutputStream()
+        oos = jvm.java.io.ObjectOutputStream(bos)
+        oos.writeObject(jarr)
+        oos.close()
+        return _decode_java_array(bos.toByteArray())
+    except ValueError:
+        return _from_java_array_elementwise(jarr)
+
+def from_java_doubles(jarr):
+    '''
+    from_java_doubles(jarr) yields a numpy array of doubles equivalent to the given Java array; see
+    from_java_array.
+    '''
+    return np.asarray(from_java_array(jarr), dtype=np.float64)
+
+def from_java_ints(jarr):
+    '''
+    from_java_ints(jarr) yields a numpy array of integers equivalent to the given Java array; see
+    from_java_array.
+    '''
+    return np.asarray(from_java_array(jarr), dtype=np.int32)
@@ -10,3 +10,8 @@ mesh_register function.
 '''
 
 from .core       import (mesh_register, java_potential_term)
+from .fields     import (PotentialField, numpy_potential_field, numpy_potential_term,
+                         validate_numpy_potential)
+from .minimizer  import (MinimizationReport, minimize_potential)
+from .chunked    import (MeshRegistration, potential_plateau, save_registration_checkpoint,
+                         load_registration_checkpoint)
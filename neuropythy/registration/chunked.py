@@ -0,0 +1,339 @@
+####################################################################################################
+# registration/chunked.py
+# Mesh registration in bounded chunks of minimization steps, optionally in a background thread, with
+# progress tracking, early stopping, and checkpointing
+# By Noah C. Benson
+
+import numpy as np
+import threading, time
+from py4j.java_gateway import get_field
+from neuropythy.java import (java_link, java_gateway, to_java_ints, to_java_doubles,
+                             from_java_doubles)
+from neuropythy.util import atomic_write
+from .core import (_parse_field_arguments, _java_potential_function)
+from .fields import numpy_potential_field
+from .minimizer import (MinimizationReport, minimize_potential)
+
+def _java_report(rep):
+    # converts an nben Minimizer.Report object into a MinimizationReport
+    res = MinimizationReport(get_field(rep, 'initialPotential'))
+    if get_field(rep, 'steps') > 0:
+        cols = [from_java_doubles(get_field(rep, name))
+                for name in ['stepSizes', 'stepLengths', 'steepestVertexGradientNorms',
+                             'potentialChanges']]
+        for row in zip(*cols): res.push(*row)
+    return res.freeze(get_field(rep, 'finalPotential'))
+
+def _registration_stepper(mesh, field, backend, random_state=None):
+    # yields a function step(X, method, max_pe_change, max_steps, max_step_size) that minimizes the
+    # given field starting at the coordinates X and yields (X, report) with a MinimizationReport;
+    # for the java backend this must be called within a java_gateway() block
+    if backend == 'numpy':
+        pfn = numpy_potential_field(mesh, field)
+        if not isinstance(random_state, np.random.RandomState):
+            random_state = np.random.RandomState(random_state)
+        def step(X, method, max_pe_change, max_steps, max_step_size):
+            return minimize_potential(pfn, X, method=method, max_pe_change=max_pe_change,
+                                      max_steps=max_steps, max_step_size=max_step_size,
+                                      random_state=random_state)
+        return step
+    faces  = to_java_ints(mesh.indexed_faces, cache=True)
+    edges  = to_java_ints(mesh.indexed_edges, cache=True)
+    coords = to_java_doubles(mesh.coordinates, cache=True)
+    potential = _parse_field_arguments(field, faces, edges, coords)
+    def step(X, method, max_pe_change, max_steps, max_step_size):
+        (method, k) = method
+        if method == 'lbfgs':
+            return minimize_potential(_java_potential_function(potential), X, method='lbfgs',
+                                      max_pe_change=max_pe_change, max_steps=max_steps,
+                                      max_step_size=max_step_size)
+        minimizer = java_link().jvm.nben.mesh.registration.Minimizer(potential, to_java_doubles(X))
+        if method == 'pure':
+            rep = minimizer.step(max_pe_change, max_steps, max_step_size)
+        elif method == 'random':
+            rep = minimizer.randomStep(max_pe_change, max_steps, max_step_size, k == -1)
+        elif method == 'nimble':
+            rep = minimizer.nimbleStep(max_pe_change, max_steps, max_step_size, int(k))
+        else:
+            raise ValueError('Unrecognized method: %s' % method)
+        return (from_java_doubles(minimizer.getX()), None if rep is None else _java_report(rep))
+    return step
+
+def potential_plateau(epsilon=0.001, window=3):
+    '''
+    potential_plateau(epsilon, window) yields a convergence predicate, suitable for the converged
+    option of mesh_register, that indicates convergence once the potential has changed by less
+    than the fraction epsilon (default: 0.001) of its value over the last window (default: 3)
+    chunks of minimization steps.
+    '''
+    window = int(window)
+    if window < 1: raise ValueError('window must be a positive integer')
+    def converged(trajectory):
+        pe = trajectory['potential']
+        if len(pe) <= window: return False
+        return abs(pe[-window-1] - pe[-1]) <= epsilon * abs(pe[-window-1])
+    return converged
+
+def _encode_field(field):
+    # encodes the list of field instructions as a dict of plain arrays (strings and numbers become
+    # 0-dimensional arrays) so that checkpoints can be loaded without unpickling anything
+    if not isinstance(field, (list, tuple)):
+        raise ValueError('field argument must be a list of instructions')
+    dat = {'field_count': np.asarray(len(field))}
+    for (i, instruct) in enumerate(field):
+        if isinstance(instruct, basestring):
+            dat['field_%d' % i] = np.asarray(instruct)
+            continue
+        dat['field_%d_count' % i] = np.asarray(len(instruct))
+        for (j, arg) in enumerate(instruct):
+            arg = np.asarray(arg)
+            if arg.dtype == np.object:
+                raise ValueError('argument %d of field instruction %d cannot be saved' % (j, i))
+            dat['field_%d_%d' % (i, j)] = arg
+    return dat
+
+def _decode_field(dat):
+    # the inverse of _encode_field
+    decode = lambda a: a.item() if len(a.shape) == 0 else a
+    field = []
+    for i in range(int(dat['field_count'])):
+        if 'field_%d_count' % i not in dat:
+            field.append(str(dat['field_%d' % i]))
+        else:
+            field.append([decode(dat['field_%d_%d' % (i, j)])
+                          for j in range(int(dat['field_%d_count' % i]))])
+    return field
+
+def save_registration_checkpoint(filename, checkpoint):
+    '''
+    save_registration_checkpoint(filename, checkpoint) writes the given dictionary of registration
+    state to the given .npz file; the file is written atomically by writing a temporary file in the
+    same directory and renaming it. The field instructions are stored as plain arrays and strings,
+    so the file can be loaded without unpickling. Checkpoints are generally written by mesh_register
+    (see its checkpoint option) and read by load_registration_checkpoint.
+    '''
+    dat = {k:v for (k,v) in checkpoint.iteritems() if k != 'field'}
+    dat.update(_encode_field(checkpoint['field']))
+    return atomic_write(filename, lambda f: np.savez_compressed(f, **dat), suffix='.npz')
+
+def load_registration_checkpoint(filename):
+    '''
+    load_registration_checkpoint(filename) yields a dictionary of the registration state stored in
+    the given checkpoint file (see save_registration_checkpoint). The dictionary contains the keys
+    'coordinates', 'reference_coordinates', 'steps', 'initial_potential', 'potential', 'field',
+    'method', 'method_k', 'max_pe_change', 'max_steps', 'max_step_size', and 'backend'.
+    '''
+    with np.load(filename, allow_pickle=False) as f:
+        dat = {k: f[k] for k in f.files}
+    field = _decode_field(dat)
+    dat = {k:v for (k,v) in dat.iteritems() if not k.startswith('field_')}
+    dat['field'] = field
+    for k in ['steps', 'method_k', 'max_steps']:
+        dat[k] = int(dat[k])
+    for k in ['initial_potential', 'potential', 'max_pe_change', 'max_step_size']:
+        dat[k] = float(dat[k])
+    for k in ['method', 'backend']:
+        dat[k] = str(dat[k])
+    return dat
+
+class MeshRegistration(object):
+    '''
+    MeshRegistration(mesh, field, method, max_pe_change, max_steps, max_step_size, backend,
+    chunk_size, converged) represents a mesh registration that is performed in chunks of at most
+    chunk_size minimization steps; MeshRegistration objects are created by mesh_register when its
+    chunk_size, converged, or background options are given and should not generally be constructed
+    directly. The method argument must be a tuple (method_name, k) as parsed by mesh_register.
+
+    After each chunk, the potential, the norm of the steepest vertex gradient, the mean step size of
+    the chunk, the total number of steps, and the elapsed time are recorded; the function
+    reg.trajectory() yields a dictionary of these as numpy arrays with the keys 'potential',
+    'gradient_norm', 'step_size', 'steps', and 'time'. If converged is not None, it must be a
+    function that is called with this dictionary after each chunk and that yields True when the
+    registration should stop (see potential_plateau).
+
+    If the checkpoint option is given, the state of the registration is written to that .npz
+    filename (see save_registration_checkpoint) after every checkpoint_steps steps or every
+    checkpoint_interval seconds, whichever comes first, and after the final chunk; if neither
+    option is given, a checkpoint is written after every chunk. A registration may be resumed from
+    such a checkpoint via the resume_from option of mesh_register. If initial_coordinates is given,
+    the registration starts from these coordinates instead of the mesh's coordinates, which remain
+    the reference coordinates of the field.
+
+    A registration is run by reg.run() or, in a background thread, by reg.start(); in the latter
+    case, reg.done() indicates whether it has finished, reg.stop() asks it to stop after the current
+    chunk, and reg.result(timeout) waits for and yields the registered coordinates. The member
+    reg.coordinates always holds the coordinates at the end of the most recent chunk, and
+    reg.report() yields a MinimizationReport of all steps taken so far whose members chunk_steps,
+    chunk_potentials, chunk_gradient_norms, chunk_step_sizes, and chunk_times are the trajectory
+    arrays and whose member coordinates is reg.coordinates.
+    '''
+    def __init__(self, mesh, field, method, max_pe_change, max_steps, max_step_size, backend,
+                 chunk_size=100, converged=None,
+                 checkpoint=None, checkpoint_steps=None, checkpoint_interval=None, resume=None,
+                 initial_coordinates=None):
+        if not isinstance(chunk_size, (int, long)) or chunk_size < 1:
+            raise ValueError('chunk_size must be a positive integer')
+        if checkpoint_steps is not None and checkpoint_steps < 1:
+            raise ValueError('checkpoint_steps must be a positive integer')
+        if checkpoint_interval is not None and checkpoint_interval <= 0:
+            raise ValueError('checkpoint_interval must be a positive number')
+        self.mesh = mesh
+        self.field = field
+        self.method = method
+        self.max_pe_change = max_pe_change
+        self.max_steps = max_steps
+        self.max_step_size = max_step_size
+        self.backend = backend
+        self.chunk_size = chunk_size
+        self.converged = converged
+        self.checkpoint = checkpoint
+        self.checkpoint_steps = checkpoint_steps
+        self.checkpoint_interval = checkpoint_interval
+        # resume is a dictionary as yielded by load_registration_checkpoint
+        if resume is None:
+            self.coordinates = np.array(mesh.coordinates if initial_coordinates is None else
+                                        initial_coordinates,
+                                        dtype=np.float64)
+            self._start = (0, None, None)
+        else:
+            self.coordinates = np.array(resume['coordinates'], dtype=np.float64)
+            self._start = (resume['steps'], resume['initial_potential'], resume['potential'])
+        self.error = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._done = threading.Event()
+        self._thread = None
+        self._reports = []
+        self._trajectory = []
+    def trajectory(self):
+        '''
+        reg.trajectory() yields a dictionary of numpy arrays of the potential, gradient_norm,
+        step_size, steps, and time recorded after each chunk of the registration reg.
+        '''
+        with self._lock:
+            traj = np.reshape(np.asarray(self._trajectory, dtype=np.float64), (-1, 5)).T
+        return dict(zip(['potential', 'gradient_norm', 'step_size', 'steps', 'time'], traj))
+    def report(self):
+        '''
+        reg.report() yields a MinimizationReport object for all of the steps taken so far by the
+        registration reg, or None if no chunk has been completed; the report's member coordinates
+        holds the coordinates at the end of the most recent chunk.
+        '''
+        with self._lock:
+            reports = list(self._reports)
+            X = self.coordinates
+        if len(reports) == 0: return None
+        rep = MinimizationReport(reports[0].initial_potential)
+        for r in reports:
+            for row in zip(r.step_sizes, r.step_lengths, r.steepest_vertex_gradient_norms,
+                           r.potential_changes):
+                rep.push(*row)
+        rep.evaluations = sum(r.evaluations for r in reports)
+        rep.freeze(reports[-1].final_potential)
+        rep.coordinates = X
+        traj = self.trajectory()
+        rep.chunk_potentials      = traj['potential']
+        rep.chunk_gradient_norms  = traj['gradient_norm']
+        rep.chunk_step_sizes      = traj['step_size']
+        rep.chunk_steps           = traj['steps']
+        rep.chunk_times           = traj['time']
+        return rep
+    def run(self):
+        '''
+        reg.run() runs the registration reg in the current thread and yields the registered
+        coordinates.
+        '''
+        try:
+            if self.backend == 'java':
+                with java_gateway():
+                    self._run()
+            else:
+                self._run()
+        except Exception as e:
+            self.error = e
+            raise
+        finally:
+            self._done.set()
+        return self.coordinates
+    def _run(self):
+        step = _registration_stepper(self.mesh, self.field, self.backend)
+        (steps, pe0, pe) = self._start
+        t0 = time.time()
+        (ckpt_steps, ckpt_time) = (steps, t0)
+        while steps < self.max_steps and not self._stop.is_set():
+            # the fraction of the current potential that remains to be minimized away
+            dpe = self.max_pe_change if pe is None else 1.0 - (1.0 - self.max_pe_change)*pe0/pe
+            if dpe <= 0: break
+            n = min(self.chunk_size, self.max_steps - steps)
+            (X, rep) = step(self.coordinates, self.method, dpe, n, self.max_step_size)
+            if rep is None or rep.steps == 0: break
+            if pe0 is None: pe0 = rep.initial_potential
+            (pe, steps) = (rep.final_potential, steps + rep.steps)
+            with self._lock:
+                self.coordinates = X
+                self._reports.append(rep)
+                self._trajectory.append((pe, rep.steepest_vertex_gradient_norms[-1],
+                                         np.mean(rep.step_sizes), steps, time.time() - t0))
+            if self.checkpoint is not None:
+                if ((self.checkpoint_steps is None and self.checkpoint_interval is None)
+                    or (self.checkpoint_steps is not None
+                        and steps - ckpt_steps >= self.checkpoint_steps)
+                    or (self.checkpoint_interval is not None
+                        and time.time() - ckpt_time >= self.checkpoint_interval)):
+                    self.save_checkpoint(steps, pe0, pe)
+                    (ckpt_steps, ckpt_time) = (steps, time.time())
+            if self.converged is not None and self.converged(self.trajectory()): break
+        if self.checkpoint is not None and pe is not None and steps > ckpt_steps:
+            self.save_checkpoint(steps, pe0, pe)
+    def save_checkpoint(self, steps, initial_potential, potential):
+        '''
+        reg.save_checkpoint(steps, initial_potential, potential) writes the current state of the
+        registration reg, which has taken the given number of steps, to its checkpoint file.
+        '''
+        save_registration_checkpoint(
+            self.checkpoint,
+            {'coordinates':           self.coordinates,
+             'reference_coordinates': np.asarray(self.mesh.coordinates),
+             'steps':                 steps,
+             'initial_potential':     initial_potential,
+             'potential':             potential,
+             'field':                 self.field,
+             'method':                self.method[0],
+             'method_k':              self.method[1],
+             'max_pe_change':         self.max_pe_change,
+             'max_steps':             self.max_steps,
+             'max_step_size':         self.max_step_size,
+             'backend':               self.backend})
+    def start(self):
+        '''
+        reg.start() starts running the registration reg in a background thread and yields reg.
+        '''
+        if self._thread is not None: raise RuntimeError('registration has already been started')
+        def _run_quietly():
+            try: self.run()
+            except Exception: pass
+        self._thread = threading.Thread(target=_run_quietly)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+    def stop(self):
+        '''
+        reg.stop() asks the registration reg to stop after its current chunk of steps.
+        '''
+        self._stop.set()
+    def done(self):
+        '''
+        reg.done() yields True if the registration reg has finished and False otherwise.
+        '''
+        return self._done.is_set()
+    def result(self, timeout=None):
+        '''
+        reg.result() waits for the registration reg to finish and yields the registered coordinates;
+        if the registration raised an error, that error is raised instead. If the optional argument
+        timeout is given and the registration does not finish within that many seconds, a
+        RuntimeError is raised.
+        '''
+        if not self._done.wait(timeout):
+            raise RuntimeError('registration did not finish within the timeout')
+        if self.error is not None: raise self.error
+        return self.coordinates
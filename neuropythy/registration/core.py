@@ -14,8 +14,8 @@ from neuropythy.freesurfer import (freesurfer_subject, add_subject_path,
                                    cortex_to_ribbon, cortex_to_ribbon_map,
                                    Hemisphere, subject_paths)
 from neuropythy.topology import Registration
-from neuropythy.java import (java_link, serialize_numpy,
-                             to_java_doubles, to_java_ints, to_java_array)
+from neuropythy.java import (java_link, java_gateway, serialize_numpy,
+                             to_java_doubles, to_java_ints, to_java_array, from_java_doubles)
 import nibabel.freesurfer.io as fsio
 import nibabel.freesurfer.mghformat as fsmgh
 from pysistence import make_dict
@@ -53,7 +53,9 @@ _parse_field_data_types = {
     'perimeter': {
         'harmonic':   ['newHarmonicPerimeterPotential', ['scale', 1.0], ['shape', 2.0], 'F', 'X']}};
         
-def _parse_field_function_argument(argdat, args, faces, edges, coords):
+def _parse_field_function_argument(argdat, args, faces, edges, coords, convert=None):
+    # convert is the function used to convert array arguments; by default these become Java arrays
+    if convert is None: convert = lambda a: to_java_array(a, cache=True)
     # first, see if this is an easy one...
     if argdat == 'F':
         return faces
@@ -62,7 +64,7 @@ def _parse_field_function_argument(argdat, args, faces, edges, coords):
     elif argdat == 'E':
         return edges
     elif isinstance(argdat, (int, long)):
-        return to_java_array(args[argdat])
+        return convert(args[argdat])
     # okay, none of those; must be a list with a default arg
     argname = argdat[0]
     argdflt = argdat[1]
@@ -71,12 +73,12 @@ def _parse_field_function_argument(argdat, args, faces, edges, coords):
         if isinstance(args[i], basestring) and args[i].lower() == argname.lower():
             return (args[i+1] if (isinstance(args[i+1], Number)
                                   or np.issubdtype(type(args[i+1]), np.float)) else
-                    to_java_array(args[i+1]))
+                    convert(args[i+1]))
     # did not find the arg; use the default:
     return argdflt
 
-def _parse_field_argument(instruct, faces, edges, coords):
-    _java = java_link()
+def _parse_field_instruction(instruct):
+    # yields (method_name, argument_descriptions, instruction_args) for a field instruction
     if isinstance(instruct, basestring):
         insttype = instruct
         instargs = []
@@ -97,11 +99,20 @@ def _parse_field_argument(instruct, faces, edges, coords):
         if shape_name not in instdata:
             raise RuntimeError('Shape ' + shape_name + ' not supported for type ' + insttype)
         instdata = instdata[shape_name]
+    return (instdata[0], instdata[1:], instargs)
+
+def _parse_field_argument(instruct, faces, edges, coords):
+    _java = java_link()
+    (method_name, argdescs, instargs) = _parse_field_instruction(instruct)
     # okay, we have a list of instructions... find the java method we are going to call...
-    java_method = getattr(_java.jvm.nben.mesh.registration.Fields, instdata[0])
+    java_method = getattr(_java.jvm.nben.mesh.registration.Fields, method_name)
+    # the arguments of anchor fields (the vertices and anchor points) differ from one registration
+    # to the next, so they are not kept in the Java array cache
+    insttype = instruct if isinstance(instruct, basestring) else instruct[0]
+    convert = to_java_array if insttype.lower() == 'anchor' else None
     # and parse the arguments into a list...
-    java_args = [_parse_field_function_argument(a, instargs, faces, edges, coords)
-                 for a in instdata[1:]]
+    java_args = [_parse_field_function_argument(a, instargs, faces, edges, coords, convert)
+                 for a in argdescs]
     # and call the function...
     return java_method(*java_args)
 
@@ -126,14 +137,26 @@ def java_potential_term(mesh, instructions):
       and should only be called by mesh_register. Note: this expects a single term's description,
       not a series of descriptions.
     '''
-    faces  = to_java_ints(mesh.indexed_faces)
-    edges  = to_java_ints(mesh.indexed_edges)
-    coords = to_java_doubles(mesh.coordinates)
+    faces  = to_java_ints(mesh.indexed_faces, cache=True)
+    edges  = to_java_ints(mesh.indexed_edges, cache=True)
+    coords = to_java_doubles(mesh.coordinates, cache=True)
     return _parse_field_arguments([instructions], faces, edges, coords)
     
+def _java_potential_function(potential):
+    # yields a function f such that f(X) is the tuple (potential, gradient) of the given Java
+    # potential field at the (dims x n) coordinate matrix X; arrays are transferred in bulk
+    def f(X):
+        jgrad = to_java_doubles(np.zeros(X.shape))
+        pe = potential.calculate(to_java_doubles(X), jgrad)
+        return (pe, from_java_doubles(jgrad))
+    return f
+
 # The mesh_register function
 def mesh_register(mesh, field, max_steps=2000, max_step_size=0.05, max_pe_change=1,
-                  method='random', return_report=False):
+                  method='random', return_report=False, backend=None,
+                  chunk_size=None, converged=None, background=False,
+                  checkpoint=None, checkpoint_steps=None, checkpoint_interval=None,
+                  resume_from=None, initial_coordinates=None):
     '''
     mesh_register(mesh, field) yields the mesh that results from registering the given mesh by
     minimizing the given potential field description over the position of the vertices in the
@@ -174,6 +197,8 @@ def mesh_register(mesh, field, max_steps=2000, max_step_size=0.05, max_pe_change
           * 'scale': the scale parameter c; default: 1.
           * 'order': the order parameter q; default: 2.
           * 'sigma': the standard deviation parameter s; default: 1.
+        Note that, as in the nben library, the gradient of a Gaussian potential is not divided by s,
+        so it is s times the derivative of the potential.
       * 'infinite-well': an infinite well function with the form 
         c ( (((x0 - m)/(x - m))^q - 1)^2 + (((M - x0)/(M - x))^q - 1)^2 )
         Parameters:
@@ -208,6 +233,45 @@ def mesh_register(mesh, field, max_steps=2000, max_step_size=0.05, max_pe_change
         gradient at each individual vertex by drawing from an exponential distribution centered at
         the vertex's actual gradient length. In effect, this can prevent vertices with very large
         gradients from dominating the minimization and often results in the best results.
+        The 'lbfgs' option instead minimizes the potential using the L-BFGS-B quasi-Newton
+        method of scipy.optimize.minimize, which usually requires far fewer evaluations of the
+        potential field than the gradient-descent methods; max_steps then limits the number of
+        L-BFGS iterations, and the line search never accepts an iteration that moves a vertex
+        farther than max_step_size. With the 'lbfgs' method, the report returned when
+        return_report is True is a MinimizationReport object (see
+        neuropythy.registration.minimizer).
+      * backend (default: None) specifies whether the potential field is evaluated and minimized
+        by the nben library in the JVM ('java') or by the NumPy implementation in the
+        neuropythy.registration.fields module ('numpy'), which does not require Java; the 'nimble'
+        method is only available with the 'java' backend. If None, the value of the environment
+        variable NEUROPYTHY_REGISTRATION_BACKEND is used, or 'java' if it is not set.
+      * chunk_size (default: None) if given, the minimization is run in chunks of at most this many
+        steps, after each of which the potential, the steepest vertex gradient norm, and the mean
+        step size are recorded (see neuropythy.registration.MeshRegistration); in this case the
+        report returned when return_report is True is a MinimizationReport object that includes
+        these trajectories as numpy arrays and, as its member coordinates, the registered
+        coordinates. If converged or background is given, the default chunk size is 100.
+      * converged (default: None) may be a function that is called with a dictionary of the
+        trajectory arrays after each chunk and that yields True when the minimization should be
+        stopped early; see potential_plateau.
+      * background (default: False) if True, mesh_register starts the minimization in a background
+        thread and immediately yields a MeshRegistration object, which may be used to monitor the
+        registration's progress, to stop it, and to obtain its result.
+      * checkpoint (default: None) may be a filename to which the state of the registration (the
+        current coordinates, the step counter, and the field and minimization settings) is written
+        as a .npz file every checkpoint_steps steps or every checkpoint_interval seconds, whichever
+        comes first; if neither is given, a checkpoint is written after every chunk of steps (see
+        chunk_size, whose default is checkpoint_steps when that is given). Checkpoints are written
+        atomically, so an interrupted registration always leaves a complete checkpoint.
+      * resume_from (default: None) may be the filename of a checkpoint from which the registration
+        should be resumed; the field, method, max_steps, max_step_size, max_pe_change, and backend
+        stored in the checkpoint are used in place of the given arguments (the field argument may
+        be None), and max_steps counts the steps that were taken before the checkpoint. The given
+        mesh must have the same topology as the mesh whose registration was checkpointed.
+      * initial_coordinates (default: None) may be a coordinate matrix with the same shape as the
+        mesh's coordinates from which the minimization is started; the mesh's own coordinates
+        remain the reference positions of the field (e.g., the reference edge lengths and angles).
+        This is used, for example, to refine a registration found on a coarser mesh.
 
     Examples:
       registered_mesh = mesh_register(
@@ -222,12 +286,36 @@ def mesh_register(mesh, field, max_steps=2000, max_step_size=0.05, max_pe_change
     # First, make sure that the arguments are all okay:
     if not isinstance(mesh, CorticalMesh):
         raise RuntimeError('mesh argument must be an instance of neuropythy.cortex.CorticalMesh')
+    if resume_from is not None:
+        # the checkpoint's settings replace those given
+        from .chunked import load_registration_checkpoint
+        resume = load_registration_checkpoint(resume_from)
+        if resume['reference_coordinates'].shape != mesh.coordinates.shape:
+            raise ValueError('checkpoint %s does not match the given mesh' % resume_from)
+        mesh = mesh.using(coordinates=resume['reference_coordinates'])
+        field = resume['field']
+        method = (resume['method'], resume['method_k'])
+        (max_steps, max_step_size, max_pe_change, backend) = [
+            resume[k] for k in ['max_steps', 'max_step_size', 'max_pe_change', 'backend']]
+    else:
+        resume = None
+    if initial_coordinates is None or resume is not None:
+        X0 = mesh.coordinates
+    else:
+        X0 = np.asarray(initial_coordinates, dtype=np.float64)
+        if X0.shape != mesh.coordinates.shape:
+            raise ValueError('initial_coordinates must have the same shape as the mesh coordinates')
     if not isinstance(max_steps, (int, long)) or max_steps < 0:
         raise RuntimeError('max_steps argument must be a positive integer')
     if not isinstance(max_steps, (float, int, long)) or max_step_size <= 0:
         raise RuntimeError('max_step_size must be a positive number')
     if not isinstance(max_pe_change, (float, int, long)) or max_pe_change <= 0 or max_pe_change > 1:
         raise RuntimeError('max_pe_change must be a number x such that 0 < x <= 1')
+    if backend is None:
+        backend = os.environ.get('NEUROPYTHY_REGISTRATION_BACKEND', 'java')
+    backend = backend.lower()
+    if backend not in ('java', 'numpy'):
+        raise ValueError('Unrecognized registration backend: %s' % backend)
     if isinstance(method, basestring):
         method = method.lower()
         if method == 'nimble': k = 4
@@ -238,33 +326,63 @@ def mesh_register(mesh, field, max_steps=2000, max_step_size=0.05, max_pe_change
     # If steps is 0, we can skip most of this...
     if max_steps == 0:
         if return_report: return None
-        else: return mesh.coordinates
+        else: return X0
     # Otherwise, we run at least some minimization
     max_pe_change = float(max_pe_change)
     max_steps = int(max_steps)
     max_step_size = float(max_step_size)
-    # Parse the field argument.
-    faces  = to_java_ints(mesh.indexed_faces)
-    edges  = to_java_ints(mesh.indexed_edges)
-    coords = to_java_doubles(mesh.coordinates)
-    potential = _parse_field_arguments(field, faces, edges, coords)
-    # Okay, that's basically all we need to do the minimization...
-    minimizer = java_link().jvm.nben.mesh.registration.Minimizer(potential, coords)
-    if method == 'pure':
-        rep = minimizer.step(max_pe_change, max_steps, max_step_size)
-    elif method == 'random':
-        # if k is -1, we do the inverse version where we draw from the 1/mean distribution
-        rep = minimizer.randomStep(max_pe_change, max_steps, max_step_size, k == -1)
-    elif method == 'nimble':
-        rep = minimizer.nimbleStep(max_pe_change, max_steps, max_step_size, int(k))
-    else:
-        raise ValueError('Unrecognized method: %s' % method)
-    # Return the report if requested
-    if return_report:
-        return rep
-    else:
-        result = minimizer.getX()
-        return np.asarray([[x for x in row] for row in result])
+    if (background or chunk_size is not None or converged is not None
+        or checkpoint is not None or resume is not None):
+        from .chunked import MeshRegistration
+        if chunk_size is None:
+            chunk_size = 100 if checkpoint_steps is None else int(checkpoint_steps)
+        reg = MeshRegistration(mesh, field, (method, k), max_pe_change, max_steps, max_step_size,
+                               backend, chunk_size=chunk_size, converged=converged,
+                               checkpoint=checkpoint, checkpoint_steps=checkpoint_steps,
+                               checkpoint_interval=checkpoint_interval, resume=resume,
+                               initial_coordinates=X0)
+        if background: return reg.start()
+        reg.run()
+        return reg.report() if return_report else reg.coordinates
+    if backend == 'numpy':
+        from .fields import numpy_potential_field
+        from .minimizer import minimize_potential
+        (X, rep) = minimize_potential(numpy_potential_field(mesh, field), X0,
+                                      method=(method, k), max_pe_change=max_pe_change,
+                                      max_steps=max_steps, max_step_size=max_step_size)
+        return rep if return_report else X
+    # Run the minimization on a gateway from the pool (see neuropythy.java.java_gateway) so that
+    # registrations in separate threads may run in separate JVMs
+    with java_gateway():
+        # Parse the field argument.
+        faces  = to_java_ints(mesh.indexed_faces, cache=True)
+        edges  = to_java_ints(mesh.indexed_edges, cache=True)
+        coords = to_java_doubles(mesh.coordinates, cache=True)
+        potential = _parse_field_arguments(field, faces, edges, coords)
+        # The lbfgs method is driven from Python using the potential's calculate method
+        if method == 'lbfgs':
+            from .minimizer import minimize_potential
+            (X, rep) = minimize_potential(_java_potential_function(potential), X0,
+                                          method='lbfgs', max_pe_change=max_pe_change,
+                                          max_steps=max_steps, max_step_size=max_step_size)
+            return rep if return_report else X
+        # Okay, that's basically all we need to do the minimization...
+        if X0 is not mesh.coordinates: coords = to_java_doubles(X0)
+        minimizer = java_link().jvm.nben.mesh.registration.Minimizer(potential, coords)
+        if method == 'pure':
+            rep = minimizer.step(max_pe_change, max_steps, max_step_size)
+        elif method == 'random':
+            # if k is -1, we do the inverse version where we draw from the 1/mean distribution
+            rep = minimizer.randomStep(max_pe_change, max_steps, max_step_size, k == -1)
+        elif method == 'nimble':
+            rep = minimizer.nimbleStep(max_pe_change, max_steps, max_step_size, int(k))
+        else:
+            raise ValueError('Unrecognized method: %s' % method)
+        # Return the report if requested
+        if return_report:
+            return rep
+        else:
+            return from_java_doubles(minimizer.getX())
 
 # The topology and registration stuff is below:
 class JavaTopology:
@@ -305,9 +423,9 @@ class JavaTopology:
         return len(self.registrations)
     
     # These let us interpolate...
-    def interpolate(fromtopo, data, order=2, fill=None):
+    def interpolate(self, fromtopo, data, order=2, fill=None):
         usable_keys = []
-        for k in registrations.iterkeys():
+        for k in self.registrations.iterkeys():
             if k in fromtopo.registrations:
                 usable_keys.append(k)
         if not usable_keys:
@@ -320,11 +438,12 @@ class JavaTopology:
         maskres = self._java_object.interpolateBytes(
             fromtopo.registrations[the_key],
             self.registrations[the_key].coordinates,
-            order, jdata)
+            order, jmask)
         datares = self._java_object.interpolateBytes(
             fromtopo.registrations[the_key],
             self.registrations[the_key].coordinates,
-            order, jmask)
+            order, jdata)
         # then interpret the results...
-        return [datares[i] if maskres[i] == 1 else fill for i in range(len(maskres))]
+        (datares, maskres) = (from_java_doubles(datares), from_java_doubles(maskres))
+        return [d if m == 1 else fill for (d,m) in zip(datares, maskres)]
 
@@ -0,0 +1,385 @@
+####################################################################################################
+# registration/fields.py
+# A NumPy implementation of the potential fields used by mesh_register; these mirror the potential
+# fields of the nben library's nben.mesh.registration package so that registration may be performed
+# without a JVM.
+# By Noah C. Benson
+
+import numpy as np
+from math import pi
+from neuropythy.geometry import Mesh
+from neuropythy.java import (java_gateway, to_java_doubles, from_java_doubles)
+from .core import (_parse_field_instruction, _parse_field_function_argument, java_potential_term)
+
+# values whose magnitude is below this are treated as 0 (see nben.util.Num.zeroish, whose tolerance,
+# Num.ZERO_TOL, is 1e-12)
+_zero_tol = 1e-12
+
+# Shape functions ##################################################################################
+# Each of these yields the tuple (y, dy) of the potential and its derivative for the measures x and
+# the reference measures x0; see the nben.mesh.registration *Function classes.
+
+def _harmonic_shape(x, x0, scale, order):
+    x = x - x0
+    ax = np.abs(x)
+    return (scale / order * ax**order, np.sign(x) * scale * ax**(order - 1.0))
+
+def _lennard_jones_shape(x, x0, scale, order):
+    r = x0 / x
+    (rq, rh) = (r**order, r**(0.5*order))
+    bad = (r <= 0)
+    y  = np.where(bad, np.inf, scale * (1.0 + rq - 2.0*rh))
+    dy = np.where(bad, np.inf, -scale * order / x * (rq - rh))
+    return (y, dy)
+
+def _infinite_well_shape(x, x0, scale, mn, mx, order):
+    tl = ((x0 - mn) / (x - mn))**order
+    tr = ((mx - x0) / (mx - x))**order
+    bad = (x <= mn) | (x >= mx)
+    y  = np.where(bad, np.inf, scale * ((tr - 1.0)**2 + (tl - 1.0)**2))
+    dy = np.where(bad, np.inf,
+                  2.0 * scale * order * (tl*(tl - 1.0)/(mn - x) + tr*(tr - 1.0)/(mx - x)))
+    return (y, dy)
+
+def _gaussian_shape(x, x0, scale, sigma, order):
+    x = (x - x0) / sigma
+    ex = np.exp(-0.5 * x**order)
+    # note that, as in nben's GaussianFunction, the derivative is not divided by sigma
+    return (scale * (1.0 - ex), 0.5 * scale * order * x**(order - 1.0) * ex)
+
+# Measure functions ################################################################################
+# Each of these yields the tuple (M, G) of the measures of the simplices in the (s x m) matrix S
+# given the (d x n) coordinate matrix X, and a tuple of s (d x m) matrices, the gradients of the
+# measures in terms of the s vertices of each simplex; see the nben.mesh.registration *Potential
+# classes.
+
+def _norms(x):
+    return np.sqrt(np.sum(x**2, axis=0))
+
+def _edge_measure(X, S):
+    dx = X[:, S[1]] - X[:, S[0]]
+    d = _norms(dx)
+    g = dx / np.where(np.abs(d) < _zero_tol, 1.0, d)
+    return (d, (-g, g))
+
+def _angle_measure(X, S):
+    (A, B, C) = (X[:, S[0]], X[:, S[1]], X[:, S[2]])
+    (ab, ac) = (B - A, C - A)
+    (dab, dac) = (_norms(ab), _norms(ac))
+    (nab, nac) = (ab / dab, ac / dac)
+    if X.shape[0] == 2:
+        theta = np.arctan2(ac[1], ac[0]) - np.arctan2(ab[1], ab[0])
+    else:
+        # the angle is measured in the plane tangent to the sphere at A
+        az = A / _norms(A)
+        ay = np.cross(az, nab, axisa=0, axisb=0, axisc=0)
+        ay /= _norms(ay)
+        ax = np.cross(ay, az, axisa=0, axisb=0, axisc=0)
+        theta = (np.arctan2(np.sum(ac*ay, axis=0), np.sum(ac*ax, axis=0))
+                 - np.arctan2(0.0, dab * np.sum(nab*ax, axis=0)))
+    theta = np.where(theta < -pi, theta + 2*pi, np.where(theta > pi, theta - 2*pi, theta))
+    cos = np.cos(theta)
+    sin = np.sqrt(1.0 - cos*cos)
+    g1 = (cos*nab - nac) / (sin*dab)
+    g2 = (cos*nac - nab) / (sin*dac)
+    return (theta, (-(g1 + g2), g1, g2))
+
+def _anchor_measure(X, S, points):
+    g = X[:, S[0]] - points
+    d = _norms(g)
+    return (d, (g / np.where(d > 0, d, 1.0),))
+
+def _mesh_field_locate(fdat, pts):
+    # yields (ids, bc, near) for the (n x 2) points pts in the field mesh; points outside the mesh
+    # are moved to the nearest point on its boundary (and near is True for them)
+    mesh = fdat['mesh']
+    (ids, bc) = mesh.point_location(pts)
+    ids = np.array(ids)
+    near = (ids < 0)
+    miss = np.where(near)[0]
+    (E, F) = (fdat['boundary_edges'], fdat['boundary_faces'])
+    if len(miss) > 0 and len(F) > 0:
+        (a, b) = (mesh.coordinates[E[:,0]], mesh.coordinates[E[:,1]])
+        ab = b - a
+        ab2 = np.sum(ab**2, axis=1)
+        ab2[ab2 == 0] = 1
+        for ii in range(0, len(miss), 4096):
+            ss = miss[ii:ii+4096]
+            # project each point onto each boundary segment
+            t = np.clip((np.dot(pts[ss], ab.T) - np.sum(a*ab, axis=1)) / ab2, 0, 1)
+            q = a[None,:,:] + t[:,:,None]*ab[None,:,:]
+            k = np.argmin(np.sum((q - pts[ss][:,None,:])**2, axis=2), axis=1)
+            tk = t[np.arange(len(ss)), k]
+            tri = mesh.triangles[F[k]]
+            ids[ss] = F[k]
+            bc[ss] = ((tri == E[k,0][:,None]) * (1.0 - tk)[:,None]
+                      + (tri == E[k,1][:,None]) * tk[:,None])
+    return (ids, bc, near)
+
+def _mesh_field_measure(X, S, fdat):
+    vals = fdat['values']
+    (k, n) = (vals.shape[0], S.shape[1] // vals.shape[0])
+    (ids, bc, near) = _mesh_field_locate(fdat, X[:2, S[0,:n]].T)
+    found = (ids >= 0)
+    M = np.zeros((k, n))
+    tri = fdat['mesh'].triangles[ids[found]]
+    for j in range(k): M[j, found] = np.sum(bc[found] * vals[j][tri], axis=1)
+    # the gradient is that of the plane of the triangle containing the point; it is 0 outside
+    g = np.zeros((X.shape[0], k, n))
+    inside = found & ~near
+    g[:2][:, :, inside] = np.transpose(fdat['gradients'][:, ids[inside]], (2, 0, 1))
+    return (M.flatten(), (g.reshape((X.shape[0], k*n)),))
+
+def _mesh_field_data(coords, faces, values):
+    # prepares the data used by _mesh_field_measure for the given field mesh
+    coords = np.asarray(coords, dtype=np.float64)
+    faces = np.asarray(faces, dtype=np.int64)
+    coords = coords if coords.shape[1] == 2 else coords.T
+    faces = faces if faces.shape[1] == 3 else faces.T
+    values = np.asarray(values, dtype=np.float64)
+    values = values if len(values.shape) == 2 else values[None,:]
+    mesh = Mesh(faces, coords)
+    T = mesh.triangles
+    # the boundary edges are those that appear in only one triangle
+    es = np.sort(np.concatenate([T[:,[0,1]], T[:,[1,2]], T[:,[2,0]]]), axis=1)
+    (_, inv, cnt) = np.unique(es, axis=0, return_inverse=True, return_counts=True)
+    bnd = np.where(cnt[inv] == 1)[0]
+    # the plane gradient of each value over each triangle
+    P = mesh.coordinates[T]
+    (a, b) = (P[:,1] - P[:,0], P[:,2] - P[:,0])
+    V = values[:, T]
+    (av, bv) = (V[:,:,1] - V[:,:,0], V[:,:,2] - V[:,:,0])
+    n0 = a[:,1]*bv - av*b[:,1]
+    n1 = av*b[:,0] - a[:,0]*bv
+    n2 = a[:,0]*b[:,1] - a[:,1]*b[:,0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        grads = np.stack((-n0/n2, -n1/n2), axis=-1)
+    return {'mesh':           mesh,
+            'values':         values,
+            'gradients':      grads,
+            'boundary_edges': es[bnd],
+            'boundary_faces': bnd % T.shape[0]}
+
+# Field terms ######################################################################################
+
+class PotentialTerm(object):
+    '''
+    PotentialTerm(measure, simplices, shape, params, reference) represents a single potential field
+    term over the simplices (edges, angles, or vertices) in the (s x m) matrix of vertex indices,
+    simplices; the potential of the term is the sum over the simplices of shape(x, reference,
+    *params) where x is the simplex measure (e.g., the edge length) given by the measure function.
+    PotentialTerm objects should generally be created by numpy_potential_term.
+    '''
+    def __init__(self, measure, simplices, shape, params, reference, key=None):
+        self.measure = measure
+        self.simplices = simplices
+        self.shape = shape
+        self.params = params
+        self.reference = reference
+        # terms with the same key share the evaluation of their measure
+        self.key = id(self) if key is None else key
+
+def _faces_to_edges(F):
+    # yields the (2 x m) matrix of edges for the (3 x p) face or (2 x m) edge matrix F
+    F = np.asarray(F, dtype=np.int64)
+    if F.shape[0] != 3: return F
+    es = np.sort(np.hstack([F[[0,1]], F[[1,2]], F[[2,0]]]).T, axis=1)
+    return np.unique(es, axis=0).T
+
+def _faces_to_angles(F):
+    # yields the (3 x 3p) matrix of angles (see nben.mesh.registration.Util.facesToAngles)
+    F = np.asarray(F, dtype=np.int64)
+    return np.hstack([F[[j, (j + 1) % 3, (j + 2) % 3]] for j in range(3)])
+
+def _perimeter(F):
+    # yields the vertices on the perimeter of the mesh with the (3 x p) face matrix F
+    es = np.sort(np.hstack([F[[0,1]], F[[1,2]], F[[2,0]]]).T, axis=1)
+    (u, cnt) = np.unique(es, axis=0, return_counts=True)
+    perim = np.unique(u[cnt % 2 == 1])
+    if len(perim) == 0: raise ValueError('mesh has no perimeter')
+    return perim
+
+def _term_params(params, count, tile=1):
+    # the first param is always the scale, which nben divides by the number of simplices
+    params = [np.asarray(p, dtype=np.float64) for p in params]
+    params = [np.tile(p, tile) if len(p.shape) > 0 else p for p in params]
+    return [params[0] / count] + params[1:]
+
+def _simplex_term(measure, S, X, shape, params, count=None, tile=1):
+    S = np.asarray(S, dtype=np.int64)
+    ref = _simplex_measures[measure](X, S)[0]
+    return PotentialTerm(measure, S, shape,
+                         _term_params(params, S.shape[1] if count is None else count, tile),
+                         ref, key=(measure, id(S)))
+
+def _edge_term(shape, params, E, X):
+    return _simplex_term('edge', _faces_to_edges(E), X, shape, params)
+
+def _angle_term(shape, params, F, X):
+    return _simplex_term('angle', _faces_to_angles(F), X, shape, params, tile=3)
+
+def _anchor_term(shape, params, vertices, points, X):
+    vertices = np.asarray(vertices, dtype=np.int64).flatten()
+    points = np.asarray(points, dtype=np.float64)
+    if points.shape[0] != X.shape[0] and points.shape[1] == X.shape[0]: points = points.T
+    if points.shape != (X.shape[0], len(vertices)):
+        raise ValueError('anchor points must be a (dims x n) matrix for n vertices')
+    return PotentialTerm(('anchor', points), vertices[None,:], shape,
+                         _term_params(params, len(vertices)), 0.0)
+
+def _perimeter_term(scale, shape, F, X):
+    perim = _perimeter(np.asarray(F, dtype=np.int64))
+    return _anchor_term(_harmonic_shape, [scale, shape], perim, X[:, perim], X)
+
+def _mesh_field_term(shape, params, coords, faces, values, vertices, vertex_values, X):
+    fdat = _mesh_field_data(coords, faces, values)
+    k = fdat['values'].shape[0]
+    vertices = np.asarray(vertices, dtype=np.int64).flatten()
+    vertex_values = np.asarray(vertex_values, dtype=np.float64).reshape((k, len(vertices)))
+    return PotentialTerm(('mesh-field', fdat), np.tile(vertices, k)[None,:], shape,
+                         _term_params(params, len(vertices), tile=k), vertex_values.flatten())
+
+def _standard_mesh_terms(edge_scale, angle_scale, F, X):
+    terms = [_angle_term(_infinite_well_shape, [angle_scale, 0.0, pi, 0.5], F, X),
+             _edge_term(_harmonic_shape, [edge_scale, 2.0], F, X)]
+    if X.shape[0] == 2: terms.append(_perimeter_term(1.0, 2.0, F, X))
+    return terms
+
+_simplex_measures = {'edge': _edge_measure, 'angle': _angle_measure}
+
+# The builders for each of the nben.mesh.registration.Fields methods named in the
+# registration.core._parse_field_data_types table; each yields a list of PotentialTerm objects
+_numpy_field_builders = {
+    'newStandardMeshPotential':   _standard_mesh_terms,
+    'newHarmonicEdgePotential':   lambda s,q,E,X: [_edge_term(_harmonic_shape, [s,q], E, X)],
+    'newLJEdgePotential':         lambda s,q,E,X: [_edge_term(_lennard_jones_shape, [s,q], E, X)],
+    'newWellEdgePotential':       lambda s,q,mn,mx,E,X: [
+        _edge_term(_infinite_well_shape, [s,mn,mx,q], E, X)],
+    'newHarmonicAnglePotential':  lambda s,q,F,X: [_angle_term(_harmonic_shape, [s,q], F, X)],
+    'newLJAnglePotential':        lambda s,q,F,X: [_angle_term(_lennard_jones_shape, [s,q], F, X)],
+    'newWellAnglePotential':      lambda s,q,mn,mx,F,X: [
+        _angle_term(_infinite_well_shape, [s,mn,mx,q], F, X)],
+    'newHarmonicAnchorPotential': lambda s,q,u,p,X: [_anchor_term(_harmonic_shape, [s,q], u, p, X)],
+    'newGaussianAnchorPotential': lambda s,sig,q,u,p,X: [
+        _anchor_term(_gaussian_shape, [s,sig,q], u, p, X)],
+    'newHarmonicMeshPotential':   lambda s,q,c,f,v,u,uv,X: [
+        _mesh_field_term(_harmonic_shape, [s,q], c, f, v, u, uv, X)],
+    'newGaussianMeshPotential':   lambda s,sig,q,c,f,v,u,uv,X: [
+        _mesh_field_term(_gaussian_shape, [s,sig,q], c, f, v, u, uv, X)],
+    'newHarmonicPerimeterPotential': lambda s,q,F,X: [_perimeter_term(s, q, F, X)]}
+
+# The potential field ##############################################################################
+
+class PotentialField(object):
+    '''
+    PotentialField(terms, vertex_count) represents the sum of the given list of PotentialTerm
+    objects over a mesh with the given number of vertices. PotentialField objects should generally
+    be created by numpy_potential_field.
+
+    The potential field f may be called as f(X) for a (dims x n) coordinate matrix X, in which case
+    the tuple (potential, gradient) is yielded. The terms are evaluated in a single pass: terms over
+    the same simplices share the evaluation of the simplex measures, and the gradients of all terms
+    are accumulated with a single scatter-add per dimension. Like the nben potential fields, f also
+    has a method f.calculate(X, G) that adds the gradient into the matrix G and yields the
+    potential.
+    '''
+    def __init__(self, terms, vertex_count):
+        self.terms = list(terms)
+        self.vertex_count = vertex_count
+    def __call__(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        # groups maps each term key to [simplices, measure gradients, summed dy, measures]
+        groups = {}
+        order = []
+        pe = 0.0
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            for t in self.terms:
+                if t.key not in groups:
+                    if isinstance(t.measure, tuple):
+                        (mtype, mdata) = t.measure
+                        mfn = _anchor_measure if mtype == 'anchor' else _mesh_field_measure
+                        (M, grads) = mfn(X, t.simplices, mdata)
+                    else:
+                        (M, grads) = _simplex_measures[t.measure](X, t.simplices)
+                    groups[t.key] = [t.simplices, grads, 0.0, M]
+                    order.append(t.key)
+                grp = groups[t.key]
+                (y, dy) = t.shape(grp[3], t.reference, *t.params)
+                # as with nben's PotentialSum, the first non-finite potential is the result
+                if np.isfinite(pe): pe += np.sum(y)
+                grp[2] = grp[2] + dy
+            # accumulate the gradients of all terms in one pass
+            idx = np.concatenate([S.flatten() for k in order for S in [groups[k][0]]])
+            grs = np.concatenate([g * groups[k][2] for k in order for g in groups[k][1]], axis=1)
+        G = np.asarray([np.bincount(idx, weights=gr, minlength=self.vertex_count) for gr in grs])
+        return (pe, G)
+    def calculate(self, X, G=None):
+        '''
+        f.calculate(X, G) yields the potential of the potential field f at the (dims x n) coordinate
+        matrix X and adds the gradient into the matrix G, if G is not None.
+        '''
+        (pe, grad) = self(X)
+        if G is not None: G += grad
+        return pe
+
+def _numpy_field_terms(instruct, faces, edges, coords):
+    # the NumPy equivalent of registration.core._parse_field_argument; yields a list of terms
+    (method_name, argdescs, instargs) = _parse_field_instruction(instruct)
+    args = [_parse_field_function_argument(a, instargs, faces, edges, coords, convert=np.asarray)
+            for a in argdescs]
+    return _numpy_field_builders[method_name](*args)
+
+def numpy_potential_field(mesh, field):
+    '''
+    numpy_potential_field(mesh, field) yields a PotentialField object that implements, using NumPy,
+    the potential field described by the given list of field instructions for the given mesh; the
+    field argument is parsed identically to the field argument of mesh_register, and the resulting
+    potential and gradient match those of the nben library's Java potential fields. The potential
+    field f may be called as f(X) to obtain the tuple (potential, gradient) at the coordinate matrix
+    X. See also validate_numpy_potential.
+    Because they match nben's, two of the gradients are not the exact derivatives of the potential:
+    the gradient of a 'Gaussian' term is sigma times the derivative of its potential (nben does not
+    divide the derivative of the Gaussian by sigma), and the gradient of an angle term on a 3D
+    (spherical) mesh is that of the planar angle between the two edges, whereas the angle itself is
+    measured in the plane tangent to the sphere.
+    '''
+    if not isinstance(field, list):
+        raise RuntimeError('field argument must be a list of instructions')
+    faces  = np.asarray(mesh.indexed_faces, dtype=np.int64)
+    edges  = np.asarray(mesh.indexed_edges, dtype=np.int64)
+    coords = np.asarray(mesh.coordinates, dtype=np.float64)
+    terms = [t for instruct in field for t in _numpy_field_terms(instruct, faces, edges, coords)]
+    return PotentialField(terms, coords.shape[1])
+
+def numpy_potential_term(mesh, instructions):
+    '''
+    numpy_potential_term(mesh, instructions) yields a PotentialField object that implements the
+    potential field described in the given single term's instructions; it is the NumPy equivalent
+    of java_potential_term(mesh, instructions).
+    '''
+    return numpy_potential_field(mesh, [instructions])
+
+def validate_numpy_potential(mesh, field, coordinates=None):
+    '''
+    validate_numpy_potential(mesh, field) evaluates the potential field described by the given list
+    of field instructions (see mesh_register) using both numpy_potential_field and the nben
+    library's Java potential fields and yields a dictionary of the results: numpy_potential and
+    java_potential are the potential values, potential_error is the relative difference between
+    them, and gradient_error is the maximum absolute difference between the gradients relative to
+    the largest Java gradient component. The optional argument coordinates specifies the (dims x n)
+    coordinate matrix at which the potentials are evaluated; by default this is
+    mesh.coordinates.
+    '''
+    X = np.asarray(mesh.coordinates if coordinates is None else coordinates, dtype=np.float64)
+    (pe, G) = numpy_potential_field(mesh, field)(X)
+    with java_gateway():
+        jX = to_java_doubles(X)
+        jG = to_java_doubles(np.zeros(X.shape))
+        jpe = 0.0
+        for instruct in field:
+            jpe += java_potential_term(mesh, instruct).calculate(jX, jG)
+        jG = from_java_doubles(jG)
+    return {'numpy_potential': pe,
+            'java_potential':  jpe,
+            'potential_error': abs(pe - jpe) / max(abs(jpe), _zero_tol),
+            'gradient_error':  np.max(np.abs(G - jG)) / max(np.max(np.abs(jG)), _zero_tol)}
@@ -0,0 +1,260 @@
+####################################################################################################
+# registration/minimizer.py
+# A NumPy implementation of the gradient-descent minimizers of the nben library's
+# nben.mesh.registration.Minimizer class and an L-BFGS minimizer; these operate on the
+# PotentialField objects of the registration.fields module or on any function of the same form.
+# By Noah C. Benson
+
+import numpy as np
+from scipy.optimize import minimize
+from .fields import _zero_tol
+
+class MinimizationReport(object):
+    '''
+    MinimizationReport(initial_potential) is a record of the trajectory of a minimization, as
+    performed by minimize_potential; it mirrors the nben library's Minimizer.Report class. The
+    report's members initial_potential, final_potential, and steps give the potential before and
+    after the minimization and the number of steps taken; the members step_sizes, step_lengths,
+    steepest_vertex_gradient_norms, and potential_changes are arrays with one value per step. The
+    evaluations member gives the number of times the potential field was evaluated.
+    '''
+    def __init__(self, initial_potential):
+        self.initial_potential = initial_potential
+        self.final_potential = initial_potential
+        self.steps = 0
+        self.evaluations = 0
+        self._trajectory = []
+    def push(self, step_size, step_length, max_norm, potential_change):
+        '''
+        report.push(step_size, step_length, max_norm, potential_change) records a single step of
+        the minimization in the given report.
+        '''
+        self._trajectory.append((step_size, step_length, max_norm, potential_change))
+        self.steps += 1
+    def freeze(self, final_potential):
+        '''
+        report.freeze(final_potential) records the final potential of the minimization and
+        converts the trajectory of the report into arrays.
+        '''
+        self.final_potential = final_potential
+        traj = np.reshape(np.asarray(self._trajectory, dtype=np.float64), (-1, 4)).T
+        (self.step_sizes, self.step_lengths,
+         self.steepest_vertex_gradient_norms, self.potential_changes) = traj
+        return self
+
+def _potential_value(pfn, X):
+    # yields (pe, G, norms, gradient length) for the potential field pfn at X
+    (pe, G) = pfn(X)
+    norms = np.sqrt(np.sum(G**2, axis=0))
+    return (pe, G, norms, np.sqrt(np.sum(G**2)))
+
+def _check_initial_potential(pe):
+    if np.isnan(pe):
+        raise ValueError('Initial state has a NaN potential')
+    elif not np.isfinite(pe):
+        raise ValueError('Initial state has a non-finite potential')
+
+def _pure_steps(pfn, X, max_pe_change, max_steps, z):
+    # mirrors nben.mesh.registration.Minimizer.step
+    (pe, G, norms, glen) = _potential_value(pfn, X)
+    _check_initial_potential(pe)
+    (pe0, petry, k) = (pe, pe, 0)
+    rep = MinimizationReport(pe0)
+    max_norm = np.max(norms)
+    try:
+        while (1.0 - pe/pe0) < max_pe_change and k < max_steps:
+            if abs(max_norm) < _zero_tol: break
+            dt = z / max_norm
+            while True:
+                if abs(dt) < _zero_tol:
+                    if abs(petry - pe) < _zero_tol:
+                        k = max_steps
+                        break
+                    raise RuntimeError('Step-size decreased to effectively 0 at step %d' % k)
+                Xtry = X - dt*G
+                (petmp, Gtmp, normstmp, glentmp) = _potential_value(pfn, Xtry)
+                if np.isnan(petmp):
+                    raise RuntimeError('Potential function yielded NaN')
+                elif not np.isfinite(petmp) or petmp >= pe or glentmp >= glen:
+                    dt *= 0.5
+                    petry = pe
+                else:
+                    k += 1
+                    (X, G, norms) = (Xtry, Gtmp, normstmp)
+                    max_norm = np.max(norms)
+                    rep.push(dt, glentmp * dt, max_norm, petmp - pe)
+                    (pe, glen, petry) = (petmp, glentmp, petmp)
+                    break
+    finally:
+        rep.freeze(pe)
+    return (X, rep)
+
+def _random_steps(pfn, X, max_pe_change, max_steps, z, inv, random_state):
+    # mirrors nben.mesh.registration.Minimizer.randomStep
+    (pe, G, norms, glen) = _potential_value(pfn, X)
+    _check_initial_potential(pe)
+    (pe0, petry, k) = (pe, pe, 0)
+    rep = MinimizationReport(pe0)
+    max_norm = np.max(norms)
+    try:
+        while (1.0 - pe/pe0) < max_pe_change and k < max_steps:
+            if abs(max_norm) < _zero_tol: break
+            zero = np.abs(norms) < _zero_tol
+            with np.errstate(divide='ignore'):
+                mu = norms/z if inv else z/norms
+            dt = np.where(zero, 0.0, -np.log(1.0 - random_state.random_sample(len(norms))) * mu)
+            tot = np.sum(dt)
+            while True:
+                if abs(tot) < _zero_tol:
+                    if abs(petry - pe) < _zero_tol:
+                        k += 1
+                        break
+                    raise RuntimeError('Step-size decreased to effectively 0 at step %d' % k)
+                Xtry = X - dt*G
+                (petmp, Gtmp, normstmp, glentmp) = _potential_value(pfn, Xtry)
+                if np.isnan(petmp):
+                    raise RuntimeError('Potential function yielded NaN')
+                elif not np.isfinite(petmp) or petmp >= pe:
+                    dt *= 0.5
+                    tot = np.sum(dt)
+                    petry = pe
+                else:
+                    k += 1
+                    (X, G, norms) = (Xtry, Gtmp, normstmp)
+                    max_norm = np.max(norms)
+                    rep.push(z, glentmp * z, max_norm, petmp - pe)
+                    (pe, petry) = (petmp, petmp)
+                    break
+    finally:
+        rep.freeze(pe)
+    return (X, rep)
+
+# the relative reduction in the potential below which scipy's L-BFGS-B considers itself converged
+_lbfgs_ftol = 1e7 * np.finfo(np.float64).eps
+
+class _LBFGSStop(Exception):
+    # raised by the L-BFGS callback to end the minimization
+    pass
+
+class _LBFGSRestart(Exception):
+    # raised by the L-BFGS callback to restart the minimization from the current state
+    pass
+
+def _lbfgs_steps(pfn, X, max_pe_change, max_steps, z):
+    # drives scipy's L-BFGS-B minimizer such that no vertex moves farther than z in an iteration:
+    # * the coordinates are scaled by 1/z so that the first step of each run moves the vertices by a
+    #   total distance of z;
+    # * at a trial point x that moves a vertex farther than z from the current iterate X, the
+    #   potential is that at the point xb = X + (x - X) z/d, where d is the largest vertex distance,
+    #   plus the penalty c (d/z - 1)^2; this is continuous, and its exact gradient is yielded;
+    # * if the minimizer accepts such a point, the iterate becomes xb and the run is restarted;
+    # * non-finite potentials are replaced by the current potential plus c (1 + (d/z)^2).
+    shape = X.shape
+    (pe, G, norms, glen) = _potential_value(pfn, X)
+    _check_initial_potential(pe)
+    pe0 = pe
+    rep = MinimizationReport(pe0)
+    # state holds the current iterate and its potential; last holds the most recent evaluation as
+    # the tuple (trial point, actual point, potential, gradient norms)
+    state = {'X': X, 'pe': pe, 'last': (X, X, pe, norms)}
+    def fn(u):
+        x = z * np.reshape(u, shape)
+        dx = x - state['X']
+        dnorms = np.sqrt(np.sum(dx**2, axis=0))
+        k = np.argmax(dnorms)
+        d = dnorms[k]
+        c = abs(state['pe']) + 1.0
+        xb = x if d <= z else state['X'] + dx * (z/d)
+        (pe, G) = pfn(xb)
+        if np.isnan(pe): raise RuntimeError('Potential function yielded NaN')
+        if not np.isfinite(pe):
+            G = np.zeros(shape)
+            G[:,k] = 2.0 * c * dx[:,k] / (z*z)
+            return (state['pe'] + c * (1.0 + (d/z)**2), z * G.flatten())
+        state['last'] = (x, xb, pe, np.sqrt(np.sum(G**2, axis=0)))
+        if d > z:
+            t = d/z - 1.0
+            dd = dx[:,k] / d
+            G = G * (z/d)
+            G[:,k] += (2.0 * c * t / z - np.sum(dx * G) / d) * dd
+            pe += c * t * t
+        return (pe, z * G.flatten())
+    def callback(u):
+        x = z * np.reshape(u, shape)
+        (xl, xb, pe, norms) = state['last']
+        if not np.array_equal(x, xl):
+            # the accepted point was not the last one evaluated, so it is clipped here as in fn
+            dx = x - state['X']
+            d = np.max(np.sqrt(np.sum(dx**2, axis=0)))
+            xl = x
+            xb = x if d <= z else state['X'] + dx * (z/d)
+            (pe, _, norms, _) = _potential_value(pfn, xb)
+        dx = xb - state['X']
+        dnorms = np.sqrt(np.sum(dx**2, axis=0))
+        rep.push(np.max(dnorms), np.sqrt(np.sum(dx**2)), np.max(norms), pe - state['pe'])
+        state['X'] = np.array(xb)
+        state['pe'] = pe
+        if (1.0 - pe/pe0) >= max_pe_change: raise _LBFGSStop()
+        if xb is not xl: raise _LBFGSRestart()
+    try:
+        while rep.steps < max_steps:
+            pe_start = state['pe']
+            try:
+                minimize(fn, state['X'].flatten() / z, jac=True, method='L-BFGS-B',
+                         callback=callback,
+                         options={'maxiter': max_steps - rep.steps, 'maxfun': 20*max_steps,
+                                  'gtol': 1e-5 * z})
+            except _LBFGSRestart:
+                continue
+            # scipy's convergence test can stop the minimizer after a step that the step-size limit
+            # cut short, so we restart from the current point until a restart makes no progress
+            if pe_start - state['pe'] <= _lbfgs_ftol * max(abs(pe_start), abs(state['pe']), 1):
+                break
+    except _LBFGSStop:
+        pass
+    finally:
+        rep.freeze(state['pe'])
+    return (state['X'], rep)
+
+def minimize_potential(pfn, X0, method='random', max_pe_change=1, max_steps=2000,
+                       max_step_size=0.05, random_state=None):
+    '''
+    minimize_potential(pfn, X0) minimizes the potential field pfn, which must be a function such
+    that pfn(X) yields the tuple (potential, gradient) for the (dims x n) coordinate matrix X (see
+    numpy_potential_field), starting from the coordinate matrix X0 and yields the tuple (X, report)
+    of the minimized coordinate matrix and a MinimizationReport object. The method,
+    max_pe_change, max_steps, and max_step_size options are as in mesh_register, including the
+    'lbfgs' method, except that the 'nimble' method is not supported. The random_state option may
+    be a seed or a numpy.random.RandomState object used by the 'random' method.
+    '''
+    X = np.array(X0, dtype=np.float64)
+    # count the potential field evaluations for the report
+    counter = [0]
+    def counted(X):
+        counter[0] += 1
+        return pfn(X)
+    (X, rep) = _minimize_potential(counted, X, method, max_pe_change, max_steps, max_step_size,
+                                   random_state)
+    if rep is not None: rep.evaluations = counter[0]
+    return (X, rep)
+
+def _minimize_potential(pfn, X, method, max_pe_change, max_steps, max_step_size, random_state):
+    if isinstance(method, basestring): (method, k) = (method.lower(), 0)
+    else: (method, k) = (method[0].lower(), method[1])
+    if max_pe_change <= 0 or max_steps < 1:
+        return (X, None)
+    if max_step_size <= 0:
+        raise ValueError('max_step_size must be a positive number')
+    if method == 'pure':
+        return _pure_steps(pfn, X, float(max_pe_change), int(max_steps), float(max_step_size))
+    elif method == 'random':
+        if not isinstance(random_state, np.random.RandomState):
+            random_state = np.random.RandomState(random_state)
+        return _random_steps(pfn, X, float(max_pe_change), int(max_steps), float(max_step_size),
+                             k == -1, random_state)
+    elif method == 'lbfgs':
+        return _lbfgs_steps(pfn, X, float(max_pe_change), int(max_steps), float(max_step_size))
+    elif method == 'nimble':
+        raise ValueError('The nimble method is only supported by the java registration backend')
+    else:
+        raise ValueError('Unrecognized method: %s' % method)
@@ -0,0 +1,13 @@
+####################################################################################################
+# neuropythy/test/__init__.py
+# Tests for the neuropythy library; these may be run with: python -m unittest neuropythy.test
+# By Noah C. Benson
+
+from .test_geometry     import (TestTriangleIndices, TestMeshAddresses,
+                                 TestChunkedInterpolation, TestKDTreeQueries)
+from .test_java         import (TestJavaPool)
+from .test_registration import (TestNumPyPotentialFields, TestLBFGSMinimizer,
+                                 TestRegistrationCheckpoints, TestBackgroundRegistration)
+from .test_topology     import (TestInterpolationCache)
+from .test_vision       import (TestSchiraModel, TestRetinotopyAnchors, TestRetinotopyCache,
+                                 TestRegistrationProlongation, TestRetinotopySweep)
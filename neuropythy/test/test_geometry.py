@@ -0,0 +1,198 @@
+####################################################################################################
+# neuropythy/test/test_geometry.py
+# Tests of the point location, addressing, and interpolation tools of the neuropythy.geometry
+# package.
+# By Noah C. Benson
+
+import unittest
+import numpy as np
+import scipy.spatial as space
+
+import neuropythy.geometry.util as geometry_util
+from neuropythy.geometry import (Mesh, SphericalTriangleIndex, PlanarTriangleIndex, kdtree_query,
+                                 kdtree_query_ball_point)
+from .test_registration  import (sphere_mesh)
+
+def plane_mesh(n=40, seed=0):
+    '''
+    plane_mesh() yields a tuple (triangles, coordinates) of the Delaunay triangulation of n random
+    points in the unit square, as (m x 3) and (n x 2) matrices.
+    '''
+    X = np.random.RandomState(seed).uniform(0, 1, (n, 2))
+    return (space.Delaunay(X).simplices, X)
+
+def edge_midpoints(T, X):
+    '''
+    edge_midpoints(T, X) yields the midpoints of the first edge of each triangle in T.
+    '''
+    return 0.5 * (X[T[:,0]] + X[T[:,1]])
+
+class TestTriangleIndices(unittest.TestCase):
+    '''
+    The TestTriangleIndices class tests the spherical and planar triangle indices against a
+    brute-force search of all triangles.
+    '''
+    tolerance = 1e-9
+
+    def assertLocated(self, P, ids, bc, brute):
+        # brute(p) yields the (m x 3) barycentric coordinates of p in every triangle
+        for (p, tid, b) in zip(P, ids, bc):
+            allbc = brute(p)
+            hits = np.where(np.all(allbc >= -self.tolerance, axis=1))[0]
+            if len(hits) == 0:
+                self.assertEqual(tid, -1, 'point %s is in no triangle but was located' % (p,))
+                self.assertTrue(np.all(b == 0))
+            else:
+                self.assertIn(tid, hits, 'point %s was located in the wrong triangle' % (p,))
+                self.assertTrue(np.allclose(b, allbc[tid], atol=1e-9))
+
+    def test_spherical(self):
+        mesh = sphere_mesh(1.0)
+        (T, X) = (np.asarray(mesh.indexed_faces).T, np.asarray(mesh.coordinates).T)
+        rs = np.random.RandomState(0)
+        U = rs.normal(0, 1, (200, 3))
+        U /= np.sqrt(np.sum(U**2, axis=1))[:,None]
+        # random directions at various radii, the vertices, and points on the triangles' edges
+        P = np.vstack([U * rs.uniform(0.5, 2.0, (200, 1)), X, edge_midpoints(T, X)])
+        tx = X[T]
+        def brute(p):
+            # the ray through p hits a triangle where p = w0 a + w1 b + w2 c with all w >= 0
+            w = np.linalg.solve(np.transpose(tx, (0,2,1)), np.tile(p, (len(T), 1)))
+            return w / np.sum(w, axis=1)[:,None]
+        idx = SphericalTriangleIndex(T, X, center=np.zeros(3))
+        (ids, bc) = idx.locate(P)
+        self.assertLocated(P, ids, bc, brute)
+        self.assertTrue(np.all(ids >= 0))
+        # the center of the sphere is in no triangle
+        (tid, b) = idx.locate(np.zeros(3))
+        self.assertEqual(tid, -1)
+        # locating in chunks yields the same result
+        (cids, cbc) = SphericalTriangleIndex(T, X, center=np.zeros(3), chunk_size=17).locate(P)
+        self.assertTrue(np.array_equal(ids, cids) and np.array_equal(bc, cbc))
+
+    def test_planar(self):
+        (T, X) = plane_mesh()
+        rs = np.random.RandomState(1)
+        # random points (some of which lie outside the convex hull), the vertices, points on the
+        # triangles' edges, and points far outside the mesh
+        P = np.vstack([rs.uniform(-0.2, 1.2, (300, 2)), X, edge_midpoints(T, X),
+                       [[5.0, 5.0], [-3.0, 0.5], [0.5, 1e3]]])
+        tx = X[T]
+        def brute(p):
+            (e1, e2, d) = (tx[:,1] - tx[:,0], tx[:,2] - tx[:,0], p - tx[:,0])
+            det = e1[:,0]*e2[:,1] - e1[:,1]*e2[:,0]
+            u = (d[:,0]*e2[:,1] - d[:,1]*e2[:,0]) / det
+            v = (e1[:,0]*d[:,1] - e1[:,1]*d[:,0]) / det
+            return np.transpose([1.0 - u - v, u, v])
+        idx = PlanarTriangleIndex(T, X)
+        (ids, bc) = idx.locate(P)
+        self.assertLocated(P, ids, bc, brute)
+        self.assertTrue(np.all(ids[-3:] == -1))
+        self.assertTrue(np.any(ids[:300] == -1))
+        (tid, b) = idx.locate(P[0])
+        self.assertEqual((tid, list(b)), (ids[0], list(bc[0])))
+        (cids, cbc) = PlanarTriangleIndex(T, X, resolution=3, chunk_size=17).locate(P)
+        self.assertTrue(np.array_equal(ids, cids) and np.allclose(bc, cbc))
+
+class TestMeshAddresses(unittest.TestCase):
+    '''
+    The TestMeshAddresses class tests that unaddressing the addresses of points yields the points.
+    '''
+    def setUp(self):
+        (T, X) = plane_mesh()
+        self.mesh = Mesh(T, X)
+        rs = np.random.RandomState(2)
+        # points inside the mesh: random convex combinations of the triangles' corners
+        w = rs.dirichlet([1, 1, 1], len(T))
+        self.points = np.sum(X[T] * w[:,:,None], axis=1)
+
+    def test_round_trip(self):
+        P = self.points
+        Q = self.mesh.unaddress(self.mesh.address(P))
+        self.assertTrue(np.allclose(Q.T, P))
+        # compact addresses store float32 barycentric coordinates
+        addr = self.mesh.address(P, compact=True)
+        self.assertEqual(addr.dtype.names, ('face_id', 'coordinates'))
+        self.assertTrue(np.allclose(self.mesh.unaddress(addr).T, P, atol=1e-6))
+
+    def test_single_point(self):
+        p = self.points[3]
+        self.assertTrue(np.allclose(self.mesh.unaddress(self.mesh.address(p)), p))
+        addr = self.mesh.address(p, compact=True)
+        self.assertEqual(addr.shape, ())
+        self.assertTrue(np.allclose(self.mesh.unaddress(addr), p, atol=1e-6))
+        self.assertIsNone(self.mesh.address(np.asarray([5.0, 5.0])))
+
+    def test_outside_points(self):
+        P = np.vstack([self.points[:5], [[5.0, 5.0]]])
+        addr = self.mesh.address(P)
+        self.assertEqual(addr['face_id'][-1], -1)
+        Q = self.mesh.unaddress(addr).T
+        self.assertTrue(np.all(np.isnan(Q[-1])))
+        self.assertTrue(np.allclose(Q[:-1], P[:-1]))
+
+class TestChunkedInterpolation(unittest.TestCase):
+    '''
+    The TestChunkedInterpolation class tests that interpolating in chunks yields the same result as
+    interpolating all points at once.
+    '''
+    def setUp(self):
+        (T, X) = plane_mesh()
+        self.mesh = Mesh(T, X)
+        rs = np.random.RandomState(3)
+        # some of the points lie outside of the mesh and are given the null value
+        self.points = rs.uniform(-0.1, 1.1, (100, 2))
+        self.data = rs.uniform(0, 1, (3, len(X)))
+
+    def test_chunks(self):
+        for method in ['linear', 'nearest']:
+            for (data, null) in [(self.data[0], None), (self.data[0], np.nan),
+                                 (self.data, np.nan), (self.data.T, 0.0)]:
+                opts = {'method': method, 'null': null}
+                ref = self.mesh.interpolate(self.points, data, **opts)
+                for chunk_size in [1, 7, 100, 1000]:
+                    res = self.mesh.interpolate(self.points, data, chunk_size=chunk_size, **opts)
+                    self.assertEqual((res.shape, res.dtype), (ref.shape, ref.dtype))
+                    same = (res == ref) | (np.isnan(res.astype(np.float64))
+                                           & np.isnan(ref.astype(np.float64)))
+                    self.assertTrue(np.all(same), '%s chunks of %d differ' % (method, chunk_size))
+
+class TestKDTreeQueries(unittest.TestCase):
+    '''
+    The TestKDTreeQueries class tests the KD-tree query helpers that pass the number of workers
+    along to SciPy.
+    '''
+    def setUp(self):
+        rs = np.random.RandomState(4)
+        self.tree = space.cKDTree(rs.uniform(0, 1, (200, 3)))
+        self.points = rs.uniform(0, 1, (50, 3))
+
+    def test_query(self):
+        (d, i) = self.tree.query(self.points, k=3)
+        for n_jobs in [None, 1, 2, -1]:
+            for chunk_size in [None, 7]:
+                (dd, ii) = kdtree_query(self.tree, self.points, k=3, n_jobs=n_jobs,
+                                        chunk_size=chunk_size)
+                self.assertTrue(np.array_equal(d, dd) and np.array_equal(i, ii))
+        ref = self.tree.query_ball_point(self.points, 0.2)
+        res = kdtree_query_ball_point(self.tree, self.points, 0.2, n_jobs=2)
+        self.assertEqual([sorted(r) for r in ref], [sorted(r) for r in res])
+
+    def test_bad_arguments(self):
+        # errors of the query itself are not mistaken for an unsupported keyword
+        self.assertRaises(TypeError, kdtree_query, self.tree, self.points, n_jobs=2, bogus=1)
+        self.assertRaises(TypeError, kdtree_query_ball_point, self.tree, self.points, 0.2,
+                          n_jobs=2, bogus=1)
+
+    def test_keywords(self):
+        version = geometry_util._scipy_version
+        expected = {(0,15): (None, None),       (1,1): ('n_jobs', None),
+                    (1,2):  ('n_jobs', 'n_jobs'), (1,6): ('workers', 'workers')}
+        try:
+            for (v, kws) in expected.iteritems():
+                geometry_util._scipy_version = v
+                self.assertEqual(tuple(geometry_util._kdtree_workers_keyword(name)
+                                       for name in ['query', 'query_ball_point']),
+                                 kws)
+        finally:
+            geometry_util._scipy_version = version
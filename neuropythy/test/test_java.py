@@ -0,0 +1,61 @@
+####################################################################################################
+# neuropythy/test/test_java.py
+# Tests of the pool of JVM gateways of the neuropythy.java package.
+# By Noah C. Benson
+
+import unittest, threading
+
+import neuropythy.java as java
+from neuropythy.java   import (java_gateway, java_link, java_pool_size, set_java_pool_size)
+from .test_registration import (java_available)
+
+class TestJavaPool(unittest.TestCase):
+    '''
+    The TestJavaPool class tests that concurrent uses of java_gateway() acquire and release the
+    gateways of the pool consistently.
+    '''
+    def setUp(self):
+        if not java_available(): self.skipTest('no JVM is available')
+        self.prev = java_pool_size()
+    def tearDown(self):
+        set_java_pool_size(self.prev)
+
+    def pool_counts(self):
+        with java._java_lock:
+            return [(gw, n) for (gw, n) in java._java_pool]
+
+    def test_acquire_release(self):
+        set_java_pool_size(2)
+        nthreads = 8
+        (entered, done, lock) = (threading.Event(), threading.Event(), threading.Lock())
+        (held, errors) = ([], [])
+        def work():
+            try:
+                with java_gateway() as gw:
+                    self.assertIs(java_link(), gw)
+                    with lock:
+                        held.append(gw)
+                        if len(held) == nthreads: entered.set()
+                    done.wait(60)
+            except Exception as e:
+                errors.append(e)
+                entered.set()
+        ths = [threading.Thread(target=work) for _ in range(nthreads)]
+        for th in ths: th.start()
+        entered.wait(60)
+        try:
+            self.assertEqual(errors, [])
+            counts = self.pool_counts()
+            # every thread holds a gateway of the pool, and the pool has grown to its full size
+            self.assertEqual(len(counts), 2)
+            self.assertEqual(sum(n for (_, n) in counts), nthreads)
+            self.assertTrue(all(n > 0 for (_, n) in counts))
+            self.assertTrue(all(any(gw is h for (gw, _) in counts) for h in held))
+        finally:
+            done.set()
+            for th in ths: th.join(60)
+        self.assertEqual(errors, [])
+        self.assertEqual([n for (_, n) in self.pool_counts()], [0, 0])
+        # shrinking the pool shuts down the idle gateway
+        set_java_pool_size(1)
+        self.assertEqual(self.pool_counts(), [(java_link(), 0)])
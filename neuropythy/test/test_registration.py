@@ -0,0 +1,310 @@
+####################################################################################################
+# neuropythy/test/test_registration.py
+# Tests of the NumPy potential fields, minimizers, background registrations, and checkpoints of the
+# neuropythy.registration package.
+# By Noah C. Benson
+
+import unittest, os, shutil, tempfile, threading
+import numpy as np
+
+from neuropythy.cortex       import CorticalMesh
+from neuropythy.registration import (numpy_potential_field, validate_numpy_potential, mesh_register,
+                                     minimize_potential, potential_plateau,
+                                     save_registration_checkpoint, load_registration_checkpoint)
+
+_java_status = []
+def java_available():
+    '''
+    java_available() yields True if a JVM gateway can be launched (or is already running) and False
+    otherwise; tests that compare against the nben library are skipped when this is False.
+    '''
+    if not _java_status:
+        try:
+            from neuropythy.java import java_link
+            java_link()
+            _java_status.append(True)
+        except Exception:
+            _java_status.append(False)
+    return _java_status[0]
+
+def grid_mesh(n=6, jitter=0.1, seed=0):
+    '''
+    grid_mesh(n) yields a 2D CorticalMesh of an n x n grid of (jittered) points, each square of
+    which is split into two counter-clockwise triangles.
+    '''
+    rs = np.random.RandomState(seed)
+    g = np.arange(float(n))
+    (xx, yy) = np.meshgrid(g, g)
+    X = np.asarray([xx.flatten(), yy.flatten()]) + rs.uniform(-jitter, jitter, (2, n*n))
+    F = [[i + n*j, i+1 + n*j, i+1 + n*(j+1)] for i in range(n-1) for j in range(n-1)] \
+        + [[i + n*j, i+1 + n*(j+1), i + n*(j+1)] for i in range(n-1) for j in range(n-1)]
+    return CorticalMesh(X, np.asarray(F).T)
+
+def sphere_mesh(radius=100.0):
+    '''
+    sphere_mesh() yields a 3D CorticalMesh of the 42-vertex icosphere with the given radius.
+    '''
+    t = (1.0 + np.sqrt(5.0)) / 2.0
+    V = [[-1,t,0],[1,t,0],[-1,-t,0],[1,-t,0],[0,-1,t],[0,1,t],[0,-1,-t],[0,1,-t],
+         [t,0,-1],[t,0,1],[-t,0,-1],[-t,0,1]]
+    F = [[0,11,5],[0,5,1],[0,1,7],[0,7,10],[0,10,11],[1,5,9],[5,11,4],[11,10,2],[10,7,6],[7,1,8],
+         [3,9,4],[3,4,2],[3,2,6],[3,6,8],[3,8,9],[4,9,5],[2,4,11],[6,2,10],[8,6,7],[9,8,1]]
+    V = [np.asarray(v, dtype=np.float64) / np.linalg.norm(v) for v in V]
+    mids = {}
+    def mid(a, b):
+        k = (min(a,b), max(a,b))
+        if k not in mids:
+            V.append((V[a] + V[b]) / np.linalg.norm(V[a] + V[b]))
+            mids[k] = len(V) - 1
+        return mids[k]
+    F = [f for (a,b,c) in F for (ab,bc,ca) in [(mid(a,b), mid(b,c), mid(c,a))]
+         for f in [[a,ab,ca], [b,bc,ab], [c,ca,bc], [ab,bc,ca]]]
+    return CorticalMesh(radius * np.asarray(V).T, np.asarray(F).T)
+
+def finite_difference_gradient(f, X, h=1e-6):
+    '''
+    finite_difference_gradient(f, X) yields the central-difference gradient of the potential of
+    the potential field f at the coordinate matrix X.
+    '''
+    G = np.zeros(X.shape)
+    for i in range(X.shape[0]):
+        for j in range(X.shape[1]):
+            (a, b) = (np.array(X), np.array(X))
+            a[i,j] += h
+            b[i,j] -= h
+            G[i,j] = (f(a)[0] - f(b)[0]) / (2*h)
+    return G
+
+class TestNumPyPotentialFields(unittest.TestCase):
+    '''
+    The TestNumPyPotentialFields class tests the gradients of the NumPy potential fields against
+    finite differences and, when a JVM is available, the fields against the nben library's fields.
+    '''
+    def setUp(self):
+        rs = np.random.RandomState(1)
+        self.mesh = grid_mesh()
+        X0 = self.mesh.coordinates
+        self.X = X0 + rs.uniform(-0.15, 0.15, X0.shape)
+        ids = np.arange(0, X0.shape[1], 3)
+        pts = X0[:, ids] + 0.5
+        # a field mesh that contains the whole grid, with linear values
+        g = np.linspace(-2, 8, 7)
+        (xx, yy) = np.meshgrid(g, g)
+        fc = np.asarray([xx.flatten(), yy.flatten()])
+        ff = np.asarray(grid_mesh(7, 0).indexed_faces).T
+        fv = np.asarray([fc[0] + 2*fc[1], 0.5*fc[0] - fc[1]])
+        vv = rs.uniform(0, 5, (2, len(ids)))
+        ones = np.ones(len(ids))
+        self.fields = {
+            'mesh':                 ['mesh'],
+            'edge harmonic':        [['edge', 'harmonic', 'scale', 2.0, 'order', 3.0]],
+            'edge lennard-jones':   [['edge', 'lennard-jones']],
+            'edge infinite-well':   [['edge', 'infinite-well']],
+            'angle harmonic':       [['angle', 'harmonic']],
+            'angle lennard-jones':  [['angle', 'lennard-jones']],
+            'angle infinite-well':  [['angle', 'infinite-well']],
+            'perimeter':            [['perimeter', 'harmonic']],
+            'anchor harmonic':      [['anchor', 'harmonic', ids, pts, 'scale', 3.0]],
+            'mesh-field harmonic':  [['mesh-field', 'harmonic', fc.T, ff, fv, ids, vv,
+                                      'scale', ones, 'order', 2*ones]]}
+        # the fields whose gradient is sigma times the derivative of the potential
+        self.gaussian_fields = {
+            'anchor Gaussian':      (0.7, [['anchor', 'Gaussian', ids, pts,
+                                            'sigma', 0.7, 'scale', 2.0]]),
+            'mesh-field Gaussian':  (1.5, [['mesh-field', 'gaussian', fc.T, ff, fv, ids, vv,
+                                            'scale', ones, 'order', 2*ones, 'sigma', 1.5*ones]])}
+
+    def assertGradient(self, name, G, F, scale=1.0):
+        err = np.max(np.abs(G - scale*F)) / np.max(np.abs(scale*F))
+        self.assertLess(err, 1e-6,
+                        '%s gradient differs from finite differences by %g' % (name, err))
+
+    def test_gradients(self):
+        for (name, field) in self.fields.iteritems():
+            f = numpy_potential_field(self.mesh, field)
+            (pe, G) = f(self.X)
+            self.assertTrue(np.isfinite(pe), '%s potential is not finite' % name)
+            self.assertGradient(name, G, finite_difference_gradient(f, self.X))
+
+    def test_gaussian_gradient_scale(self):
+        # as in nben, the Gaussian gradient is not divided by sigma
+        for (name, (sigma, field)) in self.gaussian_fields.iteritems():
+            f = numpy_potential_field(self.mesh, field)
+            self.assertGradient(name, f(self.X)[1], finite_difference_gradient(f, self.X), sigma)
+
+    def test_sphere_gradients(self):
+        mesh = sphere_mesh()
+        X = mesh.coordinates + np.random.RandomState(2).uniform(-2, 2, mesh.coordinates.shape)
+        f = numpy_potential_field(mesh, [['edge', 'harmonic']])
+        self.assertGradient('sphere edge', f(X)[1], finite_difference_gradient(f, X))
+
+    def test_java_fields(self):
+        if not java_available(): self.skipTest('no JVM is available')
+        fields = dict(self.fields)
+        fields.update({k:v for (k,(_,v)) in self.gaussian_fields.iteritems()})
+        cases = [(self.mesh, self.X, name, field) for (name, field) in fields.iteritems()]
+        mesh = sphere_mesh()
+        X = mesh.coordinates + np.random.RandomState(2).uniform(-2, 2, mesh.coordinates.shape)
+        cases += [(mesh, X, 'sphere %s %s' % tuple(k), [k])
+                  for k in [['edge', 'harmonic'], ['angle', 'harmonic'],
+                            ['angle', 'infinite-well']]]
+        for (mesh, X, name, field) in cases:
+            res = validate_numpy_potential(mesh, field, X)
+            self.assertLess(res['potential_error'], 1e-10, name)
+            self.assertLess(res['gradient_error'], 1e-10, name)
+
+class TestLBFGSMinimizer(unittest.TestCase):
+    '''
+    The TestLBFGSMinimizer class tests the NumPy backend's 'lbfgs' method against its step-size
+    limit and against the 'random' method.
+    '''
+    def field(self, offset):
+        mesh = grid_mesh()
+        ids = np.arange(0, mesh.coordinates.shape[1], 3)
+        pts = mesh.coordinates[:, ids] + offset
+        f = numpy_potential_field(mesh, ['mesh', ['anchor', 'harmonic', ids, pts, 'scale', 2.0]])
+        return (f, mesh.coordinates)
+
+    def test_step_size(self):
+        # the anchors are far enough away that most steps are cut short by the step-size limit
+        (f, X0) = self.field(2.0)
+        for z in [0.05, 0.2]:
+            (X, rep) = minimize_potential(f, X0, method='lbfgs', max_steps=50, max_step_size=z)
+            self.assertLessEqual(np.max(rep.step_sizes), z * (1 + 1e-12))
+            self.assertGreater(np.sum(np.asarray(rep.step_sizes) > z * (1 - 1e-9)), 0)
+            self.assertAlmostEqual(rep.final_potential, f(X)[0])
+
+    def test_evaluations(self):
+        (f, X0) = self.field(0.5)
+        (_, ref) = minimize_potential(f, X0, method='random', max_steps=50, max_step_size=0.2,
+                                      random_state=0)
+        target = 1.0 - ref.final_potential / ref.initial_potential
+        (_, rep) = minimize_potential(f, X0, method='lbfgs', max_steps=50, max_step_size=0.2,
+                                      max_pe_change=target)
+        self.assertLess(rep.final_potential, ref.final_potential * (1 + 1e-6))
+        self.assertLess(rep.evaluations, ref.evaluations)
+
+class TestRegistrationCheckpoints(unittest.TestCase):
+    '''
+    The TestRegistrationCheckpoints class tests the writing, reading, and resuming of mesh
+    registration checkpoints.
+    '''
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.mesh = grid_mesh()
+        ids = np.arange(0, self.mesh.coordinates.shape[1], 3)
+        pts = self.mesh.coordinates[:, ids] + 0.5
+        self.field = ['mesh', ['anchor', 'Gaussian', ids, pts, 'scale', 2.0, 'sigma', 0.7]]
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_field_round_trip(self):
+        flnm = os.path.join(self.path, 'checkpoint.npz')
+        X = self.mesh.coordinates
+        save_registration_checkpoint(
+            flnm,
+            {'coordinates': X, 'reference_coordinates': X, 'steps': 10, 'initial_potential': 2.0,
+             'potential': 1.0, 'field': self.field, 'method': 'pure', 'method_k': 0,
+             'max_pe_change': 1.0, 'max_steps': 20, 'max_step_size': 0.05, 'backend': 'numpy'})
+        self.assertEqual(os.listdir(self.path), ['checkpoint.npz'])
+        ckpt = load_registration_checkpoint(flnm)
+        (fld, ref) = (ckpt['field'], self.field)
+        self.assertEqual(fld[0], 'mesh')
+        self.assertEqual(fld[1][:2], ref[1][:2])
+        self.assertTrue(np.array_equal(fld[1][2], ref[1][2]))
+        self.assertTrue(np.array_equal(fld[1][3], ref[1][3]))
+        self.assertEqual(fld[1][4:], ref[1][4:])
+        self.assertEqual((ckpt['steps'], ckpt['method'], ckpt['backend']), (10, 'pure', 'numpy'))
+
+    def test_pickled_checkpoint_is_rejected(self):
+        flnm = os.path.join(self.path, 'checkpoint.npz')
+        obj = np.empty(1, dtype=object)
+        obj[0] = self.field
+        np.savez(flnm, field=obj)
+        self.assertRaises(ValueError, load_registration_checkpoint, flnm)
+
+    def test_resume(self):
+        flnm = os.path.join(self.path, 'checkpoint.npz')
+        opts = {'backend': 'numpy', 'method': 'pure', 'max_steps': 40, 'max_step_size': 0.05}
+        X = mesh_register(self.mesh, self.field, **opts)
+        # stop after two chunks of 10 steps, then resume from the checkpoint
+        mesh_register(self.mesh, self.field, chunk_size=10, checkpoint=flnm,
+                      converged=lambda traj: len(traj['potential']) >= 2, **opts)
+        self.assertEqual(load_registration_checkpoint(flnm)['steps'], 20)
+        Y = mesh_register(self.mesh, None, resume_from=flnm)
+        self.assertTrue(np.allclose(X, Y))
+
+    def test_report_coordinates(self):
+        opts = {'backend': 'numpy', 'method': 'pure', 'max_steps': 40, 'max_step_size': 0.05}
+        X = mesh_register(self.mesh, self.field, **opts)
+        ref = mesh_register(self.mesh, self.field, return_report=True, **opts)
+        # a single chunk is the same minimization, and its report includes the coordinates
+        rep = mesh_register(self.mesh, self.field, chunk_size=40, return_report=True, **opts)
+        self.assertTrue(np.allclose(X, rep.coordinates))
+        self.assertEqual(rep.steps, ref.steps)
+        self.assertAlmostEqual(rep.final_potential, ref.final_potential)
+
+class TestBackgroundRegistration(unittest.TestCase):
+    '''
+    The TestBackgroundRegistration class tests the stopping, early convergence, and errors of mesh
+    registrations that are run in chunks in a background thread.
+    '''
+    def setUp(self):
+        self.mesh = grid_mesh()
+        ids = np.arange(0, self.mesh.coordinates.shape[1], 3)
+        pts = self.mesh.coordinates[:, ids] + 2.0
+        self.field = ['mesh', ['anchor', 'harmonic', ids, pts]]
+        self.opts = {'backend': 'numpy', 'method': 'pure', 'max_steps': 2000,
+                     'max_step_size': 0.05, 'chunk_size': 10}
+
+    def assertConsistent(self, reg):
+        # the trajectory and the report of a finished registration agree with its result
+        X = reg.result(60)
+        (traj, rep) = (reg.trajectory(), reg.report())
+        self.assertTrue(np.array_equal(X, rep.coordinates))
+        self.assertEqual(rep.steps, traj['steps'][-1])
+        self.assertEqual(rep.final_potential, traj['potential'][-1])
+        self.assertTrue(np.array_equal(rep.chunk_potentials, traj['potential']))
+        self.assertEqual(len(rep.step_sizes), rep.steps)
+        self.assertAlmostEqual(numpy_potential_field(self.mesh, self.field)(X)[0],
+                               rep.final_potential)
+        return (traj, rep)
+
+    def test_stop(self):
+        (entered, resume) = (threading.Event(), threading.Event())
+        def converged(traj):
+            # pause after the second chunk so that stop() is called during the registration
+            if len(traj['potential']) == 2:
+                entered.set()
+                resume.wait(60)
+            return False
+        reg = mesh_register(self.mesh, self.field, background=True, converged=converged,
+                            **self.opts)
+        self.assertTrue(entered.wait(60))
+        self.assertFalse(reg.done())
+        reg.stop()
+        resume.set()
+        (traj, rep) = self.assertConsistent(reg)
+        self.assertTrue(reg.done())
+        self.assertEqual(len(traj['potential']), 2)
+        self.assertEqual(rep.steps, 20)
+
+    def test_plateau(self):
+        converged = potential_plateau(0.01, 2)
+        reg = mesh_register(self.mesh, self.field, background=True, converged=converged,
+                            **self.opts)
+        (traj, rep) = self.assertConsistent(reg)
+        self.assertLess(rep.steps, self.opts['max_steps'])
+        self.assertTrue(converged(traj))
+        self.assertFalse(converged({k: v[:-1] for (k,v) in traj.iteritems()}))
+
+    def test_error(self):
+        def converged(traj):
+            raise RuntimeError('test error')
+        reg = mesh_register(self.mesh, self.field, background=True, converged=converged,
+                            **self.opts)
+        with self.assertRaises(RuntimeError) as ctx:
+            reg.result(60)
+        self.assertEqual(str(ctx.exception), 'test error')
+        self.assertTrue(reg.done())
+        self.assertEqual(reg.report().steps, 10)
@@ -0,0 +1,72 @@
+####################################################################################################
+# neuropythy/test/test_topology.py
+# Tests of the interpolation between the registrations of the neuropythy.topology package.
+# By Noah C. Benson
+
+import unittest, os, shutil, tempfile
+import numpy as np
+
+import neuropythy.topology as topology
+from neuropythy.topology import (Topology, interpolation_cache_path, set_interpolation_cache_path)
+from .test_registration  import (sphere_mesh)
+
+class TestInterpolationCache(unittest.TestCase):
+    '''
+    The TestInterpolationCache class tests the on-disk cache of the interpolation matrices between
+    registrations.
+    '''
+    def setUp(self):
+        self.prev = interpolation_cache_path()
+        self.path = tempfile.mkdtemp()
+        set_interpolation_cache_path(self.path)
+        mesh = sphere_mesh()
+        self.triangles = np.asarray(mesh.indexed_faces)
+        self.coordinates = np.asarray(mesh.coordinates)
+        # the same sphere, rotated about the z-axis
+        t = 0.3
+        R = np.asarray([[np.cos(t), -np.sin(t), 0], [np.sin(t), np.cos(t), 0], [0, 0, 1]])
+        self.rotated = R.dot(self.coordinates)
+    def tearDown(self):
+        set_interpolation_cache_path(self.prev)
+        shutil.rmtree(self.path)
+
+    def registrations(self):
+        # yields a fresh pair of registrations (that share no in-memory cache)
+        a = Topology(self.triangles, {'fsaverage': self.coordinates})
+        b = Topology(self.triangles, {'fsaverage': self.rotated})
+        return (a.registrations['fsaverage'], b.registrations['fsaverage'])
+
+    def test_round_trip(self):
+        (a, b) = self.registrations()
+        for method in ['linear', 'nearest']:
+            M = a.interpolation_matrix(b, method=method)
+            self.assertEqual(len([f for f in os.listdir(self.path) if f.endswith('.npz')]),
+                             1 if method == 'linear' else 2)
+            # a new pair of registrations loads the matrix from the cache
+            (c, d) = self.registrations()
+            smoothing = 2 if method == 'linear' else None
+            flnm = topology._interpolation_cache_file(c, d, method, smoothing)
+            self.assertTrue(os.path.isfile(flnm))
+            L = topology._load_interpolation_matrix(flnm, M.shape)
+            self.assertEqual((L - M).nnz, 0)
+            self.assertEqual((c.interpolation_matrix(d, method=method) - M).nnz, 0)
+        self.assertEqual([f for f in os.listdir(self.path) if not f.endswith('.npz')], [])
+        # a matrix of the wrong shape is not loaded
+        self.assertIsNone(topology._load_interpolation_matrix(flnm, (3, 3)))
+
+    def test_version(self):
+        (a, b) = self.registrations()
+        flnm = topology._interpolation_cache_file(a, b, 'linear', 2)
+        version = topology._interpolation_cache_version
+        try:
+            topology._interpolation_cache_version = version + 1
+            self.assertNotEqual(topology._interpolation_cache_file(a, b, 'linear', 2), flnm)
+        finally:
+            topology._interpolation_cache_version = version
+
+    def test_disabled(self):
+        set_interpolation_cache_path(None)
+        (a, b) = self.registrations()
+        self.assertIsNone(topology._interpolation_cache_file(a, b, 'linear', 2))
+        a.interpolation_matrix(b)
+        self.assertEqual(os.listdir(self.path), [])
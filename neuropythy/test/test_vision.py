@@ -0,0 +1,215 @@
+####################################################################################################
+# neuropythy/test/test_vision.py
+# Tests of the retinotopy models and tools of the neuropythy.vision package.
+# By Noah C. Benson
+
+import unittest, os, shutil, tempfile, time
+import numpy as np
+import scipy.spatial as space
+
+from neuropythy.cortex             import (CorticalMesh)
+from neuropythy.vision.models     import (SchiraModel, JavaSchiraModel)
+from neuropythy.vision.retinotopy import (retinotopy_anchors, retinotopy_cache_path,
+                                          set_retinotopy_cache_path, clear_retinotopy_cache,
+                                          _retinotopy_cache_get, _retinotopy_cache_put,
+                                          _prolongate_registration, _limit_displacement,
+                                          _registration_is_valid, register_retinotopy_sweep,
+                                          _retinotopy_sweep_key, _retinotopy_sweep_defaults)
+from .test_registration           import (java_available, grid_mesh)
+
+class TestSchiraModel(unittest.TestCase):
+    '''
+    The TestSchiraModel class tests the NumPy SchiraModel against its own inverse and, when a JVM is
+    available, against the nben library's SchiraModel (see JavaSchiraModel).
+    '''
+    def setUp(self):
+        rs = np.random.RandomState(0)
+        self.model = SchiraModel()
+        self.theta = rs.uniform(0, 180, 200)
+        self.rho = rs.uniform(0.5, 80, 200)
+
+    def test_round_trip(self):
+        X = self.model.angle_to_cortex(self.theta, self.rho)
+        for layer in range(X.shape[1]):
+            res = self.model.cortex_to_angle(X[:,layer,0], X[:,layer,1])
+            self.assertLess(np.max(np.abs(res[:,0] - self.theta)), 1e-8)
+            self.assertLess(np.max(np.abs(res[:,1] - self.rho)), 1e-8)
+
+    def test_foveal_confluence(self):
+        (x, y) = self.model.angle_to_cortex(90.0, 0.0)[0]
+        self.assertEqual(self.model.cortex_to_angle(x, y)[1], 0.0)
+
+    def test_area_borders(self):
+        # points on the borders between areas are assigned to both (e.g., area 1.5 is V1/V2)
+        for (theta, area) in [(180.0, 1.5), (0.0, 1.5)]:
+            (x, y) = self.model.angle_to_cortex(theta, 5.0)[0]
+            self.assertEqual(self.model.cortex_to_angle(x, y)[2], area)
+
+    def test_outside_points(self):
+        # points in a wide square, most of which are outside of the model's image
+        rs = np.random.RandomState(1)
+        (x, y) = (rs.uniform(-100, 100, 500), rs.uniform(-100, 100, 500))
+        t0 = time.time()
+        res = self.model.cortex_to_angle(x, y)
+        self.assertLess(time.time() - t0, 2.0)
+        self.assertTrue(np.all(np.isfinite(res)))
+        # the points outside of the image yield the point whose image is nearest, which is no
+        # farther than the nearest point of a fine grid
+        model = self.model
+        (u, v) = model._final_rx(x, y)
+        (zx, zy) = model._layerless_rx(u, v)
+        d2 = np.sum((np.asarray(model._layerless_tx(zx, zy)) - [u, v])**2, axis=0)
+        outside = (d2 >= 1e-14)
+        self.assertGreater(np.sum(outside), 100)
+        (gu, gp) = np.meshgrid(np.linspace(-8, 20, 281), np.linspace(-np.pi, np.pi, 361))
+        G = np.asarray(model._polar_tx(gu.flatten(), gp.flatten()))
+        for i in np.where(outside)[0]:
+            gd2 = np.min((G[0] - u[i])**2 + (G[1] - v[i])**2)
+            self.assertLessEqual(d2[i], gd2 + 1e-9)
+        # the points inside of the image are inverted exactly
+        X = np.transpose(model.angle_to_cortex(self.theta, self.rho)[:,0])
+        both = model.cortex_to_angle(np.concatenate([x, X[0]]), np.concatenate([y, X[1]]))
+        self.assertTrue(np.array_equal(both[:len(x)], res))
+        self.assertLess(np.max(np.abs(both[len(x):,0] - self.theta)), 1e-8)
+
+    def test_java_model(self):
+        if not java_available(): self.skipTest('no JVM is available')
+        jmodel = JavaSchiraModel()
+        X = self.model.angle_to_cortex(self.theta, self.rho)
+        JX = np.asarray(jmodel.angle_to_cortex(self.theta, self.rho))
+        self.assertLess(np.max(np.abs(X - JX)), 1e-10)
+        for layer in range(X.shape[1]):
+            (x, y) = (X[:,layer,0], X[:,layer,1])
+            res = self.model.cortex_to_angle(x, y)
+            jres = np.asarray(jmodel.cortex_to_angle(x, y))
+            # nben's inverse is a gradient-descent search that is only precise to about 1e-4
+            self.assertLess(np.max(np.abs(res[:,:2] - jres[:,:2])), 1e-3)
+            self.assertTrue(np.array_equal(res[:,2], jres[:,2]))
+
+class TestRetinotopyAnchors(unittest.TestCase):
+    '''
+    The TestRetinotopyAnchors class tests the anchor instructions yielded by retinotopy_anchors.
+    '''
+    def setUp(self):
+        self.mesh = grid_mesh(8)
+        n = self.mesh.vertex_count
+        rs = np.random.RandomState(3)
+        self.polar_angle = rs.uniform(0, 180, n)
+        self.eccentricity = rs.uniform(1, 20, n)
+
+    def anchors(self, weight):
+        return retinotopy_anchors(self.mesh, SchiraModel(), polar_angle=self.polar_angle,
+                                  eccentricity=self.eccentricity, weight=weight, select=None,
+                                  sigma=[0.05, 1.0, 0.5])
+
+    def test_anchors(self):
+        (_, shape, idcs, ancs, _, wgts, _, sigs) = self.anchors(np.ones(self.mesh.vertex_count))
+        self.assertEqual(shape, 'Gaussian')
+        # every vertex has one anchor in each of the model's areas
+        self.assertEqual(len(idcs), 5 * self.mesh.vertex_count)
+        self.assertEqual(ancs.shape, (2, len(idcs)))
+        self.assertEqual((len(wgts), len(sigs)), (len(idcs), len(idcs)))
+
+    def test_no_anchors(self):
+        (_, _, idcs, ancs, _, wgts, _, sigs) = self.anchors(np.zeros(self.mesh.vertex_count))
+        self.assertEqual((idcs.shape, idcs.dtype), ((0,), np.int32))
+        self.assertEqual((ancs.shape, ancs.dtype), ((2, 0), np.float64))
+        self.assertEqual((wgts.shape, wgts.dtype), ((0,), np.float64))
+        self.assertEqual((sigs.shape, sigs.dtype), ((0,), np.float64))
+
+class TestRetinotopyCache(unittest.TestCase):
+    '''
+    The TestRetinotopyCache class tests the on-disk cache of register_retinotopy_initialize.
+    '''
+    def setUp(self):
+        self.prev = retinotopy_cache_path()
+        self.path = tempfile.mkdtemp()
+        set_retinotopy_cache_path(self.path)
+    def tearDown(self):
+        set_retinotopy_cache_path(self.prev)
+        clear_retinotopy_cache()
+        shutil.rmtree(self.path)
+
+    def test_round_trip(self):
+        key = ('test', 1)
+        (a, b) = (np.arange(10.0), np.arange(6).reshape((2,3)))
+        _retinotopy_cache_put(key, {'a': a, 'b': b, 'c': 'not persisted'}, persist=('a', 'b'))
+        self.assertEqual(len(os.listdir(self.path)), 1)
+        clear_retinotopy_cache()
+        val = _retinotopy_cache_get(key, persist=('a', 'b'))
+        self.assertEqual(sorted(val.keys()), ['a', 'b'])
+        self.assertTrue(np.array_equal(val['a'], a) and np.array_equal(val['b'], b))
+        set_retinotopy_cache_path(None)
+        clear_retinotopy_cache()
+        self.assertIsNone(_retinotopy_cache_get(key, persist=('a', 'b')))
+
+class TestRegistrationProlongation(unittest.TestCase):
+    '''
+    The TestRegistrationProlongation class tests the prolongation of a coarse registration onto a
+    fine mesh and the limiting of the prolongated displacement, as used by register_retinotopy.
+    '''
+    def setUp(self):
+        # a coarse grid and a fine grid over the same square; some of the fine grid's boundary
+        # vertices lie outside of the coarse grid's convex hull
+        coarse = grid_mesh(5, 0.1, seed=5)
+        self.coarse = CorticalMesh(2.0 * coarse.coordinates, coarse.indexed_faces)
+        self.fine = grid_mesh(9, 0.1, seed=6)
+
+    def test_linear_displacement(self):
+        (A, b) = (np.asarray([[0.1, -0.05], [0.02, 0.08]]), np.asarray([[0.3], [-0.2]]))
+        X0 = self.coarse.coordinates
+        disp = _prolongate_registration(self.coarse, X0 + A.dot(X0) + b, self.fine)
+        Y0 = self.fine.coordinates
+        # inside the coarse mesh, a linear displacement is reproduced exactly
+        inside = space.Delaunay(X0.T).find_simplex(Y0.T) >= 0
+        self.assertTrue(np.any(~inside))
+        self.assertTrue(np.allclose(disp[:,inside], (A.dot(Y0) + b)[:,inside], atol=1e-12))
+        # outside of it, each vertex is displaced as its nearest coarse vertex
+        d2 = np.sum((Y0[:,~inside,None] - X0[:,None,:])**2, axis=0)
+        nei = np.argmin(d2, axis=1)
+        self.assertTrue(np.allclose(disp[:,~inside], (A.dot(X0) + b)[:,nei]))
+
+    def test_limit_displacement(self):
+        mesh = self.fine
+        rs = np.random.RandomState(7)
+        small = rs.uniform(-0.05, 0.05, mesh.coordinates.shape)
+        self.assertTrue(np.array_equal(_limit_displacement(mesh, small, 0.5, 2.0), small))
+        # a displacement that folds the mesh is halved until it no longer does
+        large = rs.uniform(-2.0, 2.0, mesh.coordinates.shape)
+        self.assertFalse(_registration_is_valid(mesh, mesh.coordinates + large, None, None))
+        for (cmp, stretch) in [(None, None), (0.5, 2.0)]:
+            disp = _limit_displacement(mesh, large, cmp, stretch)
+            self.assertTrue(_registration_is_valid(mesh, mesh.coordinates + disp, cmp, stretch))
+            scale = np.max(np.abs(disp)) / np.max(np.abs(large))
+            self.assertTrue(np.allclose(disp, scale * large))
+            self.assertTrue(0 < scale < 1 and np.log2(scale) == np.round(np.log2(scale)))
+
+class TestRetinotopySweep(unittest.TestCase):
+    '''
+    The TestRetinotopySweep class tests the parameter handling of register_retinotopy_sweep, none of
+    which requires the JVM.
+    '''
+    def test_defaults(self):
+        self.assertEqual(_retinotopy_sweep_defaults,
+                         {'functional_scale': 1.0, 'edge_scale': 1.0, 'angle_scale': 1.0,
+                          'sigma': Ellipsis, 'weight_cutoff': 0.1, 'edge_max_compression': 0.25,
+                          'edge_max_stretch': 3.0, 'select': 'close', 'max_steps': 2000,
+                          'max_step_size': 0.05, 'method': 'random'})
+
+    def test_key(self):
+        key = _retinotopy_sweep_key({'sigma': [0.1, 2.0, 8.0], 'edge_scale': 2.0,
+                                     'select': ['close', [40, 4]], 'method': 'pure'})
+        self.assertEqual(key, (('edge_scale', 2.0), ('method', 'pure'),
+                               ('select', ('close', (40, 4))), ('sigma', (0.1, 2.0, 8.0))))
+        # the key does not depend on the order of the parameters or on the type of the sequences
+        self.assertEqual(key, _retinotopy_sweep_key({'method': 'pure', 'edge_scale': 2.0,
+                                                     'sigma': np.asarray([0.1, 2.0, 8.0]),
+                                                     'select': ('close', np.asarray([40, 4]))}))
+        self.assertEqual(len(set([key, _retinotopy_sweep_key({'edge_scale': 2.0})])), 2)
+
+    def test_options(self):
+        # the options are checked before the hemisphere is touched
+        for grid in [{'prior': ['retinotopy']}, [{'edge_scale': 1.0}, {'bogus': 1}]]:
+            self.assertRaises(ValueError, register_retinotopy_sweep, None, grid)
+        self.assertRaises(ValueError, register_retinotopy_sweep, None, {'edge_scale': [1.0]},
+                          bogus=1)
@@ -8,12 +8,93 @@ import numpy as np
 import numpy.linalg
 import scipy as sp
 import scipy.spatial as space
-import os, math
+import scipy.sparse as sps
+import os, math, weakref, hashlib
 from pysistence import make_dict
 
 from neuropythy.immutable import Immutable
+from neuropythy.util      import atomic_write
 import neuropythy.geometry as geo
 
+# The on-disk cache of interpolation matrices ######################################################
+# The cache is only used if a directory is given by the NEUROPYTHY_INTERPOLATION_CACHE environment
+# variable or by set_interpolation_cache_path. The version is part of the cache keys; it must be
+# incremented whenever the matrices that are calculated (e.g., the point-location or nearest-vertex
+# semantics) or the format of the files change, so that stale matrices are never loaded.
+_interpolation_cache_version = 1
+_interpolation_cache_path = os.environ.get('NEUROPYTHY_INTERPOLATION_CACHE', None)
+if _interpolation_cache_path:
+    _interpolation_cache_path = os.path.expanduser(_interpolation_cache_path)
+else:
+    _interpolation_cache_path = None
+
+def interpolation_cache_path():
+    '''
+    interpolation_cache_path() yields the directory in which interpolation matrices between
+    registrations are cached on disk, or None if the on-disk cache is disabled. The on-disk cache
+    is disabled unless the NEUROPYTHY_INTERPOLATION_CACHE environment variable gives its directory
+    or one is set by set_interpolation_cache_path.
+    '''
+    return _interpolation_cache_path
+
+def set_interpolation_cache_path(path):
+    '''
+    set_interpolation_cache_path(path) sets the directory in which interpolation matrices between
+    registrations are cached on disk; if path is None, the on-disk cache is disabled. The cached
+    matrices are stored in .npz files that are named by the hashes of the contents of the two
+    registrations and the interpolation method, so a cache directory may be shared by many
+    processes and subjects. Files are never removed from the cache: each pair of registrations adds
+    one file per method of about 16 bytes per vertex for the 'nearest' method and about 40 bytes per
+    vertex for the 'linear' method, and files written by older versions of neuropythy are no longer
+    read, so the directory may be cleared at any time. See also interpolation_cache_path.
+    '''
+    global _interpolation_cache_path
+    _interpolation_cache_path = None if path is None else os.path.expanduser(path)
+    return _interpolation_cache_path
+
+def _registration_hash(reg):
+    # the hash of a registration's coordinates and triangles; this is stored in the registration
+    h = reg.__dict__.get('_content_hash')
+    if h is None:
+        sha = hashlib.sha1()
+        for a in (reg.coordinates, reg.triangles):
+            a = np.ascontiguousarray(a, dtype=(np.float64 if a is reg.coordinates else np.int64))
+            sha.update(str(a.shape))
+            sha.update(a.tostring())
+        h = sha.hexdigest()
+        reg.__dict__['_content_hash'] = h
+    return h
+
+def _interpolation_cache_file(to_reg, from_reg, method, smoothing):
+    if _interpolation_cache_path is None: return None
+    key = 'v%d_%s_%s_%s_%s' % (_interpolation_cache_version,
+                               _registration_hash(from_reg), _registration_hash(to_reg),
+                               method, 'none' if smoothing is None else repr(float(smoothing)))
+    return os.path.join(_interpolation_cache_path, hashlib.sha1(key).hexdigest() + '.npz')
+
+def _load_interpolation_matrix(filename, shape):
+    # yields the cached matrix or None if there is no valid cached matrix
+    if filename is None or not os.path.isfile(filename): return None
+    try:
+        with np.load(filename) as dat:
+            if tuple(dat['shape']) != tuple(shape): return None
+            return sps.csr_matrix((dat['data'], dat['indices'], dat['indptr']), shape=shape)
+    except Exception:
+        return None
+
+def _save_interpolation_matrix(filename, M):
+    # the matrix is written atomically (see neuropythy.util.atomic_write), so that concurrent
+    # readers never see a partial file; failures (e.g., a read-only cache) are silently ignored
+    if filename is None: return False
+    try:
+        atomic_write(filename,
+                     lambda f: np.savez(f, data=M.data, indices=M.indices, indptr=M.indptr,
+                                        shape=M.shape),
+                     suffix='.npz')
+        return True
+    except Exception:
+        return False
+
 class Topology(object):
     '''
     Topology(triangles, registrations) constructs a topology object object with the given triangle
@@ -42,18 +123,39 @@ class Topology(object):
             name,
             Registration(self, coords if coords.shape[0] < 4 else coords.T))
         return self
-    def interpolate_from(self, topo, data, mask=None, null=None, method='automatic', n_jobs=1):
+    # the order in which shared registrations are tried when none is given explicitly
+    default_registration_order = ('fsaverage', 'fsaverage_sym')
+    def registration_order(self, topo, registration=None):
+        '''
+        topology.registration_order(topo) yields the list of names of the registrations shared by
+        topology and the topology object topo, in the order in which topology.interpolate_from would
+        try them. The optional argument registration may be a registration name or a list of names,
+        in which case only these registrations are yielded (in the given order); otherwise the
+        shared registrations listed in Topology.default_registration_order are yielded first,
+        followed by any other shared registrations in alphabetical order.
+        '''
+        shared = [k for k in topo.registrations.iterkeys() if k in self.registrations]
+        if registration is None:
+            return ([k for k in Topology.default_registration_order if k in shared] +
+                    sorted([k for k in shared if k not in Topology.default_registration_order]))
+        if isinstance(registration, basestring): registration = [registration]
+        return [k for k in registration if k in shared]
+    def interpolate_from(self, topo, data, mask=None, null=None, method='automatic', n_jobs=None,
+                         registration=None, return_registration=False, chunk_size=None):
         '''
         topology.interpolate_from(topo, data) yields a numpy array of the data interpolated from
         the given array, data, which must contain the same number of elements as there are points in
         the topology object topo, to the coordinates in the given Topology object topology. Note
         that in order for an interpolation to occur, the two topologies, topology and topo, must
-        have a shared registration; i.e., a registration with the same name.
+        have a shared registration; i.e., a registration with the same name. The interpolation is
+        performed once, using the first shared registration in topology.registration_order(topo);
+        the remaining registrations are only tried if the interpolation raises an error.
         
         The following options are accepted:
           * mask (default: None) indicates that the given True/False or 0/1 valued list/array should
-            be used; any point whose nearest neighbor (see below) is in the given mask will, instead
-            of an interpolated value, be set to the null value (see null option).
+            be used; any source vertex that is not in the mask is dropped from the interpolation,
+            and the weights of the remaining vertices are renormalized; destination vertices that
+            are left with no vertices to interpolate from are set to the null value.
           * null (default: None) indicates the value that should be placed in the returned result if
             either a vertex does not lie in any triangle or a vertex is masked out via the mask
             option.
@@ -62,32 +164,40 @@ class Topology(object):
             while 2 represents a slightly smoother version of this. Note that this is not an order
             of interpolation option.
           * method (default: 'automatic') specifies what method to use for interpolation. The only
-            currently supported methods are 'automatic' or 'nearest'. The 'nearest' method does not
-            actually perform a nearest-neighbor interpolation but rather assigns to a destination
-            vertex the value of the source vertex whose veronoi-like polygon contains the
-            destination vertex; note that the term 'veronoi-like' is used here because it uses the
-            Voronoi diagram that corresponds to the triangle mesh and not the true delaunay
-            triangulation. The 'automatic' checks every destination vertex and assigns it the
-            'nearest' value if that value would not be a number, otherwise it interpolates linearly
-            within the vertex's source triangle.
-          * n_jobs (default: 1) is passed along to the cKDTree.query method, so may be set to an
-            integer to specify how many processors to use, or may be -1 to specify all processors.
+            currently supported methods are 'automatic' (or 'linear') or 'nearest'. The 'nearest'
+            method assigns to each destination vertex the value of the nearest vertex of the source
+            triangle that contains it (or of the nearest source vertex, if no triangle contains
+            it). The 'automatic' method interpolates linearly within the vertex's source triangle.
+            Either way, the interpolation is performed with the cached sparse operator yielded by
+            registration.interpolation_matrix.
+          * n_jobs (default: None) is passed along to the cKDTree.query method, so may be set to an
+            integer to specify how many processors to use, or may be -1 to specify all processors;
+            None uses the library-wide default (see neuropythy.geometry.set_kdtree_workers).
+          * registration (default: None) specifies the name or list of names of the registrations
+            that may be used, in order of preference; see topology.registration_order.
+          * return_registration (default: False) specifies that the result should be a tuple
+            (data, name) in which name is the name of the registration that was used.
+          * chunk_size (default: None) may specify that the interpolation be performed at most
+            chunk_size vertices at a time, with the results written into a preallocated array; in
+            this case, unless the interpolation matrix has already been cached, the matrix is
+            calculated in pieces and is not cached, so that the memory used does not depend on the
+            number of vertices being interpolated onto.
         '''
-        # find a shared registration:
-        reg_names = [k for k in topo.registrations.iterkeys() if k in self.registrations]
+        reg_names = self.registration_order(topo, registration)
         if not reg_names:
             raise RuntimeError('Topologies do not share a matching registration!')
-        res = []
+        errs = []
         for reg_name in reg_names:
             try:
                 res = self.registrations[reg_name].interpolate_from(
                     topo.registrations[reg_name], data,
-                    mask=mask, null=null, method=method, n_jobs=n_jobs);
-            except:
-                pass
-        if res is None:
-            raise ValueError('All shared topologies raised errors during interpolation!')
-        return res
+                    mask=mask, null=null, method=method, n_jobs=n_jobs, chunk_size=chunk_size)
+            except Exception as e:
+                errs.append('%s: %s' % (reg_name, e))
+                continue
+            return (res, reg_name) if return_registration else res
+        raise ValueError('All shared registrations raised errors during interpolation: '
+                         + '; '.join(errs))
 
 class Registration(geo.Mesh):
     '''
@@ -107,8 +217,8 @@ class Registration(geo.Mesh):
                                                                 self.coordinates.shape[0])
 
 
-    def interpolate_from(self, reg, data, 
-                         smoothing=2, mask=None, null=None, method='automatic', n_jobs=1):
+    def interpolate_from(self, reg, data, smoothing=2, mask=None, null=None, method='automatic',
+                         n_jobs=None, chunk_size=None):
         '''
         registration.interpolate_from(reg, data) yields a numpy array of the data interpolated from
         the given array, data, which must contain the same number of elements as there are points in
@@ -117,8 +227,9 @@ class Registration(geo.Mesh):
         
         The following options are accepted:
           * mask (default: None) indicates that the given True/False or 0/1 valued list/array should
-            be used; any point whose nearest neighbor (see below) is in the given mask will, instead
-            of an interpolated value, be set to the null value (see null option).
+            be used; any source vertex that is not in the mask is dropped from the interpolation,
+            and the weights of the remaining vertices are renormalized; destination vertices that
+            are left with no vertices to interpolate from are set to the null value.
           * null (default: None) indicates the value that should be placed in the returned result if
             either a vertex does not lie in any triangle or a vertex is masked out via the mask
             option.
@@ -127,19 +238,88 @@ class Registration(geo.Mesh):
             while 2 represents a slightly smoother version of this. Note that this is not an order
             of interpolation option.
           * method (default: 'automatic') specifies what method to use for interpolation. The only
-            currently supported methods are 'automatic' or 'nearest'. The 'nearest' method does not
-            actually perform a nearest-neighbor interpolation but rather assigns to a destination
-            vertex the value of the source vertex whose veronoi-like polygon contains the
-            destination vertex; note that the term 'veronoi-like' is used here because it uses the
-            Voronoi diagram that corresponds to the triangle mesh and not the true delaunay
-            triangulation. The 'automatic' checks every destination vertex and assigns it the
-            'nearest' value if that value would not be a number, otherwise it interpolates linearly
-            within the vertex's source triangle.
-          * n_jobs (default: 1) is passed along to the cKDTree.query method, so may be set to an
-            integer to specify how many processors to use, or may be -1 to specify all processors.
+            currently supported methods are 'automatic' (or 'linear') or 'nearest'. The 'nearest'
+            method assigns to each destination vertex the value of the nearest vertex of the source
+            triangle that contains it (or of the nearest source vertex, if no triangle contains
+            it). The 'automatic' method interpolates linearly within the vertex's source triangle.
+            Either way, the interpolation is performed with the cached sparse operator yielded by
+            registration.interpolation_matrix.
+          * n_jobs (default: None) is passed along to the cKDTree.query method, so may be set to an
+            integer to specify how many processors to use, or may be -1 to specify all processors;
+            None uses the library-wide default (see neuropythy.geometry.set_kdtree_workers).
+          * chunk_size (default: None) may specify that the interpolation be performed at most
+            chunk_size vertices at a time, with the results written into a preallocated array; in
+            this case, unless the interpolation matrix has already been cached, the matrix is
+            calculated in pieces and is not cached, so that the memory used does not depend on the
+            number of vertices being interpolated onto.
+        '''
+        if chunk_size is None:
+            M = self.interpolation_matrix(reg, method=method, smoothing=smoothing, n_jobs=n_jobs)
+            return geo.apply_interpolation_matrix(M, data, mask=mask, null=null)
+        data = np.asarray(data)
+        transposed = (data.shape[0] != reg.coordinates.shape[0])
+        M = self.cached_interpolation_matrix(reg, method=method, smoothing=smoothing)
+        if M is not None:
+            fn = lambda ii: geo.apply_interpolation_matrix(M[ii], data, mask=mask, null=null)
+        else:
+            if method == 'automatic': method = 'linear'
+            smoothing = 1 if method == 'nearest' else smoothing
+            fn = lambda ii: geo.apply_interpolation_matrix(
+                reg.point_interpolation_matrix(self.coordinates[ii], method=method,
+                                               smoothing=smoothing, n_jobs=n_jobs),
+                data, mask=mask, null=null)
+        return geo.interpolate_in_chunks(self.coordinates.shape[0], chunk_size, transposed, fn)
+
+    def cached_interpolation_matrix(self, reg, method='linear', smoothing=2):
+        '''
+        registration.cached_interpolation_matrix(reg) yields the interpolation matrix that would be
+        yielded by registration.interpolation_matrix(reg) if it has already been calculated and
+        cached in memory; otherwise yields None.
+        '''
+        if method == 'automatic': method = 'linear'
+        if method == 'nearest': smoothing = None
+        cache = self.__dict__.get('_interpolation_matrices')
+        if cache is None or reg not in cache: return None
+        return cache[reg].get((method, smoothing))
+
+    def interpolation_matrix(self, reg, method='linear', smoothing=2, n_jobs=None):
+        '''
+        registration.interpolation_matrix(reg) yields a scipy.sparse.csr_matrix M of size (n x m),
+        where n is the number of vertices in registration and m is the number of vertices in the
+        Registration object reg, such that M.dot(data) interpolates data from the vertices of reg
+        to the vertices of registration; see also neuropythy.geometry.apply_interpolation_matrix.
+        The matrix is calculated once for each reg, method, and smoothing and is cached in the
+        registration thereafter; the vertices of registration are located in reg only once, and
+        all of the matrices for reg share this location. If an on-disk cache is enabled (see
+        set_interpolation_cache_path), matrices are additionally cached there such that other
+        processes that use the same pair of registrations can load rather than calculate them.
+        The method may be 'linear' (or 'automatic') or 'nearest'; see registration.interpolate_from
+        for a description of these and of the smoothing option.
         '''
-        return reg.interpolate(self.coordinates, data,
-                               smoothing=smoothing, mask=mask, null=null,
-                               method=method, n_jobs=n_jobs)
+        if method == 'automatic': method = 'linear'
+        if method == 'nearest': smoothing = None
+        cache = self.__dict__.get('_interpolation_matrices')
+        if cache is None:
+            cache = weakref.WeakKeyDictionary()
+            self.__dict__['_interpolation_matrices'] = cache
+        if reg not in cache: cache[reg] = {}
+        mtcs = cache[reg]
+        k = (method, smoothing)
+        if k not in mtcs:
+            flnm = _interpolation_cache_file(self, reg, method, smoothing)
+            M = _load_interpolation_matrix(flnm, (self.coordinates.shape[0],
+                                                  reg.coordinates.shape[0]))
+            if M is None:
+                if 'location' not in mtcs:
+                    mtcs['location'] = reg.point_location(self.coordinates, n_jobs=n_jobs)
+                M = reg.point_interpolation_matrix(
+                    self.coordinates, method=method,
+                    smoothing=(1 if smoothing is None else smoothing),
+                    n_jobs=n_jobs, location=mtcs['location'])
+                _save_interpolation_matrix(flnm, M)
+            # the operator is shared, so it must not be changed in place
+            M.data.flags.writeable = False
+            mtcs[k] = M
+        return mtcs[k]
 
     
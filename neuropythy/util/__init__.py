@@ -3,5 +3,6 @@
 # This file defines the general tools that are available as part of neuropythy.
 
 from .command import (CommandLineParser)
+from .files   import (atomic_write)
 
 
@@ -0,0 +1,37 @@
+####################################################################################################
+# neuropythy/util/files.py
+# Tools for safely writing files, such as caches and checkpoints, that other processes may read.
+# By Noah C. Benson
+
+import os, tempfile
+
+def _replace_file(src, dst):
+    # moves the file src to dst, atomically replacing dst if it exists
+    if os.name != 'nt': return os.rename(src, dst)
+    # os.rename cannot replace an existing file on Windows, but MoveFileEx can
+    import ctypes
+    (replace_existing, write_through) = (0x1, 0x8)
+    if not ctypes.windll.kernel32.MoveFileExW(unicode(src), unicode(dst),
+                                              replace_existing | write_through):
+        raise ctypes.WinError()
+
+def atomic_write(filename, write, suffix=''):
+    '''
+    atomic_write(filename, write) calls write(f) with a file object f that is open for writing in
+    binary mode, then moves the file that was written to the given filename, atomically replacing
+    any existing file of that name. The data are written to a temporary file in the same directory,
+    so readers of filename never see a partially-written file. If the directory does not exist, it
+    is created. If write raises an error, the temporary file is removed and the error is raised.
+    The optional argument suffix gives the suffix of the temporary file. The filename is yielded.
+    '''
+    dirname = os.path.dirname(os.path.abspath(filename))
+    if not os.path.isdir(dirname): os.makedirs(dirname)
+    (fd, tmp) = tempfile.mkstemp(dir=dirname, prefix='.tmp', suffix=suffix)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        _replace_file(tmp, filename)
+    except Exception:
+        if os.path.exists(tmp): os.remove(tmp)
+        raise
+    return filename
@@ -4,11 +4,14 @@
 
 from .models     import (load_fmm_model,
                          RetinotopyModel, RetinotopyMeshModel, RegisteredRetinotopyModel,
-                         SchiraModel)
+                         SchiraModel, JavaSchiraModel)
 from .retinotopy import (empirical_retinotopy_data, predicted_retinotopy_data, retinotopy_data,
                          extract_retinotopy_argument,
                          register_retinotopy, retinotopy_anchors, retinotopy_model,
-                         predict_retinotopy, register_retinotopy_initialize)
+                         predict_retinotopy, register_retinotopy_initialize,
+                         retinotopy_map_level, register_retinotopy_sweep,
+                         retinotopy_cache_path, set_retinotopy_cache_path,
+                         clear_retinotopy_cache)
 from .cmag       import (neighborhood_cortical_magnification, path_cortical_magnification,
                          isoangular_path)
 
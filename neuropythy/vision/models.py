@@ -14,8 +14,9 @@ import neuropythy.geometry   as     geo
 import neuropythy.freesurfer as     nfs
 import neuropythy.cortex     as     ncx
 from   neuropythy.immutable  import Immutable
-from   neuropythy.java       import (java_link, serialize_numpy,
-                                     to_java_doubles, to_java_ints, to_java_array)
+from   neuropythy.java       import (java_link, java_gateway, java_object_gateway,
+                                     serialize_numpy, to_java_doubles, to_java_ints, to_java_array,
+                                     from_java_doubles)
 
 class RetinotopyModel:
     '''
@@ -47,14 +48,23 @@ class RetinotopyModel:
             'Object with base class RetinotopyModel did not override cortex_to_angle')
 
 # How we construct a Schira Model:
+def _sech(x):
+    with np.errstate(over='ignore'):
+        return 2.0 / (np.exp(x) + np.exp(-x))
+
 class SchiraModel(RetinotopyModel):
     '''
-    The SchiraModel class is a class that inherits from RetinotopyModel and acts as a Python wrapper
-    around the Java nben.neuroscience.SchiraModel class; it handles conversion from visual field 
-    angle to cortical surface coordinates and vice versa for the Banded Double-Sech model proposed
-    in the following paper:
+    The SchiraModel class is a class that inherits from RetinotopyModel and implements, in NumPy,
+    the conversion from visual field angle to cortical surface coordinates and vice versa for the
+    Banded Double-Sech model proposed in the following paper:
     Schira MM, Tyler CW, Spehar B, Breakspear M (2010) Modeling Magnification and Anisotropy in the
     Primate Foveal Confluence. PLOS Comput Biol 6(1):e1000651. doi:10.1371/journal.pcbi.1000651.
+    The calculations are identical to those of the Java nben.neuroscience.SchiraModel class (see
+    JavaSchiraModel), except that the inverse of the double-sech transformation is found by Newton's
+    method, that points on the horizontal meridian near the foveal confluence, whose inverse nben's
+    search does not find, are inverted exactly, that points outside of the model's image yield the
+    point whose image is nearest them (by a search of bounded cost), and that they operate on whole
+    arrays of points at once.
     '''
 
     # These are the accepted arguments to the model:
@@ -71,6 +81,16 @@ class SchiraModel(RetinotopyModel):
         'v3size': 0.4,
         'hv4size': 0.9,
         'v3asize': 0.9}
+    # The constants of the double-sech function
+    double_sech_parameters = (0.1821, 0.76)
+    # Values whose magnitude is below this are treated as zero (nben's Num.ZERO_TOL)
+    zero_tolerance = 1e-12
+    # The grid of log-magnitudes (first, last, count) and the number of arguments of the points
+    # whose images seed the search for the inverse of the points outside of the model's image
+    image_grid_magnitudes = (-8.0, 20.0, 57)
+    image_grid_arguments = 49
+    # The damping factors, relative to the trace of J^T J, tried at each step of that search
+    nearest_damping = (0.0,) + tuple(4.0**np.arange(-12, 6))
     # This function checks the given arguments to see if they are okay:
     def __check_parameters(self, parameters):
         # we don't care if there are extra parameters; we just make sure the given parameters make
@@ -80,8 +100,7 @@ class SchiraModel(RetinotopyModel):
             for (k,v) in SchiraModel.default_parameters.iteritems()}
         return opts
 
-    # This class is immutable: don't change the params to change the model; 
-    # don't change the java object!
+    # This class is immutable: don't change the params to change the model!
     def __setattr__(self, name, val):
         raise ValueError('The SchiraModel class is immutable; its objects cannot be edited')
 
@@ -101,6 +120,308 @@ class SchiraModel(RetinotopyModel):
             and params['center'] == 0):
             params['center'] = [0.0, 0.0]
         self.__dict__['parameters'] = make_dict(params)
+        # the derived constants of the model
+        (A, B, lam) = (params['A'], params['B'], params['lambda'])
+        v1 = params['v1size']
+        v2 = v1 + params['v2size']
+        v3 = v2 + params['v3size']
+        self.__dict__['_constants'] = make_dict(
+            sin_psi=math.sin(params['psi']),
+            cos_psi=math.cos(params['psi']),
+            FC0=math.log((A + lam) / (B + lam)),
+            shear_div=1.0 / (1.0 - params['shear'][0][1]*params['shear'][1][0]),
+            v2_bound=v2,
+            v3_bound=v3,
+            hv4_bound=v3 + params['hv4size'],
+            v3a_bound=v3 + params['v3asize'])
+
+    # The steps of the model's transformation; each operates on the x and y coordinate vectors
+    def _final_tx(self, x, y):
+        # center, flip, shear, rotate, scale and re-center
+        (p, c) = (self.parameters, self._constants)
+        (x, y) = (x - c['FC0'], -y)
+        (x, y) = (x + p['shear'][0][1]*y, p['shear'][1][0]*x + y)
+        (x, y) = (x*c['cos_psi'] - y*c['sin_psi'], x*c['sin_psi'] + y*c['cos_psi'])
+        return (p['center'][0] + p['scale'][0]*x, p['center'][1] + p['scale'][1]*y)
+    def _final_rx(self, x, y):
+        (p, c) = (self.parameters, self._constants)
+        (x, y) = ((x - p['center'][0]) / p['scale'][0], (y - p['center'][1]) / p['scale'][1])
+        (x, y) = (x*c['cos_psi'] + y*c['sin_psi'], -x*c['sin_psi'] + y*c['cos_psi'])
+        (x, y) = (c['shear_div'] * (x - y*p['shear'][0][1]),
+                  c['shear_div'] * (y - x*p['shear'][1][0]))
+        return (x + c['FC0'], -y)
+    def _lambda_tx(self, x, y):
+        lam = self.parameters['lambda']
+        return (np.where(x >= 0,
+                         x + lam,
+                         x + 2.0*lam*(1.0 - np.abs(np.arctan2(y, x))/math.pi)),
+                y)
+    def _lambda_rx(self, x, y, tol=1e-10, max_iterations=100):
+        # the inverse has no closed form, so we find the zero of
+        # f(x0) = x1 - x0 - 2 lambda (1 - atan2(y0, x0)/pi) by Newton's method, as in nben; on the
+        # horizontal meridian (y0 = 0), where Newton's method does not converge, the inverse is x1
+        # for x1 < 0, and the segment 0 <= x1 < lambda is the image of the origin
+        lam = self.parameters['lambda']
+        x = np.array(x, dtype=np.float64)
+        inner = (x < lam)
+        x[~inner] -= lam
+        if not inner.any(): return (x, y)
+        rz = x[inner]
+        x0 = 0.5 * (2*rz - lam)
+        y0 = np.abs(np.asarray(y)[inner])
+        k = 2 * lam / math.pi
+        meridian = (y0 < SchiraModel.zero_tolerance)
+        x0[meridian] = np.minimum(rz[meridian], 0.0)
+        active = ~meridian
+        for _ in range(max_iterations):
+            f  = rz - x0 - k*(math.pi - np.arctan2(y0, x0))
+            df = -1.0 - k*y0 / (x0*x0 + y0*y0)
+            active &= ~(np.abs(f) < tol)
+            if not active.any(): break
+            x0 = np.where(active, x0 - f/df, x0)
+        x[inner] = x0
+        return (x, y)
+    def _layerless_tx(self, x, y):
+        (A, B) = (self.parameters['A'], self.parameters['B'])
+        (p1, p2) = SchiraModel.double_sech_parameters
+        z = x + 1j*y
+        absz = np.abs(z)
+        zero = absz < SchiraModel.zero_tolerance
+        with np.errstate(divide='ignore', invalid='ignore'):
+            argz = np.angle(z)
+            sech_arg = _sech(argz)
+            num = A + absz * np.exp(1j * argz * sech_arg**(p1 * _sech(p2*np.log(absz / A))))
+            den = B + absz * np.exp(1j * argz * sech_arg**(p1 * _sech(p2*np.log(absz / B))))
+            w = np.log(np.abs(num) / np.abs(den)) + 1j*(np.angle(num) - np.angle(den))
+        w = np.where(zero, math.log(A/B), w)
+        return (w.real, w.imag)
+    def _polar_tx(self, u, p):
+        # the double-sech transformation of the points with log-magnitudes u and arguments p
+        r = np.exp(u)
+        return self._layerless_tx(r*np.cos(p), r*np.sin(p))
+    def _image_grid(self):
+        # yields (u, p, tree) where u and p are the log-magnitudes and arguments of a grid of points
+        # and tree is a KD-tree of their images under the double-sech transformation; this is built
+        # the first time it is needed and is then kept by the model
+        grid = self.__dict__.get('_image_grid_cache')
+        if grid is None:
+            (u, p) = np.meshgrid(np.linspace(*SchiraModel.image_grid_magnitudes),
+                                 np.linspace(-math.pi, math.pi, SchiraModel.image_grid_arguments))
+            (u, p) = (u.flatten(), p.flatten())
+            grid = (u, p, space.cKDTree(np.transpose(self._polar_tx(u, p))))
+            self.__dict__['_image_grid_cache'] = grid
+        return grid
+    def _layerless_nearest(self, x, y, z, max_iterations=25):
+        # yields the points whose images under the double-sech transformation are nearest to the
+        # points (x, y), which lie outside of its image; each point is found by two Levenberg-
+        # Marquardt searches over (log |z|, arg z), one starting from the given point z and one from
+        # the point of the image grid whose image is nearest, of which the better is kept; each step
+        # tries all of the damping factors in SchiraModel.nearest_damping, so the cost is bounded
+        (gu, gp, tree) = self._image_grid()
+        n = len(x)
+        (_, ii) = geo.kdtree_query(tree, np.transpose([x, y]))
+        with np.errstate(divide='ignore'):
+            (u, p) = (np.log(np.abs(z)), np.angle(z))
+        u = np.where(np.isfinite(u), u, gu[ii])
+        (u, p) = (np.concatenate([u, gu[ii]]), np.concatenate([p, gp[ii]]))
+        (x, y) = (np.tile(x, 2), np.tile(y, 2))
+        def residual(u, p, x, y):
+            (fx, fy) = self._polar_tx(u, p)
+            return np.asarray([fx - x, fy - y])
+        r = residual(u, p, x, y)
+        d2 = np.sum(r**2, axis=0)
+        mu = np.asarray(SchiraModel.nearest_damping)[:,None]
+        k = len(mu)
+        (h, pi) = (1e-6, math.pi)
+        active = np.ones(len(x), dtype=bool)
+        for _ in range(max_iterations):
+            if not active.any(): break
+            (ua, pa, xa, ya, ra, d2a) = (u[active], p[active], x[active], y[active],
+                                         r[:,active], d2[active])
+            # the Jacobian by central differences, one-sided at the branch cut arg z = +/- pi
+            ju = (residual(ua + h, pa, xa, ya) - residual(ua - h, pa, xa, ya)) / (2*h)
+            (pp, pm) = (np.minimum(pa + h, pi), np.maximum(pa - h, -pi))
+            jp = (residual(ua, pp, xa, ya) - residual(ua, pm, xa, ya)) / (pp - pm)
+            (a, b, c) = (np.sum(ju*ju, axis=0), np.sum(ju*jp, axis=0), np.sum(jp*jp, axis=0))
+            (gu_, gp_) = (np.sum(ju*ra, axis=0), np.sum(jp*ra, axis=0))
+            # the steps for all damping factors, evaluated at once
+            lam = mu * (a + c)
+            with np.errstate(all='ignore'):
+                det = (a + lam)*(c + lam) - b*b
+                us = ua - ((c + lam)*gu_ - b*gp_) / det
+                ps = pa - ((a + lam)*gp_ - b*gu_) / det
+                # a step across the branch cut is instead taken along it
+                cut = (np.abs(ps) > pi) & (np.abs(pa) >= pi)
+                us = np.where(cut, ua - gu_ / (a + lam), us)
+                ps = np.clip(np.where(cut, pa, ps), -pi, pi)
+                rs = np.reshape(residual(us.flatten(), ps.flatten(), np.tile(xa, k),
+                                         np.tile(ya, k)),
+                                (2, k, -1))
+                d2s = np.sum(rs**2, axis=0)
+            d2s[~np.isfinite(d2s)] = np.inf
+            (best, jj) = (np.argmin(d2s, axis=0), np.arange(len(ua)))
+            better = (d2s[best, jj] < d2a)
+            # stop once no damping factor reduces the residual by a meaningful fraction
+            still = better & (d2s[best, jj] < d2a * (1.0 - 1e-12))
+            ua[better] = us[best, jj][better]
+            pa[better] = ps[best, jj][better]
+            ra[:,better] = rs[:, best, jj][:,better]
+            d2a[better] = d2s[best, jj][better]
+            (u[active], p[active], r[:,active], d2[active]) = (ua, pa, ra, d2a)
+            active[np.where(active)[0][~still]] = False
+        # the better search of each point
+        best = np.argmin(np.reshape(np.where(np.isfinite(d2), d2, np.inf), (2, n)), axis=0)
+        (u, p) = (np.reshape(u, (2, n))[best, np.arange(n)],
+                  np.reshape(p, (2, n))[best, np.arange(n)])
+        r = np.exp(u)
+        return (r*np.cos(p), r*np.sin(p))
+    def _layerless_rx(self, x, y, tol=1e-12, max_iterations=100):
+        # the inverse of the double-sech transformation, found by Newton's method; the starting
+        # point is the inverse of the plain log-polar transformation log((A + z) / (B + z)); the
+        # points that lie outside of the transformation's image yield the points whose images are
+        # nearest to them (see _layerless_nearest)
+        (A, B) = (self.parameters['A'], self.parameters['B'])
+        (x, y) = (np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+        center = (np.abs(y) < SchiraModel.zero_tolerance) & (x == math.log(A/B))
+        with np.errstate(all='ignore'):
+            e = np.exp(x + 1j*y)
+            z = (A - B*e) / (e - 1.0)
+        z = np.where(center | ~np.isfinite(z), 0.11 - 0.27j, z)
+        def residual(z, x, y):
+            (fx, fy) = self._layerless_tx(z.real, z.imag)
+            return np.asarray([fx - x, fy - y])
+        r = residual(z, x, y)
+        d2 = np.sum(r**2, axis=0)
+        active = ~center & (d2 >= tol*tol)
+        for _ in range(max_iterations):
+            if not active.any(): break
+            (za, ra, d2a) = (z[active], r[:,active], d2[active])
+            (xa, ya) = (x[active], y[active])
+            # the Jacobian by central differences
+            h = 1e-6 * (1.0 + np.abs(za))
+            jx = (residual(za + h, xa, ya) - residual(za - h, xa, ya)) / (2*h)
+            jy = (residual(za + 1j*h, xa, ya) - residual(za - 1j*h, xa, ya)) / (2*h)
+            det = jx[0]*jy[1] - jy[0]*jx[1]
+            with np.errstate(all='ignore'):
+                dz = ((jy[1]*ra[0] - jy[0]*ra[1]) + 1j*(jx[0]*ra[1] - jx[1]*ra[0])) / det
+            dz[~np.isfinite(dz)] = 0
+            # backtrack until the residual decreases
+            t = np.ones(len(za))
+            for _ in range(40):
+                znew = za - t*dz
+                rnew = residual(znew, xa, ya)
+                d2new = np.sum(rnew**2, axis=0)
+                worse = ~(d2new < d2a)
+                if not worse.any(): break
+                t[worse] *= 0.5
+            better = (d2new < d2a)
+            # points whose residual is not at least halved are left to _layerless_nearest
+            fast = (d2new < 0.5*d2a)
+            za[better] = znew[better]
+            ra[:,better] = rnew[:,better]
+            d2a[better] = d2new[better]
+            (z[active], r[:,active], d2[active]) = (za, ra, d2a)
+            # stop once converged or once progress slows
+            still = fast & (d2a >= tol*tol)
+            active[np.where(active)[0][~still]] = False
+        z = np.where(center, 0.0, z)
+        (zx, zy) = (z.real, z.imag)
+        # points without an exact inverse
+        outside = ~center & ~(d2 < 1e-14)
+        if outside.any():
+            (zx[outside], zy[outside]) = self._layerless_nearest(x[outside], y[outside],
+                                                                 z[outside])
+        return (zx, zy)
+
+    def _angle_to_cortex(self, theta, rho):
+        # theta and rho must be vectors; yields an n x 5 x 2 array
+        p = self.parameters
+        zz = math.pi/180.0 * (90.0 - np.asarray(theta, dtype=np.float64)) * 2.0 / math.pi
+        abszz = np.abs(zz)
+        sgn = np.where(abszz < SchiraModel.zero_tolerance, 1.0, np.sign(zz))
+        rho = np.abs(np.asarray(rho, dtype=np.float64))
+        (v1, v2, v3) = (p['v1size'], p['v2size'], p['v3size'])
+        layers = np.asarray([v1 * zz,
+                             sgn * (v1 + v2*(1.0 - abszz)),
+                             sgn * (v1 + v2 + v3*abszz),
+                             v1 + v2 + v3 + p['hv4size']*(1.0 - 0.5*(zz + 1.0)),
+                             -(v1 + v2 + v3 + 0.5*p['v3asize']*(zz + 1.0))])
+        (x, y) = (rho * np.cos(layers), rho * np.sin(layers))
+        (x, y) = self._lambda_tx(x, y)
+        (x, y) = self._layerless_tx(x, y)
+        (x, y) = self._final_tx(x, y)
+        return np.transpose([x, y], (2, 1, 0))
+    def _cortex_to_angle(self, x, y):
+        # x and y must be vectors; yields an n x 3 array
+        (p, c) = (self.parameters, self._constants)
+        (x, y) = self._final_rx(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+        (x, y) = self._layerless_rx(x, y)
+        (x, y) = self._lambda_rx(x, y)
+        (zz, rho) = (np.arctan2(y, x), np.sqrt(x*x + y*y))
+        abszz = np.abs(zz)
+        sgn = np.where(abszz < SchiraModel.zero_tolerance, 1.0, np.sign(zz))
+        zeroish = lambda u: np.abs(u) < SchiraModel.zero_tolerance
+        v1 = p['v1size']
+        (v2b, v3b, hv4b, v3ab) = (c['v2_bound'], c['v3_bound'], c['hv4_bound'], c['v3a_bound'])
+        with np.errstate(all='ignore'):
+            conds = [zeroish(abszz - v1),
+                     abszz < v1,
+                     zeroish(abszz - v2b),
+                     abszz < v2b,
+                     zeroish(abszz - v3b),
+                     abszz < v3b,
+                     (sgn < 0) & (abszz <= v3ab),
+                     (sgn > 0) & (abszz <= hv4b),
+                     sgn < 0]
+            angs = [sgn,
+                    zz / v1,
+                    np.zeros(zz.shape),
+                    sgn * (1.0 - (abszz - v1)/p['v2size']),
+                    sgn,
+                    sgn * (abszz - v2b)/p['v3size'],
+                    2*(abszz - v3b)/p['v3asize'] - 1.0,
+                    2*(1.0 - (abszz - v3b)/p['hv4size']) - 1.0,
+                    (abszz - v3ab) / (v3ab - 2.0)]
+            ang = np.select(conds, angs, (abszz - hv4b) / (2.0 - hv4b))
+        area = np.select(conds, [1.5, 1.0, 2.5, 2.0, 3.5, 3.0, 4.0, -4.0, 0.0], 0.0)
+        return np.transpose([90.0 - 180.0/math.pi * (0.5*math.pi*ang), rho, area])
+
+    def angle_to_cortex(self, theta, rho):
+        iterTheta = hasattr(theta, '__iter__')
+        iterRho = hasattr(rho, '__iter__')
+        if iterTheta and iterRho:
+            if len(theta) != len(rho):
+                raise RuntimeError('Arguments theta and rho must be the same length!')
+            return self._angle_to_cortex(theta, rho)
+        elif iterTheta:
+            return self._angle_to_cortex(theta, [rho for t in theta])
+        elif iterRho:
+            return self._angle_to_cortex([theta for r in rho], rho)
+        else:
+            return self._angle_to_cortex([theta], [rho])[0]
+    def cortex_to_angle(self, x, y):
+        iterX = hasattr(x, '__iter__')
+        iterY = hasattr(y, '__iter__')
+        if iterX and iterY:
+            if len(x) != len(y):
+                raise RuntimeError('Arguments x and y must be the same length!')
+            return self._cortex_to_angle(x, y)
+        elif iterX:
+            return self._cortex_to_angle(x, [y for i in x])
+        elif iterY:
+            return self._cortex_to_angle([x for i in y], y)
+        else:
+            return self._cortex_to_angle([x], [y])[0]
+
+class JavaSchiraModel(SchiraModel):
+    '''
+    The JavaSchiraModel class is identical to the SchiraModel class except that its calculations
+    are performed by the Java nben.neuroscience.SchiraModel class; it requires the JVM and is
+    primarily intended as a reference for the NumPy implementation of the SchiraModel class.
+    '''
+    def __init__(self, **opts):
+        SchiraModel.__init__(self, **opts)
+        params = self.parameters
         # Okay, let's construct the object...
         self.__dict__['_java_object'] = java_link().jvm.nben.neuroscience.SchiraModel(
             params['A'],
@@ -120,6 +441,10 @@ class SchiraModel(RetinotopyModel):
             params['shear'][1][0])
     
     def angle_to_cortex(self, theta, rho):
+        # the arrays must be made on the gateway to which the model object belongs
+        with java_gateway(java_object_gateway(self._java_object)):
+            return self._java_angle_to_cortex(theta, rho)
+    def _java_angle_to_cortex(self, theta, rho):
         iterTheta = hasattr(theta, '__iter__')
         iterRho = hasattr(rho, '__iter__')
         jarr = None
@@ -134,9 +459,12 @@ class SchiraModel(RetinotopyModel):
             jarr = self._java_object.angleToCortex(to_java_doubles([theta for r in rho]),
                                                    to_java_doubles(rho))
         else:
-            return self._java_object.angleToCortex(theta, rho)
-        return np.asarray([[c for c in r] for r in jarr])
+            return from_java_doubles(self._java_object.angleToCortex(theta, rho))
+        return from_java_doubles(jarr)
     def cortex_to_angle(self, x, y):
+        with java_gateway(java_object_gateway(self._java_object)):
+            return self._java_cortex_to_angle(x, y)
+    def _java_cortex_to_angle(self, x, y):
         iterX = hasattr(x, '__iter__')
         iterY = hasattr(y, '__iter__')
         jarr = None
@@ -151,8 +479,8 @@ class SchiraModel(RetinotopyModel):
             jarr = self._java_object.cortexToAngle(to_java_doubles([x for i in y]),
                                                    to_java_doubles(y))
         else:
-            return self._java_object.cortexToAngle(x, y)
-        return np.asarray([[c for c in r] for r in jarr])
+            return from_java_doubles(self._java_object.cortexToAngle(x, y))
+        return from_java_doubles(jarr)
         
 
 class RetinotopyMeshModel(RetinotopyModel):
@@ -5,10 +5,13 @@
 
 import numpy                        as np
 import scipy                        as sp
+import scipy.spatial                as space
 import nibabel.freesurfer.io        as fsio
 import nibabel.freesurfer.mghformat as fsmgh
 
-import os, sys, gzip
+import os, sys, gzip, time, itertools, multiprocessing, hashlib, threading, collections, inspect
+
+from multiprocessing.pool import ThreadPool
 
 from numpy.linalg import norm
 from math         import pi
@@ -19,9 +22,12 @@ from neuropythy.cortex       import (CorticalMesh)
 from neuropythy.freesurfer   import (freesurfer_subject, add_subject_path,
                                      cortex_to_ribbon, cortex_to_ribbon_map,
                                      Hemisphere, subject_paths)
-from neuropythy.topology     import (Registration)
-from neuropythy.registration import (mesh_register, java_potential_term)
-from neuropythy.java         import (to_java_doubles, to_java_ints)
+from neuropythy.topology     import (Registration, _registration_hash)
+from neuropythy.geometry     import (apply_interpolation_matrix, kdtree_query)
+from neuropythy.registration import (mesh_register, java_potential_term,
+                                     load_registration_checkpoint)
+from neuropythy.java         import (to_java_doubles, to_java_ints, from_java_doubles)
+from neuropythy.util         import (atomic_write)
 
 from .models import (RetinotopyModel, SchiraModel, RetinotopyMeshModel, RegisteredRetinotopyModel,
                      load_fmm_model)
@@ -398,10 +404,10 @@ def retinotopy_mesh_field(mesh, mdl,
     # now, if we want to exclude outliers, we do so here:
     if exclusion_threshold is not None:
         jpe = java_potential_term(mesh, field_desc)
-        jcrds = to_java_doubles(mesh.coordinates)
+        jcrds = to_java_doubles(mesh.coordinates, cache=True)
         jgrad = to_java_doubles(np.zeros(mesh.coordinates.shape))
         jpe.calculate(jcrds,jgrad)
-        gnorms = np.sum((np.asarray([[x for x in row] for row in jgrad])[:, idcs])**2, axis=0)
+        gnorms = np.sum((from_java_doubles(jgrad)[:, idcs])**2, axis=0)
         gnorms_pos = gnorms[gnorms > 0]
         mdn = np.median(gnorms_pos)
         std = np.std(gnorms_pos)
@@ -508,47 +514,320 @@ def retinotopy_anchors(mesh, mdl,
     (polar_angle, eccentricity, weight) = _retinotopy_vectors_to_float(
         polar_angle, eccentricity, weight,
         weight_cutoff=weight_cutoff)
-    idcs = [i for (i,w) in enumerate(weight) if w > 0]
+    idcs = np.where(weight > 0)[0]
     # Interpret the select arg if necessary (but don't apply it yet)
     select = ['close', [20]] if select == 'close'   else \
              ['close', [20]] if select == ['close'] else \
              select
+    # Okay, apply the model; res is an (n x k x 2) array of the k anchors of each of the n vertices
+    # in which anchors that the model could not place are nan
+    if len(idcs) == 0:
+        # a reshape cannot infer the number of anchors of no vertices
+        res = np.zeros((0, 0, 2), dtype=np.float64)
+    else:
+        res = np.asarray(mdl.angle_to_cortex(polar_angle[idcs], eccentricity[idcs]))
+        if res.dtype == np.object:
+            res = np.where(np.vectorize(lambda u: u is None, otypes=[np.bool])(res), np.nan, res)
+        res = np.reshape(np.asarray(res, dtype=np.float64), (len(idcs), -1, 2))
+    valid = np.all(np.isfinite(res), axis=2)
     if select is None:
-        select = lambda a,b: b
+        pass
     elif isinstance(select, list) and len(select) == 2 and select[0] == 'close':
         d = np.mean(mesh.edge_lengths)*select[1][0] if isinstance(select[1], list) else select[1]
-        select = lambda idx,ancs: [a for a in ancs if a[0] is not None if norm(X[idx] - a) < d]
-    # Okay, apply the model:
-    res = mdl.angle_to_cortex(polar_angle[idcs], eccentricity[idcs])
-    # Organize the data; trim out those not selected
-    data = [[[i for _ in r], r]
-            for (i,r0) in zip(idcs, res)
-            if r0[0] is not None
-            for r in [select(i, r0)]
-            if len(r) > 0]
-    # Flatten out the data into arguments for Java
-    idcs = [int(i) for d in data for i in d[0]]
-    ancs = np.asarray([pt for d in data for pt in d[1]]).T
+        with np.errstate(invalid='ignore'):
+            valid &= np.sqrt(np.sum((res - X[idcs][:,None,:])**2, axis=2)) < d
+    else:
+        # an arbitrary select function must be called for each vertex; it may yield any list of
+        # anchors, so the anchor matrix is rebuilt from its results
+        sel = [np.reshape(np.asarray(select(i, [a for a in r0[v0]]), dtype=np.float64), (-1, 2))
+               for (i,r0,v0) in zip(idcs, res, valid)]
+        kmax = max([len(r) for r in sel] + [0])
+        res = np.full((len(idcs), kmax, 2), np.nan, dtype=np.float64)
+        valid = np.zeros((len(idcs), kmax), dtype=np.bool)
+        for (k,r) in enumerate(sel):
+            res[k,:len(r)] = r
+            valid[k,:len(r)] = True
+    # Flatten out the data into arguments for Java; the anchors are grouped by vertex
+    (vi, ai) = np.nonzero(valid)
+    ancs = np.ascontiguousarray(res[vi, ai].T)
     # Get just the relevant weights and the scale
-    wgts = weight[idcs] * (1 if scale is None else scale)
+    wgts = np.ascontiguousarray(weight[idcs[vi]] * (1 if scale is None else scale),
+                                dtype=np.float64)
     # Figure out the sigma parameter:
     if sigma is None: sigs = None
     elif isinstance(sigma, Number) or np.issubdtype(type(sigma), np.float): sigs = sigma
     elif hasattr(sigma, '__iter__') and len(sigma) == 3:
         [minsig, mult, maxsig] = sigma
-        sigs = np.clip(
-            [mult*min([norm(a0 - a) for a in anchs if a is not a0]) if len(iii) > 1 else maxsig
-             for (iii,anchs) in data
-             for a0 in anchs],
-            minsig, maxsig)
+        # the distance from each anchor to the nearest other anchor of the same vertex
+        k = res.shape[1]
+        with np.errstate(invalid='ignore'):
+            dists = np.sqrt(np.sum((res[:,:,None,:] - res[:,None,:,:])**2, axis=3))
+        dists[~(valid[:,:,None] & valid[:,None,:])] = np.inf
+        dists[:, np.arange(k), np.arange(k)] = np.inf
+        mind = np.min(dists, axis=2) if k > 0 else np.zeros((len(idcs), 0))
+        counts = np.sum(valid, axis=1)
+        sigs = np.where(counts[:,None] > 1, mult * mind, maxsig)
+        sigs = np.ascontiguousarray(np.clip(sigs[vi, ai], minsig, maxsig), dtype=np.float64)
     else:
         raise ValueError('sigma must be a number or a list of 3 numbers')
+    idcs = np.ascontiguousarray(idcs[vi], dtype=np.int32)
     # okay, we've partially parsed the data that was given; now we can construct the final list of
     # instructions:
     return (['anchor', shape, idcs, ancs, 'scale', wgts]
             + ([] if sigs is None else ['sigma', sigs])
             + ([] if suffix is None else suffix))
 
+def _retinotopy_field(mesh, model, edge_scale, angle_scale, functional_scale,
+                      edge_max_compression, edge_max_stretch, select, sigma):
+    # yields the potential field instructions that register_retinotopy minimizes over the map mesh
+    elens = mesh.edge_lengths
+    if edge_max_compression is None and edge_max_stretch is None:
+        edge_well_potential = []
+    else: 
+        emin = 0 if edge_max_compression is None else edge_max_compression * elens
+        emax = (10**6) * elens if edge_max_stretch is None else edge_max_stretch * elens
+        edge_well_potential = [['edge', 'infinite-well', 'min', emin, 'max', emax]]
+    return edge_well_potential + [
+        ['angle',     'infinite-well'],
+        ['edge',      'harmonic',      'scale', edge_scale],
+        ['angle',     'harmonic',      'scale', angle_scale],
+        ['perimeter', 'harmonic'],
+        retinotopy_anchors(mesh, model,
+                           polar_angle='polar_angle',
+                           eccentricity='eccentricity',
+                           weight='weight',
+                           weight_cutoff=0, # taken care of above
+                           scale=functional_scale,
+                           select=select,
+                           **({} if sigma is Ellipsis else {'sigma':sigma}))]
+
+def retinotopy_map_level(m, order, max_edge_ratio=2):
+    '''
+    retinotopy_map_level(m, order) yields a coarse version of the 2D map mesh m, as made by
+    register_retinotopy_initialize when its resample option is 'fsaverage' or 'fsaverage_sym', that
+    includes only the map vertices that belong to the icosahedral mesh of the given order; these
+    are the vertices whose labels are less than 10 * 4**order + 2. The coarse vertices are
+    triangulated by a Delaunay triangulation of their map coordinates, from which the triangles with
+    an edge longer than max_edge_ratio (default: 2) times the median edge length are removed (these
+    span concave stretches of the map's boundary), and the map's properties are carried over.
+    '''
+    n = 10 * 4**order + 2
+    I = np.where(np.asarray(m.vertex_labels) < n)[0]
+    if len(I) < 3:
+        raise ValueError('icosahedral order %d includes fewer than 3 map vertices' % order)
+    X = m.coordinates[:, I]
+    tris = space.Delaunay(X.T).simplices.T
+    lens = np.asarray([np.sqrt(np.sum((X[:,tris[a]] - X[:,tris[b]])**2, axis=0))
+                       for (a,b) in [(0,1), (1,2), (2,0)]])
+    tris = tris[:, np.max(lens, axis=0) <= max_edge_ratio * np.median(lens)]
+    # some vertices may no longer be in any triangle
+    (J, tris) = np.unique(tris, return_inverse=True)
+    I = I[J]
+    L = np.asarray(m.vertex_labels)[I]
+    # only the map's own properties have one value per map vertex (those of a hemisphere do not)
+    props = {p: np.asarray(v)[I] for (p,v) in m.properties.iteritems() if v is not None}
+    return CorticalMesh(m.coordinates[:, I], L[np.reshape(tris, (3, -1))],
+                        vertex_labels=L, properties=props)
+
+def _prolongate_registration(coarse, coarse_X, fine):
+    # interpolates the displacement of the coarse mesh's vertices from their reference positions to
+    # coarse_X onto the vertices of the fine mesh; barycentric interpolation is used inside the
+    # coarse mesh's convex hull and the displacement of the nearest coarse vertex outside of it
+    X0 = coarse.coordinates
+    D = np.asarray(coarse_X) - X0
+    Y0 = fine.coordinates
+    tri = space.Delaunay(X0.T)
+    s = tri.find_simplex(Y0.T)
+    inside = np.where(s >= 0)[0]
+    outside = np.where(s < 0)[0]
+    disp = np.zeros(Y0.shape)
+    if len(inside) > 0:
+        T = tri.transform[s[inside]]
+        bc = np.einsum('nij,nj->ni', T[:,:2], Y0[:,inside].T - T[:,2])
+        bc = np.concatenate([bc, 1 - np.sum(bc, axis=1)[:,None]], axis=1)
+        disp[:,inside] = np.einsum('dnk,nk->dn', D[:, tri.simplices[s[inside]]], bc)
+    if len(outside) > 0:
+        (_, nei) = kdtree_query(space.cKDTree(X0.T), Y0[:,outside].T)
+        disp[:,outside] = D[:,nei]
+    return disp
+
+def _registration_is_valid(mesh, X, edge_max_compression, edge_max_stretch):
+    # yields True if no triangle of the mesh is flipped at the coordinates X and no edge is outside
+    # the limits of the edge infinite-well; i.e., if the potential at X is finite
+    X0 = mesh.coordinates
+    F = mesh.indexed_faces
+    def signed_areas(X):
+        (a, b) = (X[:,F[1]] - X[:,F[0]], X[:,F[2]] - X[:,F[0]])
+        return a[0]*b[1] - a[1]*b[0]
+    if np.any(signed_areas(X0) * signed_areas(X) <= 0): return False
+    E = mesh.indexed_edges
+    l0 = mesh.edge_lengths
+    l = np.sqrt(np.sum((X[:,E[0]] - X[:,E[1]])**2, axis=0))
+    if edge_max_compression is not None and np.any(l <= edge_max_compression * l0): return False
+    if edge_max_stretch is not None and np.any(l >= edge_max_stretch * l0): return False
+    return True
+
+def _limit_displacement(mesh, disp, edge_max_compression, edge_max_stretch, max_halvings=10):
+    # halves the displacement disp of the mesh's vertices from their reference positions until
+    # moving the vertices by it yields a finite potential; if it never does, yields 0 displacement
+    for _ in range(max_halvings):
+        if _registration_is_valid(mesh, mesh.coordinates + disp,
+                                  edge_max_compression, edge_max_stretch):
+            return disp
+        disp = 0.5 * disp
+    return np.zeros(disp.shape)
+
+# The cache of register_retinotopy_initialize stages #############################################
+# The stages of register_retinotopy_initialize that do not depend on the retinotopy data (aligning
+# the subject to the prior, finding the subject in the resampling registration, and projecting the
+# resampled map) are cached in memory, keyed by the content hashes of the registrations involved and
+# by the model; if an on-disk cache directory is given, the addresses are additionally saved there
+# so that other processes may load them.
+_retinotopy_cache_path = os.environ.get('NEUROPYTHY_RETINOTOPY_CACHE', None)
+if _retinotopy_cache_path: _retinotopy_cache_path = os.path.expanduser(_retinotopy_cache_path)
+else:                      _retinotopy_cache_path = None
+_retinotopy_cache = collections.OrderedDict()
+_retinotopy_cache_size = 16
+_retinotopy_cache_lock = threading.Lock()
+
+def retinotopy_cache_path():
+    '''
+    retinotopy_cache_path() yields the directory in which the subject addresses calculated by
+    register_retinotopy_initialize are cached on disk, or None if the on-disk cache is disabled. The
+    on-disk cache is disabled unless the NEUROPYTHY_RETINOTOPY_CACHE environment variable gives its
+    directory or one is set by set_retinotopy_cache_path.
+    '''
+    return _retinotopy_cache_path
+
+def set_retinotopy_cache_path(path):
+    '''
+    set_retinotopy_cache_path(path) sets the directory in which the subject addresses calculated by
+    register_retinotopy_initialize (the address of the subject's vertices in the prior and in the
+    resampling registration) are cached on disk; if path is None, the on-disk cache is disabled. The
+    files are named by the hashes of the contents of the registrations involved, so a cache
+    directory may be shared by many processes and subjects. Note that the interpolation matrices
+    used in resampling are cached separately; see neuropythy.topology.interpolation_cache_path.
+    '''
+    global _retinotopy_cache_path
+    _retinotopy_cache_path = None if path is None else os.path.expanduser(path)
+    return _retinotopy_cache_path
+
+def clear_retinotopy_cache():
+    '''
+    clear_retinotopy_cache() clears the in-memory cache of the stages of
+    register_retinotopy_initialize; the on-disk cache (see retinotopy_cache_path) is not changed.
+    '''
+    with _retinotopy_cache_lock:
+        _retinotopy_cache.clear()
+
+def _retinotopy_cache_file(key):
+    if _retinotopy_cache_path is None: return None
+    return os.path.join(_retinotopy_cache_path, hashlib.sha1(repr(key)).hexdigest() + '.npz')
+
+def _retinotopy_cache_get(key, persist=()):
+    # yields the cached dict for the given key or None; if persist is not empty, the entries named
+    # in it are loaded from the on-disk cache when the key is not in memory
+    with _retinotopy_cache_lock:
+        if key in _retinotopy_cache:
+            val = _retinotopy_cache.pop(key)
+            _retinotopy_cache[key] = val
+            return val
+    flnm = _retinotopy_cache_file(key) if persist else None
+    if flnm is None or not os.path.isfile(flnm): return None
+    try:
+        with np.load(flnm) as dat:
+            return {k:dat[k] for k in persist}
+    except Exception:
+        return None
+
+def _retinotopy_cache_put(key, val, persist=()):
+    # stores the dict val in the in-memory cache and the entries named in persist on disk; the
+    # arrays are shared by all users of the cache, so they are made read-only
+    for v in val.itervalues():
+        if isinstance(v, np.ndarray): v.flags.writeable = False
+    with _retinotopy_cache_lock:
+        _retinotopy_cache.pop(key, None)
+        _retinotopy_cache[key] = val
+        while len(_retinotopy_cache) > _retinotopy_cache_size:
+            _retinotopy_cache.popitem(last=False)
+    flnm = _retinotopy_cache_file(key) if persist else None
+    if flnm is None or os.path.isfile(flnm): return val
+    # as with the interpolation cache, the file is written atomically and failures are ignored
+    try:
+        atomic_write(flnm, lambda f: np.savez(f, **{k:val[k] for k in persist}), suffix='.npz')
+    except Exception:
+        pass
+    return val
+
+def _prior_alignment_stage(subreg, prior_reg0, prior_reg1):
+    # yields (address, coordinates) where address is the address of the subject's registration
+    # subreg in the prior subject's model registration prior_reg0 and coordinates are the subject's
+    # coordinates in the prior registration prior_reg1
+    key = ('prior', _registration_hash(subreg),
+           _registration_hash(prior_reg0), _registration_hash(prior_reg1))
+    persist = ('face_id', 'coordinates', 'prior_coordinates')
+    val = _retinotopy_cache_get(key, persist)
+    if val is None:
+        addr = prior_reg0.address(subreg.coordinates)
+        val = {'face_id':           addr['face_id'],
+               'coordinates':       addr['coordinates'],
+               'prior_coordinates': prior_reg1.unaddress(addr)}
+    val = _retinotopy_cache_put(key, val, persist)
+    return ({'face_id': val['face_id'], 'coordinates': val['coordinates']},
+            val['prior_coordinates'])
+
+def _resample_stage(toreg, prior_reg):
+    # yields (address, matrix) where address is the address of the subject's registration prior_reg
+    # in the resampling registration toreg and matrix is the interpolation matrix from prior_reg to
+    # toreg; the matrix is saved on disk by the interpolation cache rather than by this cache
+    key = ('resample', _registration_hash(prior_reg), _registration_hash(toreg))
+    persist = ('face_id', 'coordinates')
+    val = _retinotopy_cache_get(key, persist)
+    if val is None:
+        val = toreg.address(prior_reg.coordinates)
+    if 'matrix' not in val:
+        val = {'face_id':     val['face_id'],
+               'coordinates': val['coordinates'],
+               'matrix':      toreg.interpolation_matrix(prior_reg)}
+    val = _retinotopy_cache_put(key, val, persist)
+    return ({'face_id': val['face_id'], 'coordinates': val['coordinates']}, val['matrix'])
+
+def _resampled_map_stage(tohem, toreg, model):
+    # yields (mesh, map) where mesh is the registration mesh of the resampling registration and map
+    # is its projection by the model, without any retinotopy properties; the model is kept in the
+    # cache entry so that its id is not reused while the entry is alive
+    key = ('map', _registration_hash(toreg), id(model))
+    val = _retinotopy_cache_get(key)
+    if val is None:
+        mesh = tohem.registration_mesh(toreg)
+        val = {'model': model,
+               'mesh':  mesh,
+               'map':   model.projection_data['forward_function'](mesh)}
+    val = _retinotopy_cache_put(key, val)
+    return (val['mesh'], val['map'])
+
+def _warm_start_coordinates(hemi, registration):
+    # yields the (n x 3) coordinate matrix of the given registration of the hemisphere, which may be
+    # the name of one of its registrations, a FreeSurfer sphere.reg filename, a Registration, or a
+    # coordinate matrix
+    if isinstance(registration, basestring):
+        if registration in hemi.topology.registrations:
+            X = hemi.topology.registrations[registration].coordinates
+        elif os.path.isfile(registration):
+            X = fsio.read_geometry(registration)[0]
+        else:
+            raise ValueError('initial_registration %s is neither a registration of the hemisphere'
+                             ' nor a file' % registration)
+    elif isinstance(registration, Registration):
+        X = registration.coordinates
+    else:
+        X = np.asarray(registration)
+    X = np.asarray(X, dtype=np.float64)
+    if len(X.shape) == 2 and X.shape[0] == 3 and X.shape[1] != 3: X = X.T
+    if X.shape != (hemi.vertex_count, 3):
+        raise ValueError('initial_registration does not match the hemisphere\'s vertices')
+    return X
+
 def register_retinotopy_initialize(hemi,
                                    model='benson17',
                                    polar_angle=None, eccentricity=None, weight=None,
@@ -558,15 +837,24 @@ def register_retinotopy_initialize(hemi,
                                    prior='retinotopy',
                                    resample='fsaverage_sym',
                                    max_area=None,
-                                   max_eccentricity=None):
+                                   max_eccentricity=None,
+                                   initial_registration=None):
     '''
     register_retinotopy_initialize(hemi, model) yields an fsaverage_sym LH hemisphere that has
     been prepared for retinotopic registration with the data on the given hemisphere, hemi. The
     options polar_angle, eccentricity, weight, and weight_cutoff are accepted, as are the
-    prior and resample options; all are documented in help(register_retinotopy).
+    prior, resample, and initial_registration options; all are documented in
+    help(register_retinotopy).
     The return value of this function is actually a dictionary with the element 'map' giving the
     resulting map projection, and additional entries giving other meta-data calculated along the
     way.
+    The stages of the initialization that do not depend on the retinotopy data are cached: the
+    alignment of the subject to the prior and the resampling are keyed by the contents of the
+    registrations involved, and the resampled map projection by the resampling registration and the
+    model, so initializing the same subject again (e.g., with different data) reuses them. If an
+    on-disk cache is enabled (see set_retinotopy_cache_path), the addresses are also cached there;
+    the resampling interpolation matrices are cached by the interpolation cache. See also
+    clear_retinotopy_cache.
     '''
     # Step 0: Initialization of variables ##########################################################
     prop_names = ['polar_angle', 'eccentricity', 'weight']
@@ -641,9 +929,8 @@ def register_retinotopy_initialize(hemi,
             raise ValueError('Model registratio not found in prior subject: %s' % prior_subject)
         prior_reg0 = prior_hemi.topology.registrations[model_reg]
         prior_reg1 = prior_hemi.topology.registrations[prior]
-        addr = prior_reg0.address(subreg.coordinates)
+        (addr, coords) = _prior_alignment_stage(subreg, prior_reg0, prior_reg1)
         data['address_in_prior'] = addr
-        coords = prior_reg1.unaddress(addr)
     prior_reg = Registration(proj_from_hemi.topology, coords)
     data['prior_registration'] = prior_reg
     data['prior_hemisphere'] = prior_hemi
@@ -667,31 +954,51 @@ def register_retinotopy_initialize(hemi,
         else:
             raise ValueError('resample argument must be fsaverage, fsaverage_sym, or None')
         data['resample_hemisphere'] = tohem
-        resamp_addr = toreg.address(prior_reg.coordinates)
+        (resamp_addr, interp_mtx) = _resample_stage(toreg, prior_reg)
         data['resample_address'] = resamp_addr
         data['initial_registration'] = toreg
+        # resample all of the properties at once, as columns of one matrix
+        interp = apply_interpolation_matrix(
+            interp_mtx,
+            np.transpose([data['sub_' + p] for p in prop_names + ['curvature']]))
         for (p,v) in zip(prop_names,
-                         _retinotopy_vectors_to_float(
-                             *[toreg.interpolate_from(prior_reg, data['sub_' + p])
-                               for p in prop_names])):
+                         _retinotopy_vectors_to_float(*[interp[:,k]
+                                                        for k in range(len(prop_names))])):
             data['initial_' + p] = v
-        data['initial_curvature'] = toreg.interpolate_from(prior_reg, data['sub_curvature'])
+        data['initial_curvature'] = interp[:,len(prop_names)]
         data['unresample_function'] = lambda rr: Registration(proj_from_hemi.topology,
                                                               rr.unaddress(resamp_addr))
-    data['initial_mesh'] = tohem.registration_mesh(toreg)
-    # Step 4: make the projection
+    # Step 4: make the projection; the resampled map is shared, so we add the data to a copy of it
     proj_data = model.projection_data
     if resample is None:
+        data['initial_mesh'] = tohem.registration_mesh(toreg)
         proj_data = proj_from_hemi.projection_data(center=proj_data['center'],
                                                    center_right=proj_data['center_right'],
                                                    method=proj_data['method'],
                                                    registration=proj_data['registration'],
                                                    radius=proj_data['radius'])
-    m = proj_data['forward_function'](data['initial_mesh'])
+        m = proj_data['forward_function'](data['initial_mesh'])
+    else:
+        (data['initial_mesh'], m) = _resampled_map_stage(tohem, toreg, model)
+        m = m.using()
     for p in prop_names:
         m.prop(p, data['initial_' + p][m.vertex_labels])
     m.prop('curvature', data['initial_curvature'][m.vertex_labels])
     data['map'] = m
+    # If we are warm-starting, find the map vertices in the given registration; for a resampled map
+    # these are interpolated from the subject's vertices
+    if initial_registration is not None:
+        warm = Registration(proj_from_hemi.topology,
+                            _warm_start_coordinates(proj_from_hemi, initial_registration))
+        if resample is None:
+            wx = warm.coordinates[m.vertex_labels]
+        else:
+            wx = warm.unaddress(prior_reg.address(toreg.coordinates[m.vertex_labels]))
+        wx = proj_data['forward_function'](wx)
+        # any vertex that could not be found stays at its initial position
+        bad = ~np.all(np.isfinite(wx), axis=0)
+        wx[:,bad] = m.coordinates[:,bad]
+        data['warm_start_coordinates'] = wx
     # Step 5: Annotate how we get back
     def __postproc_fn(reg):
         d = data.copy()
@@ -725,6 +1032,83 @@ def register_retinotopy_initialize(hemi,
     data['postprocess_function'] = __postproc_fn
     return data
 
+def _register_retinotopy_map(data, field_args, max_steps, max_step_size, method,
+                             multiresolution, multiresolution_steps, record_levels=False,
+                             checkpoint=None, checkpoint_steps=None, checkpoint_interval=None,
+                             resume_from=None):
+    # registers the map of the data made by register_retinotopy_initialize to the field given by
+    # field_args (see _retinotopy_field) and yields (coordinates, levels), where levels is a list of
+    # dictionaries of the registration's levels (empty unless record_levels is True)
+    (edge_max_compression, edge_max_stretch) = field_args[4:6]
+    m = data['map']
+    if multiresolution is None or resume_from is not None:
+        (meshes, steps) = ([m], [max_steps])
+    elif data['resample'] is None:
+        raise ValueError('multiresolution registration requires the resample option')
+    else:
+        orders = sorted(multiresolution)
+        meshes = [retinotopy_map_level(m, order) for order in orders] + [m]
+        if multiresolution_steps is None:
+            steps = [max_steps for _ in orders] + [max_steps // 4]
+        elif len(multiresolution_steps) != len(meshes):
+            raise ValueError('multiresolution_steps must give one value per level plus one for the'
+                             ' full-resolution map')
+        else:
+            steps = [int(k) for k in multiresolution_steps]
+    levels = []
+    (prev, prev_X) = (None, None)
+    for (k, (mesh, level_steps)) in enumerate(zip(meshes, steps)):
+        t0 = time.time()
+        if prev is None and 'warm_start_coordinates' not in data:
+            X0 = mesh.coordinates
+        else:
+            if prev is None:
+                # start from the warm-start coordinates of this level's vertices
+                wx = data['warm_start_coordinates']
+                disp = wx[:, m.index[np.asarray(mesh.vertex_labels)]] - mesh.coordinates
+            else:
+                # prolongate the coarser level's registration to this level
+                disp = _prolongate_registration(prev, prev_X, mesh)
+            disp = _limit_displacement(mesh, disp, edge_max_compression, edge_max_stretch)
+            X0 = mesh.coordinates + disp
+        (r, pe) = (X0, None)
+        if level_steps > 0:
+            opts = {}
+            if k == len(meshes) - 1:
+                opts = {'checkpoint':          checkpoint,
+                        'checkpoint_steps':    checkpoint_steps,
+                        'checkpoint_interval': checkpoint_interval,
+                        'resume_from':         resume_from}
+            if record_levels and opts.get('checkpoint') is None and opts.get('resume_from') is None:
+                # one chunk, so that the minimization is unchanged but its report, which gives the
+                # final potential of whichever backend is used, also includes the coordinates
+                opts['chunk_size'] = level_steps
+            res = mesh_register(
+                mesh,
+                _retinotopy_field(mesh, *field_args),
+                method=method,
+                max_steps=level_steps,
+                max_step_size=max_step_size,
+                initial_coordinates=X0,
+                return_report=record_levels,
+                **opts)
+            if not record_levels:
+                r = res
+            elif res is not None:
+                (r, pe) = (res.coordinates, res.final_potential)
+            elif opts.get('resume_from') is not None:
+                # the checkpoint's registration had already finished
+                ckpt = load_registration_checkpoint(resume_from)
+                (r, pe) = (ckpt['coordinates'], ckpt['potential'])
+        dt = time.time() - t0
+        if record_levels:
+            levels.append(make_dict({'vertex_count': mesh.vertex_count,
+                                     'max_steps':    level_steps,
+                                     'time':         dt,
+                                     'potential':    pe}))
+        (prev, prev_X) = (mesh, r)
+    return (r, levels)
+
 def register_retinotopy(hemi,
                         model='benson17',
                         polar_angle=None, eccentricity=None, weight=None, weight_cutoff=0.1,
@@ -739,7 +1123,11 @@ def register_retinotopy(hemi,
                         max_steps=2000, max_step_size=0.05, method='random',
                         max_predicted_eccen=90,
                         return_meta_data=False,
-                        mutate_hemi=Ellipsis):
+                        mutate_hemi=Ellipsis,
+                        checkpoint=None, checkpoint_steps=None, checkpoint_interval=None,
+                        resume_from=None,
+                        multiresolution=None, multiresolution_steps=None,
+                        initial_registration=None):
     '''
     register_retinotopy(hemi) registers the given hemisphere object, hemi, to a model of V1, V2,
       and V3 retinotopy, and yields a copy of hemi that is identical but additionally contains
@@ -865,6 +1253,37 @@ def register_retinotopy(hemi,
       * resample (default: 'fsaverage_sym') specifies that the data should be resampled to one of
         the uniform meshes, 'fsaverage' or 'fsaverage_sym', prior to registration; if None then no
         resampling is performed.
+      * checkpoint, checkpoint_steps, checkpoint_interval, and resume_from (default: None) are
+        passed along to mesh_register; they may be used to periodically save the state of a long
+        registration to a .npz file and to resume the registration from such a file. When the
+        multiresolution option is used, they apply only to the final, full-resolution level.
+      * multiresolution (default: None) may be a list of icosahedral orders, such as [4, 5], in
+        which case the registration is performed coarse-to-fine: the map is first registered using
+        only the vertices of the coarsest icosahedral level (see retinotopy_map_level), then the
+        displacement of these vertices is interpolated onto the next level, which is registered in
+        turn, and so on up to the full-resolution map. The resample option must be 'fsaverage' or
+        'fsaverage_sym' for this option to be used. If the interpolated displacement would fold the
+        finer mesh, it is halved until it does not.
+      * multiresolution_steps (default: None) may give the max_steps for each level of a
+        multiresolution registration, with the final element giving that of the full-resolution
+        map; by default, each coarse level is given max_steps and the full-resolution map is
+        given max_steps // 4.
+      * initial_registration (default: None) may specify a previous registration of the hemisphere
+        to the model from which the registration should be started, such as the registration
+        written to surf/lh.retinotopy_sym.sphere.reg by the register_retinotopy command; it may be
+        the name of a registration of the hemisphere (or of its inverted right hemisphere, for a
+        right hemisphere), a sphere.reg filename, or a Registration object. The map vertices are
+        moved to their positions in this registration, projected through the model's projection,
+        before minimization, while the prior-warped map remains the reference of the potential
+        field; when the data have changed only slightly, the registration then converges in far
+        fewer steps. If the warm-start coordinates would fold the map, the displacement toward
+        them is halved until it does not.
+    When return_meta_data is True, the meta-data includes the entry 'registration_levels', a list
+    of dictionaries, one per level of the registration, of the level's 'vertex_count', 'max_steps',
+    'time' (the number of seconds the level's registration took), and 'potential' (the final
+    potential of the level's field, as reported by the minimizer of the registration's backend, or
+    None if the level took no steps); the single-level registration has one such entry, so that the
+    time to a final potential can be compared between the two.
     '''
     # Step 1: prep the map for registration--figure out what properties we're using...
     model = retinotopy_model()      if model is None                 else \
@@ -879,41 +1298,135 @@ def register_retinotopy(hemi,
                                           max_eccentricity=max_eccentricity,
                                           partial_voluming_correction=partial_voluming_correction,
                                           max_predicted_eccen=max_predicted_eccen,
-                                          prior=prior, resample=resample)
+                                          prior=prior, resample=resample,
+                                          initial_registration=initial_registration)
     # Step 2: run the mesh registration
-    if max_steps == 0:
-        r = data['map'].coordinates
-    else:
-        elens = data['map'].edge_lengths
-        if edge_max_compression is None and edge_max_stretch is None:
-            edge_well_potential = []
-        else: 
-            emin = 0 if edge_max_compression is None else edge_max_compression * elens
-            emax = (10**6) * elens if edge_max_stretch is None else edge_max_stretch * elens
-            edge_well_potential = [['edge', 'infinite-well', 'min', emin, 'max', emax]]
-        r = mesh_register(
-            data['map'],
-            edge_well_potential + [
-                ['angle',     'infinite-well'],
-                ['edge',      'harmonic',      'scale', edge_scale],
-                ['angle',     'harmonic',      'scale', angle_scale],
-                ['perimeter', 'harmonic'],
-                retinotopy_anchors(data['map'], model,
-                                   polar_angle='polar_angle',
-                                   eccentricity='eccentricity',
-                                   weight='weight',
-                                   weight_cutoff=0, # taken care of above
-                                   scale=functional_scale,
-                                   select=select,
-                                   **({} if sigma is Ellipsis else {'sigma':sigma}))],
-            method=method,
-            max_steps=max_steps,
-            max_step_size=max_step_size)
+    (r, levels) = _register_retinotopy_map(
+        data,
+        (model, edge_scale, angle_scale, functional_scale,
+         edge_max_compression, edge_max_stretch, select, sigma),
+        max_steps, max_step_size, method, multiresolution, multiresolution_steps,
+        record_levels=return_meta_data,
+        checkpoint=checkpoint,
+        checkpoint_steps=checkpoint_steps,
+        checkpoint_interval=checkpoint_interval,
+        resume_from=resume_from)
+    data['registration_levels'] = levels
     # Step 3: run the post-processing function
     postproc = data['postprocess_function']
     ppr = postproc(r)
     return ppr if return_meta_data else ppr['registered_mesh']
 
+# the register_retinotopy options that may be varied by register_retinotopy_sweep
+_retinotopy_sweep_parameters = ('functional_scale', 'edge_scale', 'angle_scale', 'sigma',
+                                'weight_cutoff', 'edge_max_compression', 'edge_max_stretch',
+                                'select', 'max_steps', 'max_step_size', 'method')
+def _argument_defaults(f, names):
+    # yields a dictionary of the default values of the given arguments of the function f
+    spec = inspect.getargspec(f)
+    defaults = dict(zip(spec.args[-len(spec.defaults):], spec.defaults))
+    return {k: defaults[k] for k in names}
+# the register_retinotopy defaults of the options that may be varied
+_retinotopy_sweep_defaults = _argument_defaults(register_retinotopy, _retinotopy_sweep_parameters)
+
+def _retinotopy_sweep_key(params):
+    # yields a hashable key for the dictionary of parameters params
+    def freeze(v):
+        if isinstance(v, np.ndarray): v = v.tolist()
+        return tuple(freeze(u) for u in v) if isinstance(v, (list, tuple)) else v
+    return tuple(sorted((k, freeze(v)) for (k,v) in params.iteritems()))
+
+def register_retinotopy_sweep(hemi, param_grid, model='benson17', workers=None,
+                              return_meta_data=False, **kw):
+    '''
+    register_retinotopy_sweep(hemi, param_grid) runs register_retinotopy on the given hemisphere
+    once for every set of parameters in the given parameter grid and yields a dictionary of the
+    results. The param_grid may be a dictionary whose keys are register_retinotopy options and whose
+    values are lists of the values to try for that option, in which case every combination of the
+    values is run, or a list of such dictionaries whose values are single values, each of which is
+    run. The options that may be varied are functional_scale, edge_scale, angle_scale, sigma,
+    weight_cutoff, edge_max_compression, edge_max_stretch, select, max_steps, max_step_size, and
+    method; any other register_retinotopy option may be passed as a keyword argument and applies to
+    all of the runs.
+
+    Unlike repeated calls to register_retinotopy, the sweep prepares the map for registration (see
+    register_retinotopy_initialize) once for each distinct weight_cutoff and shares it, along with
+    the arrays of its mesh that are sent to the JVM, among the runs. The runs are performed
+    concurrently by a pool of worker threads; workers (default: None) gives the number of threads
+    and, if None, one thread per CPU is used (see also neuropythy.java.java_gateway, which gives
+    each thread its own JVM gateway).
+
+    The keys of the result are tuples of the sorted (option, value) pairs of each parameter set
+    (lists are converted into tuples), and each value is a dictionary with the entries 'parameters',
+    the run's options; 'time', the number of seconds that the run's registration took (excluding the
+    shared initialization); 'potential', the final potential of the registration, as reported by
+    the minimizer (the field is not evaluated again after the registration); and
+    'registered_mesh', as yielded by register_retinotopy. If return_meta_data is True, the entry
+    'meta_data' additionally gives the meta-data that register_retinotopy would yield.
+    '''
+    # Parse the parameter grid
+    if isinstance(param_grid, dict):
+        names = sorted(param_grid.keys())
+        grid = [dict(zip(names, vals))
+                for vals in itertools.product(*[param_grid[k] for k in names])]
+    else:
+        grid = [dict(g) for g in param_grid]
+    for g in grid:
+        for k in g.iterkeys():
+            if k not in _retinotopy_sweep_parameters:
+                raise ValueError('register_retinotopy_sweep cannot vary the option %s' % k)
+    init_names = ('polar_angle', 'eccentricity', 'weight', 'max_eccentricity',
+                  'partial_voluming_correction', 'max_predicted_eccen', 'prior', 'resample',
+                  'initial_registration')
+    reg_names = ('multiresolution', 'multiresolution_steps')
+    for k in kw.iterkeys():
+        if k not in _retinotopy_sweep_parameters and k not in init_names and k not in reg_names:
+            raise ValueError('register_retinotopy_sweep does not accept the option %s' % k)
+    # the register_retinotopy defaults of the options that are not given
+    defaults = dict(_retinotopy_sweep_defaults)
+    defaults.update({k:v for (k,v) in kw.iteritems() if k in _retinotopy_sweep_parameters})
+    init_opts = {k: kw[k] for k in init_names if k in kw}
+    reg_opts = {k: kw.get(k, None) for k in reg_names}
+    model = retinotopy_model()      if model is None                 else \
+            retinotopy_model(model) if isinstance(model, basestring) else \
+            model
+    # Initialize once per weight cutoff
+    inits = {}
+    for g in grid:
+        cutoff = g.get('weight_cutoff', defaults['weight_cutoff'])
+        if cutoff not in inits:
+            inits[cutoff] = register_retinotopy_initialize(hemi, model=model,
+                                                           weight_cutoff=cutoff, **init_opts)
+    def _run(g):
+        p = dict(defaults, **g)
+        data = inits[p['weight_cutoff']]
+        t0 = time.time()
+        # the recorded levels carry the final potential from the minimizer's report
+        (r, levels) = _register_retinotopy_map(
+            data,
+            (model, p['edge_scale'], p['angle_scale'], p['functional_scale'],
+             p['edge_max_compression'], p['edge_max_stretch'], p['select'], p['sigma']),
+            p['max_steps'], p['max_step_size'], p['method'],
+            reg_opts['multiresolution'], reg_opts['multiresolution_steps'],
+            record_levels=True)
+        dt = time.time() - t0
+        ppr = data['postprocess_function'](r)
+        res = {'parameters':      make_dict(g),
+               'time':            dt,
+               'potential':       levels[-1]['potential'],
+               'registered_mesh': ppr['registered_mesh']}
+        if return_meta_data: res['meta_data'] = ppr.using(registration_levels=levels)
+        return (_retinotopy_sweep_key(g), make_dict(res))
+    if workers is None: workers = multiprocessing.cpu_count()
+    workers = max(1, min(int(workers), len(grid)))
+    if workers == 1: return dict(map(_run, grid))
+    pool = ThreadPool(workers)
+    try:
+        return dict(pool.map(_run, grid))
+    finally:
+        pool.close()
+        pool.join()
+
 # Tools for registration-free retinotopy prediction:
 _retinotopy_templates = {}
 def predict_retinotopy(sub, template='benson17'):
@@ -954,12 +1467,11 @@ def predict_retinotopy(sub, template='benson17'):
     # Okay, we just need to interpolate over to this subject
     tmpl = _retinotopy_templates[template]
     sym = freesurfer_subject('fsaverage_sym').LH
-    return (
-        {'polar_angle':  sub.LH.interpolate(sym,  tmpl['angle'], apply=False),
-         'eccentricity': sub.LH.interpolate(sym,  tmpl['eccen'], apply=False),
-         'visual_area':  sub.LH.interpolate(sym,  tmpl['varea'], apply=False, method='nearest')},
-        {'polar_angle':  sub.RHX.interpolate(sym, tmpl['angle'], apply=False),
-         'eccentricity': sub.RHX.interpolate(sym, tmpl['eccen'], apply=False),
-         'visual_area':  sub.RHX.interpolate(sym, tmpl['varea'], apply=False, method='nearest')})
+    # all three properties are interpolated in one pass per hemisphere
+    props = {'polar_angle': tmpl['angle'], 'eccentricity': tmpl['eccen'],
+             'visual_area': tmpl['varea']}
+    methods = {'polar_angle': 'automatic', 'eccentricity': 'automatic', 'visual_area': 'nearest'}
+    return tuple(hem.interpolate(sym, props, apply=False, method=methods)
+                 for hem in (sub.LH, sub.RHX))
         
 
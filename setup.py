@@ -52,7 +52,8 @@ setup(
               'neuropythy.cortex',
               'neuropythy.registration',
               'neuropythy.vision',
-              'neuropythy.commands'],
+              'neuropythy.commands',
+              'neuropythy.test'],
     include_package_data=True,
     package_data={
         '': ['LICENSE.txt',